@@ -305,6 +305,7 @@ class Docker(object):
                 raise Exception("Passed unknown compression type (%s) for Docker plugin" % (compress_type))
         else:
             compress_command = None
+        builder.cancellation.check()
         guestfs_handle = launch_inspect_and_mount(builder.base_image.data, readonly = True)
         storagedir = os.path.dirname(builder.target_image.data)
 
@@ -314,6 +315,11 @@ class Docker(object):
         # go wrong
         tempdir = None
         fuse_thread = None
+        unmounted = [ ]
+        def _unmount_on_cancel():
+            # Fails the tar below and lets mount_local_run return
+            subprocess.call( ['umount', '-f', tempdir] )
+            unmounted.append(tempdir)
         try:
             tempdir = tempfile.mkdtemp(dir=storagedir)
             self.log.debug("Mounting input image locally at (%s)" % (tempdir))
@@ -323,6 +329,7 @@ class Docker(object):
             self.log.debug("Launching mount_local_run thread")
             fuse_thread = threading.Thread(group=None, target=_run_guestmount, args=(guestfs_handle,))
             fuse_thread.start()
+            builder.cancellation.on_cancel(_unmount_on_cancel)
             self.log.debug("Creating tar of entire image")
             # NOTE - we used to capture xattrs here but have reverted the change for now
             #        as SELinux xattrs break things in unexpected ways and the tar feature
@@ -344,6 +351,7 @@ class Docker(object):
             tarcmd.append('./')
             self.log.debug("Command: %s" % (str(tarcmd)))
             subprocess.check_call(tarcmd)
+            builder.cancellation.check()
             if wrap_metadata:
                 self.log.debug("Estimating size of tar contents to include in Docker metadata")
                 size = 0
@@ -357,9 +365,11 @@ class Docker(object):
             self.log.exception(e)
             raise
         finally:
+            builder.cancellation.remove(_unmount_on_cancel)
             if tempdir:
                 try:
-                    subprocess.check_call( ['umount', '-f', tempdir] )
+                    if not unmounted:
+                        subprocess.check_call( ['umount', '-f', tempdir] )
                     os.rmdir(tempdir)
                 except Exception as e:
                     self.log.exception(e)
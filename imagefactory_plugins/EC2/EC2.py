@@ -517,7 +517,7 @@ class EC2(object):
             except:
                 pass
 
-            sleep(1)
+            self.builder.cancellation.sleep(1)
 
         if i == 299:
             raise ImageFactoryException("Unable to gain ssh access after 300 seconds - aborting")
@@ -543,7 +543,7 @@ class EC2(object):
                 raise ImageFactoryException("Exception encountered when waiting for instance (%s) to start" % (instance.id))
             if instance.state == 'running':
                 break
-            sleep(1)
+            self.builder.cancellation.sleep(1)
 
         if instance.state != 'running':
             self.status="FAILED"
@@ -659,6 +659,7 @@ class EC2(object):
             instance_type=self.app_config.get('ec2-32bit-util','m1.small')
 
         # Create a use-once SSH-able security group
+        self.builder.cancellation.check()
         self.activity("Creating EC2 security group for SSH access to utility image")
         factory_security_group_name = "imagefactory-%s" % (self.new_image_id, )
         factory_security_group_desc = "Temporary ImageFactory generated security group with SSH access"
@@ -703,12 +704,13 @@ class EC2(object):
             # There are a handful of additional boot tasks after SSH starts running
             # Give them an additional 20 seconds for good measure
             self.log.debug("Waiting 20 seconds for remaining boot tasks")
-            sleep(20)
+            self.builder.cancellation.sleep(20)
 
             if (user != 'root'):
                 self.log.debug("Temporarily enabling root user for customization steps...")
                 enable_root(guestaddr, key_file, user, cmd_prefix)
 
+            self.builder.cancellation.check()
             self.activity("Customizing running EC2 JEOS instance")
             self.log.debug("Stopping cron and killing any updatedb process that may be running")
             # updatedb interacts poorly with the bundle step - make sure it isn't running
@@ -828,7 +830,7 @@ class EC2(object):
                 self.activity("Waiting for newly generated AMI to become available")
                 # As with launching an instance we have seen occasional issues when trying to query this AMI right
                 # away - give it a moment to settle
-                sleep(10)
+                self.builder.cancellation.sleep(10)
                 new_amis = conn.get_all_images([ new_ami_id ])
                 new_ami = new_amis[0]
                 timeout = 120
@@ -840,7 +842,7 @@ class EC2(object):
                     elif new_ami.state == "failed":
                         raise ImageFactoryException("Amazon reports EBS image creation failed")
                     self.log.debug("AMI status (%s) - waiting for 'available' - [%d of %d seconds elapsed]" % (new_ami.state, i * interval, timeout * interval))
-                    sleep(interval)
+                    self.builder.cancellation.sleep(interval)
 
             if not new_ami_id:
                 raise ImageFactoryException("Failed to produce an AMI ID")
@@ -947,23 +949,18 @@ class EC2(object):
         self.ec2_key_file_object.flush()
         self.ec2_key_file=self.ec2_key_file_object.name
 
-    def ec2_push_image_upload_ebs(self, target_image_id, provider, credentials, virt_type, flat):
-        # TODO: Merge with ec2_push_image_upload and/or factor out duplication
-        # In this case we actually do need an Oz object to manipulate a remote guest
-        self.os_helper.init_guest()
-
-        self.ec2_decode_credentials(credentials)
-        # We don't need the x509 material here so close the temp files right away
-        # TODO: Mod the decode to selectively create the files in the first place
-        #   This is silly and messy
-        self.ec2_cert_file_object.close()
-        self.ec2_key_file_object.close()
-
-        # Image is always here and it is the target_image datafile
-        input_image = self.builder.target_image.data
-
+    def prepare_push_to_providers(self, builder, target, parameters):
+        # Called once before the first of several pushes of the same TargetImage
+        # Security groups, key pairs and utility instances belong to a region so only
+        # the compression of the image for EBS uploads can be shared
+        self.active_image = builder.provider_image
+        parameters = parameters if parameters else { }
+        ami_type = parameters.get('ec2_ami_type', self.app_config.get('ec2_ami_type', 'ebs'))
+        if ami_type == "ebs":
+            self.ec2_compress_image(builder.target_image.data)
+
+    def ec2_compress_image(self, input_image):
         input_image_compressed = input_image + ".gz"
-        input_image_compressed_name = os.path.basename(input_image_compressed)
         compress_complete_marker = input_image_compressed + "-factory-compressed"
 
         # We are guaranteed to hit this from multiple builders looking at the same image
@@ -989,6 +986,27 @@ class EC2(object):
         finally:
             res_mgr.release_named_lock(input_image_compressed)
 
+        return input_image_compressed
+
+    def ec2_push_image_upload_ebs(self, target_image_id, provider, credentials, virt_type, flat):
+        # TODO: Merge with ec2_push_image_upload and/or factor out duplication
+        # In this case we actually do need an Oz object to manipulate a remote guest
+        self.os_helper.init_guest()
+
+        self.ec2_decode_credentials(credentials)
+        # We don't need the x509 material here so close the temp files right away
+        # TODO: Mod the decode to selectively create the files in the first place
+        #   This is silly and messy
+        self.ec2_cert_file_object.close()
+        self.ec2_key_file_object.close()
+
+        # Image is always here and it is the target_image datafile
+        input_image = self.builder.target_image.data
+
+        input_image_compressed = self.ec2_compress_image(input_image)
+        input_image_compressed_name = os.path.basename(input_image_compressed)
+        self.builder.checkpoint(self.builder.provider_image, 'compressed', path=input_image_compressed)
+
         self.activity("Preparing EC2 region details")
         region=provider
         region_conf=self._decode_region_details(region)
@@ -1007,7 +1025,19 @@ class EC2(object):
         ec2region = boto.ec2.get_region(region_conf['host'], aws_access_key_id=self.ec2_access_key, aws_secret_access_key=self.ec2_secret_key)
         conn = ec2region.connect(aws_access_key_id=self.ec2_access_key, aws_secret_access_key=self.ec2_secret_key)
 
+        # A push we were asked to carry on from (parameter resume_from) may have got as far as
+        # the snapshot - registering it is all that is left and needs no utility instance
+        snapshot_checkpoint = (self.builder.provider_image.checkpoints or { }).get('snapshot_taken')
+        if snapshot_checkpoint and (snapshot_checkpoint.get('region') == region_conf['host']):
+            self.activity("Resuming from existing EC2 snapshot (%s)" % (snapshot_checkpoint['snapshot_id']))
+            ami_id = self.ec2_register_ebs_snapshot(conn, snapshot_checkpoint['snapshot_id'], flat, aki, virt_type)
+            self.builder.provider_image.identifier_on_provider=ami_id
+            self.builder.provider_image.provider_account_identifier=self.ec2_access_key
+            self.percent_complete=100
+            return
+
         # Create security group
+        self.builder.cancellation.check()
         self.activity("Creating EC2 security group for SSH access to utility image")
         factory_security_group_name = "imagefactory-%s" % (str(self.new_image_id))
         factory_security_group_desc = "Temporary ImageFactory generated security group with SSH access"
@@ -1052,7 +1082,7 @@ class EC2(object):
             # There are a handful of additional boot tasks after SSH starts running
             # Give them an additional 20 seconds for good measure
             self.log.debug("Waiting 20 seconds for remaining boot tasks")
-            sleep(20)
+            self.builder.cancellation.sleep(20)
 
             if (ami_info['user'] != 'root'):
                 self.log.debug("Temporarily enabling root user for customization steps...")
@@ -1061,13 +1091,16 @@ class EC2(object):
             GIGABYTE = 2 ** 30
             # This rounds up to the nearest GiB and correctly deals with exact number of GB files
             ami_size =int((os.path.getsize(input_image) + GIGABYTE - 1)/GIGABYTE)
+            self.builder.cancellation.check()
             self.activity("Creating %d GiB volume in (%s) to hold new image" % (ami_size,self.instance.placement))
             volume = conn.create_volume(ami_size, self.instance.placement)
+            self.builder.checkpoint(self.builder.provider_image, 'volume_created', volume_id=volume.id, region=region_conf['host'])
 
             # Do the upload before testing to see if the volume has completed
             # to get a bit of parallel work
             self.activity("Uploading compressed image file")
             self.guest.guest_live_upload(guestaddr, input_image_compressed, "/mnt")
+            self.builder.checkpoint(self.builder.provider_image, 'uploaded', instance_id=self.instance.id, region=region_conf['host'])
 
             # Don't burden API users with the step-by-step details here
             self.activity("Preparing EC2 volume to receive new image")
@@ -1082,7 +1115,7 @@ class EC2(object):
                     retcode = 0
                     break
                 self.log.debug("Volume status (%s) - waiting for 'available': %d/600" % (volume.status, i*10))
-                sleep(10)
+                self.builder.cancellation.sleep(10)
 
             if retcode:
                 raise ImageFactoryException("Unable to create target volume for EBS AMI - aborting")
@@ -1100,7 +1133,7 @@ class EC2(object):
                     retcode = 0
                     break
                 self.log.debug("Volume status (%s) - waiting for 'attached': %d/120" % (vs, i*10))
-                sleep(10)
+                self.builder.cancellation.sleep(10)
 
             if retcode:
                 raise ImageFactoryException("Unable to attach volume (%s) to instance (%s) aborting" % (volume.id, self.instance.id))
@@ -1108,9 +1141,10 @@ class EC2(object):
             # TODO: This may not be necessary but it helped with some funnies observed during testing
             #         At some point run a bunch of builds without the delay to see if it breaks anything
             self.log.debug("Waiting 20 seconds for EBS attachment to stabilize")
-            sleep(20)
+            self.builder.cancellation.sleep(20)
 
             # Decompress image into new EBS volume
+            self.builder.cancellation.check()
             self.activity("Decompressing image into new volume")
             command = "gzip -dc /mnt/%s | dd of=/dev/xvdh bs=4k\n" % (input_image_compressed_name)
             self.log.debug("Decompressing image file into EBS device via command: %s" % (command))
@@ -1120,6 +1154,7 @@ class EC2(object):
             self.guest.guest_execute_command(guestaddr, "sync")
 
             # Snapshot EBS volume
+            self.builder.cancellation.check()
             self.activity("Taking EC2 snapshot of new volume")
             self.log.debug("Taking snapshot of volume (%s)" % (volume.id))
             snapshot = conn.create_snapshot(volume.id, 'Image Factory Snapshot for provider image %s' % self.new_image_id)
@@ -1133,47 +1168,14 @@ class EC2(object):
                     retcode = 0
                     break
                 self.log.debug("Snapshot progress(%s) -  status (%s) - waiting for 'completed': %d/1200" % (str(snapshot.progress), snapshot.status, i*10))
-                sleep(10)
+                self.builder.cancellation.sleep(10)
 
             if retcode:
                 raise ImageFactoryException("Unable to snapshot volume (%s) - aborting" % (volume.id))
 
-            # register against snapshot
-            self.activity("Registering snapshot as a new AMI")
-            self.log.debug("Registering snapshot (%s) as new EBS AMI" % (snapshot.id))
-            if flat:
-                root_dev = '/dev/sda1'
-            else:
-                # For reasons known only to Amazon, putting sda in here fails
-                # TODO: Find out why
-                root_dev = '/dev/xvda'
-                aki = None
-            ebs = EBSBlockDeviceType()
-            ebs.snapshot_id = snapshot.id
-            ebs.delete_on_termination = True
-            block_map = BlockDeviceMapping()
-            block_map[root_dev] = ebs
-            # The ephemeral mappings are automatic with S3 images
-            # For EBS images we need to make them explicit
-            # These settings are required to make the same fstab work on both S3 and EBS images
-            e0 = EBSBlockDeviceType()
-            e0.ephemeral_name = 'ephemeral0'
-            e1 = EBSBlockDeviceType()
-            e1.ephemeral_name = 'ephemeral1'
-            if self.tdlobj.arch == "i386" and virt_type == 'paravirtual':
-                # TODO: This is kind of a legacy oddity from the S3 days - revisit
-                block_map['/dev/sda2'] = e0
-                block_map['/dev/sda3'] = e1
-            else:
-                block_map['/dev/sdb'] = e0
-                block_map['/dev/sdc'] = e1
-            result = conn.register_image(name='ImageFactory created AMI - %s' % (self.new_image_id),
-                            description='ImageFactory created AMI - %s' % (self.new_image_id),
-                            architecture=self.tdlobj.arch,  kernel_id=aki,
-                            root_device_name=root_dev, block_device_map=block_map,
-                            virtualization_type = virt_type)
-
-            ami_id = str(result)
+            self.builder.checkpoint(self.builder.provider_image, 'snapshot_taken', snapshot_id=snapshot.id, region=region_conf['host'])
+
+            ami_id = self.ec2_register_ebs_snapshot(conn, snapshot.id, flat, aki, virt_type)
             self.log.debug("Extracted AMI ID: %s " % (ami_id))
         except:
             self.log.debug("EBS image upload failed on exception")
@@ -1231,6 +1233,44 @@ class EC2(object):
         self.builder.provider_image.provider_account_identifier=self.ec2_access_key
         self.percent_complete=100
 
+    def ec2_register_ebs_snapshot(self, conn, snapshot_id, flat, aki, virt_type):
+        # register against snapshot
+        self.activity("Registering snapshot as a new AMI")
+        self.log.debug("Registering snapshot (%s) as new EBS AMI" % (snapshot_id))
+        if flat:
+            root_dev = '/dev/sda1'
+        else:
+            # For reasons known only to Amazon, putting sda in here fails
+            # TODO: Find out why
+            root_dev = '/dev/xvda'
+            aki = None
+        ebs = EBSBlockDeviceType()
+        ebs.snapshot_id = snapshot_id
+        ebs.delete_on_termination = True
+        block_map = BlockDeviceMapping()
+        block_map[root_dev] = ebs
+        # The ephemeral mappings are automatic with S3 images
+        # For EBS images we need to make them explicit
+        # These settings are required to make the same fstab work on both S3 and EBS images
+        e0 = EBSBlockDeviceType()
+        e0.ephemeral_name = 'ephemeral0'
+        e1 = EBSBlockDeviceType()
+        e1.ephemeral_name = 'ephemeral1'
+        if self.tdlobj.arch == "i386" and virt_type == 'paravirtual':
+            # TODO: This is kind of a legacy oddity from the S3 days - revisit
+            block_map['/dev/sda2'] = e0
+            block_map['/dev/sda3'] = e1
+        else:
+            block_map['/dev/sdb'] = e0
+            block_map['/dev/sdc'] = e1
+        result = conn.register_image(name='ImageFactory created AMI - %s' % (self.new_image_id),
+                        description='ImageFactory created AMI - %s' % (self.new_image_id),
+                        architecture=self.tdlobj.arch,  kernel_id=aki,
+                        root_device_name=root_dev, block_device_map=block_map,
+                        virtualization_type = virt_type)
+
+        return str(result)
+
     def ec2_push_image_upload(self, target_image_id, provider, credentials, virt_type, flat):
         def replace(item):
             if item in [self.ec2_access_key, self.ec2_secret_key]:
@@ -1357,7 +1397,8 @@ class EC2(object):
         # TODO: Make this progressively more robust
 
         # In the near term, the most important thing we can do is terminate any EC2 instance we may be using
-        if self.instance:
+        # Only set once a push or snapshot has got as far as launching one
+        if getattr(self, 'instance', None):
             instance_id = self.instance.id
             try:
                 self.terminate_instance(self.instance)
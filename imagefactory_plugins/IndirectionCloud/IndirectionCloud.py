@@ -214,6 +214,10 @@ class IndirectionCloud(object):
             self.add_disk(libvirt_doc, builder.base_image.data, input_image_device)
 
         # Run all commands, repo injection, etc specified
+        memory_mb, cpus = self.res_mgr.guest_resources(self.guest)
+        self.log.debug("Waiting for %d MB of memory and %d vCPUs to launch the utility image" % (memory_mb, cpus))
+        self.res_mgr.admit(builder.target_image.identifier, memory_mb=memory_mb, cpus=cpus,
+                           cancellation=builder.cancellation)
         try:
             self.log.debug("Launching utility image and running any customizations specified")
             libvirt_xml = libvirt_doc.serialize(None, 1)
@@ -222,6 +226,7 @@ class IndirectionCloud(object):
         finally:
             self.log.debug("Cleaning up install artifacts")
             self.guest.cleanup_install()
+            self.res_mgr.release(builder.target_image.identifier)
 
         # After shutdown, extract the results
         results_location = parameters.get('results_location', "/results/images/boot.iso")
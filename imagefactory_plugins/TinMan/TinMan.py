@@ -32,6 +32,7 @@ from imgfac.ReservationManager import ReservationManager
 from imgfac.FactoryUtils import launch_inspect_and_mount, shutdown_and_close, remove_net_persist
 from imgfac.OSDelegate import OSDelegate
 from imgfac.FactoryUtils import parameter_cast_to_bool
+from imgfac.BlobStore import clone_file, unshare_file
 from libvirt import libvirtError
 from oz.OzException import OzException
 import json
@@ -70,7 +71,9 @@ class TinMan(object):
         # which we do not want to modify in place
         self.activity("Copying BaseImage to modifiable TargetImage")
         self.log.debug("Copying base_image file (%s) to new target_image file (%s)" % (builder.base_image.data, builder.target_image.data))
-        oz.ozutil.copyfile_sparse(builder.base_image.data, builder.target_image.data)
+        # A reflink shares the blocks until the target image starts to diverge
+        if not clone_file(builder.base_image.data, builder.target_image.data):
+            oz.ozutil.copyfile_sparse(builder.base_image.data, builder.target_image.data)
         self.image = builder.target_image.data
 
         # Merge together any TDL-style customizations requested via our plugin-to-plugin interface
@@ -108,11 +111,19 @@ class TinMan(object):
         # when we are done with our second  stage customizations
         # TODO: Consider moving all of that back here
 
+        builder.cancellation.check()
         guestfs_handle = launch_inspect_and_mount(builder.target_image.data)
-        remove_net_persist(guestfs_handle)
-        shutdown_and_close(guestfs_handle)
+        try:
+            remove_net_persist(guestfs_handle)
+        finally:
+            shutdown_and_close(guestfs_handle)
 
+        memory_mb, cpus = self.res_mgr.guest_resources(self.guest)
+        self.activity("Waiting for %d MB of memory and %d vCPUs to run the guest" % (memory_mb, cpus))
+        self.res_mgr.admit(builder.target_image.identifier, memory_mb=memory_mb, cpus=cpus,
+                           cancellation=builder.cancellation)
         try:
+            builder.cancellation.check()
             self.log.debug("Doing second-stage target_image customization and ICICLE generation")
             #self.percent_complete = 30
             builder.target_image.icicle = self.guest.customize_and_generate_icicle(libvirt_xml)
@@ -121,6 +132,7 @@ class TinMan(object):
         finally:
             self.activity("Cleaning up install artifacts")
             self.guest.cleanup_install()
+            self.res_mgr.release(builder.target_image.identifier)
 
     def add_cloud_plugin_content(self, content):
         # This is a method that cloud plugins can call to deposit content/commands to be run
@@ -316,34 +328,61 @@ class TinMan(object):
         # Used in the logging helper function above
         self.active_image = self.base_image
 
+        # A build interrupted by a restart of the factory after the install finished
+        # carries on with the disk image it left behind
+        checkpoints = self.base_image.checkpoints if self.base_image.checkpoints else { }
+        resume_install = ('install_done' in checkpoints) and (self.base_image.parameters or { }).get('libvirt_xml') and \
+                         isfile(self.base_image.data)
+
         try:
             self._init_oz()
+            if resume_install:
+                # Customizing writes to the disk image - never through a body shared with other images
+                unshare_file(self.base_image.data)
             self.guest.diskimage = self.base_image.data
-            self.activity("Cleaning up any old Oz guest")
-            self.guest.cleanup_old_guest()
-            self.activity("Generating JEOS install media")
-            self.threadsafe_generate_install_media(self.guest)
+            if not resume_install:
+                self.activity("Cleaning up any old Oz guest")
+                self.guest.cleanup_old_guest()
+                builder.cancellation.check()
+                self.activity("Generating JEOS install media")
+                self.threadsafe_generate_install_media(self.guest)
             self.percent_complete=10
 
             # We want to save this later for use by RHEV-M and Condor clouds
             libvirt_xml=""
             gfs = None
 
+            # Newer Oz versions introduce a configurable disk size in TDL
+            # We must still detect that it is present and pass it in this call
             try:
-                self.activity("Generating JEOS disk image")
-                # Newer Oz versions introduce a configurable disk size in TDL
-                # We must still detect that it is present and pass it in this call
-                try:
-                    disksize=getattr(self.guest, "disksize")
-                except AttributeError:
-                    disksize = 10
-                self.guest.generate_diskimage(size = disksize)
-                # TODO: If we already have a base install reuse it
-                #  subject to some rules about updates to underlying repo
-                self.activity("Execute JEOS install")
-                libvirt_xml = self.guest.install(self.app_config["timeout"])
-                self.base_image.parameters['libvirt_xml'] = libvirt_xml
+                disksize=getattr(self.guest, "disksize")
+            except AttributeError:
+                disksize = 10
+            # Only start the install once the guest's memory, vCPUs and full disk size fit our budgets
+            memory_mb, cpus = self.res_mgr.guest_resources(self.guest)
+            self.activity("Waiting for %d MB of memory, %d vCPUs and %d GB of disk to run the install" % (memory_mb, cpus, int(disksize)))
+            self.res_mgr.admit(self.base_image.identifier, memory_mb=memory_mb, cpus=cpus,
+                               disk_bytes=int(disksize) * 1024 * 1024 * 1024, disk_path=self.base_image.data,
+                               cancellation=builder.cancellation)
+
+            try:
+                # An install already running is stopped by abort() destroying its guest
+                builder.cancellation.check()
+                if resume_install:
+                    self.activity("Resuming after completed JEOS install")
+                    libvirt_xml = self.base_image.parameters['libvirt_xml']
+                else:
+                    self.activity("Generating JEOS disk image")
+                    self.guest.generate_diskimage(size = disksize)
+                    builder.cancellation.check()
+                    # Reuse of an existing identical base install is handled by the Builder's
+                    # build cache (base_image_cache) before we are ever called
+                    self.activity("Execute JEOS install")
+                    libvirt_xml = self.guest.install(self.app_config["timeout"])
+                    self.base_image.parameters['libvirt_xml'] = libvirt_xml
+                    builder.checkpoint(self.base_image, 'install_done')
                 self.image = self.guest.diskimage
+                builder.cancellation.check()
                 self.log.debug("Base install complete - Doing customization and ICICLE generation")
                 self.percent_complete = 30
                 # Power users may wish to avoid ever booting the guest after the installer is finished
@@ -366,6 +405,7 @@ class TinMan(object):
                     builder.base_image.icicle = "<icicle></icicle>"
                     self.guest.customize(libvirt_xml)
                 self.log.debug("Customization and ICICLE generation complete")
+                builder.checkpoint(self.base_image, 'icicle_done')
                 self.percent_complete = 50
             finally:
                 self.activity("Cleaning up install artifacts")
@@ -376,6 +416,7 @@ class TinMan(object):
                     self.install_script_object.close()    
                 if gfs:
                     shutdown_and_close(gfs)
+                self.res_mgr.release(self.base_image.identifier)
 
             self.log.debug("Generated disk image (%s)" % (self.guest.diskimage))
             # OK great, we now have a customized KVM image
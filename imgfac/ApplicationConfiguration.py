@@ -129,6 +129,9 @@ class ApplicationConfiguration(Singleton):
 
             cmd_plugins = subparsers.add_parser('plugins', help='List active plugins or get details of a specific plugin.')
             cmd_plugins.add_argument('--id')
+
+            cmd_gc = subparsers.add_parser('gc', help='Remove files left behind by failed or interrupted builds.')
+            cmd_gc.add_argument('--dry-run', action='store_true', default=False, help='Only report what would be removed. (default: %(default)s)')
         return argparser
 
     def __add_param_arguments(self, parser):
@@ -18,7 +18,8 @@ from .PersistentImage import PersistentImage
 #from props import prop
 
 
-METADATA = ( )
+# cache_key - identifies the template and parameters this image was built from
+METADATA = ('cache_key', )
 
 class BaseImage(PersistentImage):
     """ TODO: Docstring for BaseImage  """
@@ -30,6 +31,7 @@ class BaseImage(PersistentImage):
         """
         super(BaseImage, self).__init__(image_id)
         self.template = None
+        self.cache_key = None
 
     def metadata(self):
         self.log.debug("Getting metadata in class (%s) my metadata is (%s)" % (self.__class__, METADATA))
@@ -0,0 +1,351 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import stat
+import hashlib
+import fcntl
+import errno
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+BLOB_DIR = 'blobs'
+REF_DIR = 'refs'
+# From linux/fs.h - _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def _temp_path_for(destination):
+    # Next to the destination so it can be renamed over it
+    return '%s.%d.copy' % (destination, os.getpid())
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def clone_file(source, destination):
+    """
+    Make destination a copy-on-write clone of source if the filesystem supports
+    reflinks (btrfs, XFS with reflink=1, ...).  The clone is renamed over destination,
+    so a destination that is a body shared with a blob is replaced, not written through.
+
+    @param source Path of the file to copy
+    @param destination Path of the copy, created or replaced
+
+    @return True if the clone was made, False if the caller has to copy the data itself
+    """
+    temp_path = _temp_path_for(destination)
+    try:
+        with open(source, 'rb') as src:
+            with open(temp_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.rename(temp_path, destination)
+        return True
+    except (IOError, OSError):
+        _remove_quietly(temp_path)
+        return False
+
+
+def unshare_file(path):
+    """
+    Give the file at path a writable copy of its content of its own if it is a body
+    shared with a blob, so that writing to it cannot change any other image.
+
+    @return True if a copy was made
+    """
+    if os.stat(path).st_nlink <= 1:
+        return False
+    copy_file(path, path)
+    return True
+
+
+class BlobStore(object):
+    """
+    Stores image bodies once per distinct content, keyed by their SHA-256 digest.
+
+    An image body taken into the store becomes a hard link to its blob, so identical
+    bodies share their disk blocks and the link count of a blob is the number of images
+    using it plus one.  For each image a symlink under refs/ records which blob it
+    uses so the blob can be dropped along with its last image.  Blobs are made read
+    only - a shared body must be replaced rather than modified in place.
+    """
+
+    def __init__(self, storage_path, chunk_size=4*1024*1024):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        # Must be on the same filesystem as the bodies for the hard links to work
+        self.blob_path = os.path.join(storage_path, BLOB_DIR)
+        self.ref_path = os.path.join(self.blob_path, REF_DIR)
+        self.chunk_size = chunk_size
+        self._lock = Lock()
+        # Files waiting for ingest_later(), key to path, and the key being ingested
+        self._queue_cond = Condition()
+        self._queued = OrderedDict()
+        self._ingesting = None
+        self._ingest_thread = None
+        if not os.path.isdir(self.ref_path):
+            os.makedirs(self.ref_path)
+
+    def _path_for_digest(self, digest):
+        return os.path.join(self.blob_path, digest[0:2], digest)
+
+    def _path_for_ref(self, key):
+        return os.path.join(self.ref_path, key)
+
+    def digest(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as body:
+            chunk = body.read(self.chunk_size)
+            while chunk:
+                sha.update(chunk)
+                chunk = body.read(self.chunk_size)
+        return sha.hexdigest()
+
+    def _forget(self, key):
+        # Caller must hold _lock
+        ref = self._path_for_ref(key)
+        try:
+            blob = os.readlink(ref)
+        except OSError:
+            return
+        os.remove(ref)
+        try:
+            if os.stat(blob).st_nlink <= 1:
+                os.remove(blob)
+                self.log.debug("Removed unreferenced blob (%s)" % (os.path.basename(blob)))
+        except OSError as e:
+            self.log.warning("Unable to check or remove blob (%s): %s" % (blob, e))
+
+    def digest_for(self, key):
+        """
+        @return The digest of the blob the body stored under key uses, or None
+        """
+        try:
+            return os.path.basename(os.readlink(self._path_for_ref(key)))
+        except OSError:
+            return None
+
+    def ingest(self, key, path):
+        """
+        Move the file at path into the store, leaving a link to its blob in its place.
+
+        @param key The owner of the file, normally the image identifier
+        @param path The file to deduplicate
+
+        @return The digest of the file's content, or None if the file changed while it
+                was being hashed
+        """
+        digest = self.digest_for(key)
+        if digest:
+            try:
+                if os.path.samefile(path, self._path_for_digest(digest)):
+                    return digest
+            except OSError:
+                pass
+            # Replaced by a copy of its own since - whatever it holds now needs a new blob
+            with self._lock:
+                self._forget(key)
+        # Read only before hashing, so a writer that honours the mode cannot change the
+        # content under the digest; anyone else is caught by the check below
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        before = os.stat(path)
+        digest = self.digest(path)
+        blob = self._path_for_digest(digest)
+        with self._lock:
+            after = os.stat(path)
+            if (after.st_ino, after.st_size, after.st_mtime_ns) != (before.st_ino, before.st_size, before.st_mtime_ns):
+                os.chmod(path, mode)
+                self.log.warning("(%s) changed while it was being hashed - leaving it as it is" % (path))
+                return None
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            try:
+                os.link(path, blob)
+                self.log.debug("Stored new blob (%s) from (%s)" % (digest, path))
+            except FileExistsError:
+                # Already have this content - swap the file for a link to the existing blob
+                temp_path = '%s.%s' % (path, digest)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                os.link(blob, temp_path)
+                os.rename(temp_path, path)
+                self.log.debug("Replaced (%s) with a link to existing blob (%s)" % (path, digest))
+            os.symlink(blob, self._path_for_ref(key))
+        return digest
+
+    def ingest_later(self, key, path):
+        """
+        Have a background thread ingest() the file at path, so that whoever finished
+        writing it is not held up while it is hashed.  Until then the file is left as
+        it is.
+
+        @param key The owner of the file, normally the image identifier
+        @param path The file to deduplicate
+        """
+        with self._queue_cond:
+            if (key in self._queued) or (key == self._ingesting):
+                return
+            self._queued[key] = path
+            if not self._ingest_thread:
+                self._ingest_thread = Thread(target=self._ingest_queued, name='blob-ingest')
+                self._ingest_thread.daemon = True
+                self._ingest_thread.start()
+            self._queue_cond.notify_all()
+
+    def _ingest_queued(self):
+        while True:
+            with self._queue_cond:
+                while not self._queued:
+                    self._queue_cond.wait()
+                key, path = self._queued.popitem(last=False)
+                self._ingesting = key
+            try:
+                if os.path.isfile(path):
+                    self.ingest(key, path)
+            except Exception as e:
+                # The file is still usable as it is
+                self.log.warning("Unable to deduplicate (%s): %s" % (path, e))
+            finally:
+                with self._queue_cond:
+                    self._ingesting = None
+                    self._queue_cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until every file queued by ingest_later() has been ingested.
+
+        @return False if the timeout expired first
+        """
+        with self._queue_cond:
+            return self._queue_cond.wait_for(lambda: (not self._queued) and (not self._ingesting), timeout)
+
+    def release(self, key):
+        """
+        Forget the body stored under key, removing its blob if no other body uses it.
+        The body itself is left to the caller.
+        """
+        with self._queue_cond:
+            self._queued.pop(key, None)
+            # Otherwise the ingest could record the body after it is forgotten here
+            self._queue_cond.wait_for(lambda: self._ingesting != key)
+        with self._lock:
+            self._forget(key)
+
+    def collect_orphans(self, dry_run=False):
+        """
+        Find and (unless dry_run) remove blobs no body links to any more, along with
+        their refs, and refs to blobs that are gone.  Such are left behind by bodies
+        removed or replaced without release().
+
+        @return A list of (path, bytes freed) for everything removed
+        """
+        found = [ ]
+        with self._lock:
+            gone = set()
+            for dirpath, dirnames, filenames in os.walk(self.blob_path):
+                if dirpath == self.ref_path:
+                    continue
+                for filename in filenames:
+                    blob = os.path.join(dirpath, filename)
+                    st = os.stat(blob)
+                    if st.st_nlink > 1:
+                        continue
+                    found.append((blob, st.st_blocks * 512))
+                    gone.add(blob)
+            for key in os.listdir(self.ref_path):
+                ref = self._path_for_ref(key)
+                try:
+                    blob = os.readlink(ref)
+                except OSError:
+                    continue
+                if (blob in gone) or not os.path.exists(blob):
+                    found.append((ref, 0))
+            if not dry_run:
+                for path, size in found:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        self.log.warning("Unable to remove (%s): %s" % (path, e))
+        return found
+
+    def usage(self):
+        """
+        @return A dict with the number of blobs, their total size and the bytes saved
+                by sharing them
+        """
+        blobs = 0
+        stored = 0
+        saved = 0
+        for dirpath, dirnames, filenames in os.walk(self.blob_path):
+            if dirpath == self.ref_path:
+                continue
+            for filename in filenames:
+                st = os.stat(os.path.join(dirpath, filename))
+                blobs += 1
+                stored += st.st_blocks * 512
+                saved += st.st_blocks * 512 * max(st.st_nlink - 2, 0)
+        return {'blobs': blobs, 'stored_bytes': stored, 'saved_bytes': saved}
+
+
+def copy_file(source, destination, chunk_size=4*1024*1024):
+    """
+    Copy source to destination as cheaply as the filesystem allows - a reflink if
+    possible, otherwise a copy of only the allocated regions so sparse files stay sparse.
+    Like clone_file() the copy is renamed over destination, which may be source itself.
+    """
+    if clone_file(source, destination):
+        return
+    temp_path = _temp_path_for(destination)
+    try:
+        _copy_sparse(source, temp_path, chunk_size)
+        os.rename(temp_path, destination)
+    except:
+        _remove_quietly(temp_path)
+        raise
+
+
+def _copy_sparse(source, destination, chunk_size):
+    with open(source, 'rb') as src:
+        with open(destination, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            while offset < size:
+                try:
+                    data_start = os.lseek(src.fileno(), offset, os.SEEK_DATA)
+                    data_end = os.lseek(src.fileno(), data_start, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # Nothing but a hole from offset to the end
+                        break
+                    # No hole support on this filesystem - copy the remainder
+                    data_start, data_end = offset, size
+                src.seek(data_start)
+                dst.seek(data_start)
+                remaining = data_end - data_start
+                while remaining > 0:
+                    chunk = src.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+                offset = data_end
+            dst.truncate(size)
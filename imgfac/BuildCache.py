@@ -0,0 +1,180 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import time
+import json
+import hashlib
+import xml.etree.ElementTree as ElementTree
+from threading import Lock
+from .Singleton import Singleton
+from .NotificationCenter import NotificationCenter
+
+# Parameters that change how or for whom a build is run but not what it produces
+UNCACHED_PARAMETERS = ('callbacks', 'tenant', 'priority', 'deadline', 'build_cache')
+IN_FLIGHT_STATUSES = ('NEW', 'PENDING', 'BUILDING')
+
+
+def build_cache_key(template, parameters=None):
+    """
+    Work out the key identifying the result of building template with parameters.
+
+    The template XML is canonicalized so that formatting, attribute order and
+    whitespace between elements do not matter.  For an ISO install the size and
+    modification time of a local ISO are included so a replaced ISO is not mistaken
+    for the old one.  A change to the content behind an install tree URL cannot be
+    detected here - only the cache TTL bounds how long such a result is reused.
+
+    @param template Template XML or a Template object
+    @param parameters The build parameters
+
+    @return A hex digest, or None if the template is not XML we can key on
+    """
+    xml = getattr(template, 'xml', template)
+    if not isinstance(xml, str):
+        return None
+    try:
+        canonical = ElementTree.canonicalize(xml, strip_text=True)
+        root = ElementTree.fromstring(canonical)
+    except ElementTree.ParseError:
+        return None
+    install = { }
+    install_element = root.find('./os/install')
+    if install_element is not None:
+        install['type'] = install_element.get('type')
+        install['location'] = (install_element.findtext(install_element.get('type') or 'url') or '').strip()
+        if (install['type'] == 'iso') and os.path.isfile(install['location']):
+            st = os.stat(install['location'])
+            install['size'] = st.st_size
+            install['mtime'] = st.st_mtime
+    relevant = dict([ (key, value) for key, value in (parameters or { }).items() if key not in UNCACHED_PARAMETERS ])
+    sha = hashlib.sha256()
+    sha.update(canonical.encode('utf-8'))
+    sha.update(json.dumps(install, sort_keys=True).encode('utf-8'))
+    sha.update(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class BuildCache(Singleton):
+    """
+    Lets identical BaseImage builds share a single Oz install.
+
+    Every cached BaseImage carries the key of the template and parameters it was built
+    from in its cache_key metadata.  A new build with the same key reuses a COMPLETE
+    image whose body is younger than the TTL, or follows one that is still being built.
+    Looking up and registering happen under one lock, so of several identical requests
+    arriving together only the first starts an install.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self._lock = Lock()
+        # Images dropped from the cache while still being built.  Their builder would write
+        # the old cache_key back, so it is cleared once they reach a final status.
+        self._dropped = set()
+        self._dropped_lock = Lock()
+        self._observing = False
+
+    def find(self, pim, key, ttl=0):
+        """
+        @param pim The PersistentImageManager to search
+        @param key A key from build_cache_key()
+        @param ttl Seconds a COMPLETE image stays reusable, 0 for no limit
+
+        @return The identifier of the image to reuse - the newest COMPLETE one if any,
+                otherwise one still being built - or None
+        """
+        complete = None
+        in_flight = None
+        with self._dropped_lock:
+            dropped = set(self._dropped)
+        for metadata in pim.metadata_from_query({'cache_key': key}, fields=['status', 'data']):
+            if metadata['identifier'] in dropped:
+                continue
+            if metadata.get('status') == 'COMPLETE':
+                try:
+                    mtime = os.stat(metadata.get('data')).st_mtime
+                except (OSError, TypeError):
+                    # Body removed behind our back - nothing to reuse
+                    continue
+                if ttl and (mtime < (time.time() - ttl)):
+                    continue
+                if (not complete) or (mtime > complete[0]):
+                    complete = (mtime, metadata['identifier'])
+            elif (metadata.get('status') in IN_FLIGHT_STATUSES) and (not in_flight):
+                in_flight = metadata['identifier']
+        return complete[1] if complete else in_flight
+
+    def register(self, pim, key, image, ttl=0):
+        """
+        Add image to pim as a build for key, unless an existing image can be reused.
+
+        @return The identifier of the image to reuse, or None if image has to be built
+        """
+        with self._lock:
+            source_id = self.find(pim, key, ttl)
+            image.cache_key = key
+            pim.add_image(image)
+        if source_id:
+            self.log.debug("Image (%s) reuses the build of (%s) for cache key (%s)" % (image.identifier, source_id, key))
+        return source_id
+
+    def invalidate(self, pim, image_id=None):
+        """
+        Stop images being reused by later builds.  The images themselves are kept.
+
+        @param image_id The image to drop from the cache, or None for all of them
+
+        @return The identifiers of the images dropped
+        """
+        with self._lock:
+            if image_id:
+                images = [ image for image in [ pim.image_with_id(image_id) ] if image and getattr(image, 'cache_key', None) ]
+            else:
+                images = [ pim.image_with_id(metadata['identifier']) for metadata in pim.metadata_from_query({ }, fields=['cache_key'])
+                           if metadata.get('cache_key') ]
+            dropped = [ ]
+            for image in images:
+                if not image:
+                    continue
+                if image.status in IN_FLIGHT_STATUSES:
+                    self._drop_when_final(image.identifier)
+                else:
+                    image.cache_key = None
+                    pim.save_image(image)
+                dropped.append(image.identifier)
+        self.log.info("Dropped %d images from the build cache" % (len(dropped)))
+        return dropped
+
+    def _drop_when_final(self, image_id):
+        with self._dropped_lock:
+            self._dropped.add(image_id)
+            if not self._observing:
+                NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
+                self._observing = True
+
+    def handle_state_change(self, notification):
+        image = notification.sender
+        if notification.user_info['new_status'] in IN_FLIGHT_STATUSES:
+            return
+        with self._dropped_lock:
+            if image.identifier not in self._dropped:
+                return
+            self._dropped.discard(image.identifier)
+        # The status is posted before the builder saves the image, which then stores this
+        image.cache_key = None
@@ -13,55 +13,376 @@
 #   limitations under the License.
 
 import logging
+import os.path
+import json
+import hashlib
+import time
 from imgfac.Singleton import Singleton
 from .Builder import Builder
+from .RemoteBuilder import RemoteBuilder
+from .Template import Template
 from imgfac.NotificationCenter import NotificationCenter
-from threading import BoundedSemaphore
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.PersistentImageManager import PersistentImageManager
+from imgfac.JobScheduler import JobScheduler
+from imgfac.PushFanout import PushFanout
+from imgfac.BuildPlan import BuildPlan
+from imgfac.FarmCoordinator import FarmCoordinator
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.BuildCache import UNCACHED_PARAMETERS
+from imgfac.BlobStore import copy_file
+from imgfac.CallbackWorker import CallbackWorker
+from imgfac.FactoryUtils import parameter_cast_to_bool
+from imgfac.Notification import Notification
+from threading import BoundedSemaphore, Lock, Thread
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+# Metadata an alias takes over from the image it shares once that image is complete
+UNSHARED_METADATA = ('identifier', 'data', 'parameters', 'status', 'status_detail', 'percent_complete', 'alias_of')
 
 class BuildDispatcher(Singleton):
+    """
+    Starts a Builder for each image requested and keeps it until the image is done.
+
+    With single_flight enabled a TargetImage or ProviderImage request with the same
+    inputs as one still in progress does not start a second Builder.  The caller
+    gets the in-flight image, or with single_flight_aliases an alias image of its own
+    that follows the in-flight one and takes over its result when it completes.
+    Either way callbacks given with the later request see the shared build.
+
+    As the coordinator of a build farm, each stage goes to the worker the
+    FarmCoordinator places it on, through a RemoteBuilder.  Only stages no live
+    worker can run are built here.
+    """
 
     def _singleton_init(self):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.builders = dict()
         self.builders_lock = BoundedSemaphore()
+        # Single flight - key of the stage inputs to the builder running them, the
+        # reverse mapping from image ID, and the requests following each image
+        self.in_flight = dict()
+        self.flight_keys = dict()
+        self.followers = dict()
+        # Held while looking up and starting single flight builds so that of two
+        # identical requests arriving together one always finds the other
+        self.flights_lock = Lock()
+        app_config = ApplicationConfiguration().configuration
+        self.single_flight = app_config.get('single_flight', False)
+        self.single_flight_aliases = app_config.get('single_flight_aliases', False)
+        self.push_parallelism = app_config.get('push_parallelism', 4)
+        # Build plans by ID - finished ones are kept for build_plan_retention seconds
+        self.plans = dict()
+        self.build_plan_retention = app_config.get('build_plan_retention', 86400)
+        # Every build stage runs on this scheduler's bounded worker pools
+        self.scheduler = JobScheduler()
+        self.scheduler.configure(pool_sizes=app_config.get('job_pool_sizes'),
+                                 aging_interval=app_config.get('job_aging_interval'))
+        self.farm = FarmCoordinator() if (app_config.get('farm_role') == 'coordinator') else None
         NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
 
     def handle_state_change(self, notification):
+        image = notification.sender
         status = notification.user_info['new_status']
-        if(status in ('COMPLETED', 'FAILED', 'DELETED', 'DELETEFAILED')):
-            self.builders_lock.acquire()
-            image_id = notification.sender.identifier
-            if(image_id in self.builders):
-                del self.builders[image_id]
-                self.log.debug('Removed builder from BuildDispatcher on notification from image %s: %s' % (image_id, status))
+        final = status in FINAL_STATUSES
+        self.builders_lock.acquire()
+        try:
+            followers = list(self.followers.get(image.identifier, [ ]))
+            if final:
+                if(image.identifier in self.builders):
+                    del self.builders[image.identifier]
+                    self.log.debug('Removed builder from BuildDispatcher on notification from image %s: %s' % (image.identifier, status))
+                key = self.flight_keys.pop(image.identifier, None)
+                if key:
+                    self.in_flight.pop(key, None)
+                self.followers.pop(image.identifier, None)
+        finally:
             self.builders_lock.release()
+        # Outside the lock - updating an alias posts notifications of its own
+        for follower in followers:
+            self._update_follower(image, follower, notification, final)
 
-    def builder_for_base_image(self, template, parameters=None):
-        builder = Builder()
-        builder.build_image_from_template(template, parameters=parameters)
+    def _flight_key(self, stage, inputs, parameters):
+        relevant = dict([ (key, value) for key, value in (parameters or { }).items() if key not in UNCACHED_PARAMETERS ])
+        # Only the digest is kept so credentials among the inputs are never stored
+        return hashlib.sha256(json.dumps([ stage, inputs, relevant ], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _single_flight_key(self, stage, image_id, template, parameters, inputs):
+        # Builds from a template start a whole chain of images and are left to the build cache
+        if (not self.single_flight) or (not image_id) or template:
+            return None
+        if parameters and (parameter_cast_to_bool(parameters.get('single_flight', True)) is False):
+            return None
+        return self._flight_key(stage, [ image_id ] + inputs, parameters)
+
+    def _follow(self, key, image_attr, parameters):
+        # Caller holds self.flights_lock
         self.builders_lock.acquire()
         try:
-            self.builders[builder.base_image.identifier] = builder
+            builder = self.in_flight.get(key)
         finally:
             self.builders_lock.release()
-        return builder
+        if not builder:
+            return None
+        primary = getattr(builder, image_attr)
+        callbacks = parameters.get('callbacks', [ ]) if parameters else [ ]
+        follower = {'alias': None, 'builder': None, 'workers': [ ]}
+        if self.single_flight_aliases:
+            alias_builder = Builder()
+            alias = type(primary)()
+            for attr in ('template', 'target', 'base_image_id', 'provider', 'target_image_id'):
+                if hasattr(primary, attr):
+                    setattr(alias, attr, getattr(primary, attr))
+            alias.parameters = parameters if parameters else { }
+            alias.alias_of = primary.identifier
+            setattr(alias_builder, image_attr, alias)
+            alias_builder.pim.add_image(alias)
+            # The alias reports on itself, so its callbacks observe it like any other image
+            alias_builder._init_callback_workers(alias, callbacks, follower['workers'])
+            alias.status_detail = {'activity': 'Waiting for identical image (%s)' % (primary.identifier), 'error': None}
+            alias.status = 'PENDING'
+            alias_builder.pim.save_image(alias)
+            follower.update({'alias': alias, 'builder': alias_builder})
+            result = alias_builder
+        else:
+            # Handed the shared image's notifications from handle_state_change
+            for callback_url in callbacks:
+                worker = CallbackWorker(callback_url)
+                worker.start()
+                follower['workers'].append(worker)
+            result = builder
+        self.builders_lock.acquire()
+        try:
+            joined = self.in_flight.get(key) is builder
+            if joined:
+                self.followers.setdefault(primary.identifier, [ ]).append(follower)
+                if follower['alias']:
+                    self.builders[follower['alias'].identifier] = result
+        finally:
+            self.builders_lock.release()
+        if not joined:
+            # Finished while we were setting up - pass on the final status ourselves
+            notification = Notification('image.status', primary, dict(old_status=None, new_status=primary.status))
+            self._update_follower(primary, follower, notification, True)
+        self.log.debug('Request with stage inputs (%s) joined build of image (%s)' % (key, primary.identifier))
+        return result
+
+    def _update_follower(self, image, follower, notification, final):
+        alias = follower['alias']
+        if not alias:
+            for worker in follower['workers']:
+                worker.status_notifier(notification)
+                if final:
+                    worker.shut_down()
+        elif final:
+            # Copying the body can take a while - not something to do during a notification
+            Thread(target=self._settle_alias, args=(image, follower), name='alias-%s' % (alias.identifier[0:8])).start()
+        else:
+            alias.status_detail = image.status_detail
+            alias.status = image.status
+            follower['builder'].pim.save_image(alias)
+
+    def _settle_alias(self, image, follower):
+        alias = follower['alias']
+        pim = follower['builder'].pim
+        try:
+            if image.status == 'COMPLETE':
+                for key in image.metadata().difference(UNSHARED_METADATA):
+                    setattr(alias, key, getattr(image, key, None))
+                if image.data and os.path.isfile(image.data) and (os.path.getsize(image.data) > 0):
+                    copy_file(image.data, alias.data)
+            alias.status_detail = image.status_detail
+            alias.status = image.status
+        except Exception as e:
+            alias.status_detail = {'activity': 'Taking over the result of image (%s) failed with exception.' % (image.identifier),
+                                   'error': str(e)}
+            alias.status = 'FAILED'
+            self.log.exception(e)
+        finally:
+            pim.save_image(alias)
+            follower['builder']._shutdown_callback_workers(alias, follower['workers'])
 
-    def builder_for_target_image(self, target, image_id=None, template=None, parameters=None):
-        builder = Builder()
-        builder.customize_image_for_target(target, image_id, template, parameters)
+    def _start_flight(self, key, builder, image):
+        # Caller holds self.flights_lock and self.builders_lock
+        if key and (image.status not in FINAL_STATUSES):
+            self.in_flight[key] = builder
+            self.flight_keys[image.identifier] = key
+
+    def cancel_build(self, image_id, reason='Cancelled by request'):
+        """
+        Cancel the build of image_id through the Builder that owns it - see Builder.cancel.
+        An alias created by single_flight_aliases stops following its shared image, which
+        carries on for the other requests.
+
+        @return False if no build of the image is in progress in this process
+        """
+        follower = None
         self.builders_lock.acquire()
         try:
-            self.builders[builder.target_image.identifier] = builder
+            builder = self.builders.get(image_id)
+            for followers in self.followers.values():
+                for candidate in followers:
+                    if candidate['alias'] and (candidate['alias'].identifier == image_id):
+                        follower = candidate
+                        followers.remove(candidate)
+                        break
         finally:
             self.builders_lock.release()
+        if follower:
+            alias = follower['alias']
+            alias.status_detail = {'activity': 'Build cancelled', 'error': reason}
+            alias.status = 'FAILED'
+            follower['builder'].pim.save_image(alias)
+            follower['builder']._shutdown_callback_workers(alias, follower['workers'])
+            return True
+        if not builder:
+            return False
+        return builder.cancel(reason)
+
+    def _builder(self, stage, template=None, target=None, image_id=None, my_image_id=None):
+        # A RemoteBuilder for the worker of the build farm placed to run stage, else a Builder
+        if (not self.farm) or my_image_id:
+            return Builder()
+        input_image = self.farm.pim.image_with_id(image_id) if image_id else None
+        if input_image:
+            template = template if template else input_image.template
+        if not template:
+            # Left for the Builder to report
+            return Builder()
+        template = template if isinstance(template, Template) else Template(template)
+        worker_id = self.farm.place(stage, (template.os_name, template.os_version, template.os_arch), target, input_image)
+        return RemoteBuilder(self.farm, worker_id) if worker_id else Builder()
+
+    def builder_for_base_image(self, template, parameters=None, my_image_id=None):
+        builder = self._builder('base', template=template, my_image_id=my_image_id)
+        builder.build_image_from_template(template, parameters=parameters, my_image_id=my_image_id)
+        self.builders_lock.acquire()
+        try:
+            self.builders[builder.base_image.identifier] = builder
+        finally:
+            self.builders_lock.release()
+        return builder
+
+    def builder_for_target_image(self, target, image_id=None, template=None, parameters=None, my_image_id=None):
+        # A worker of a build farm is told which image to create - never share it
+        key = None if my_image_id else self._single_flight_key('target', image_id, template, parameters, [ target ])
+        with self.flights_lock:
+            if key:
+                follower = self._follow(key, 'target_image', parameters)
+                if follower:
+                    return follower
+            builder = self._builder('target', template, target, image_id, my_image_id)
+            builder.customize_image_for_target(target, image_id, template, parameters, my_image_id)
+            self.builders_lock.acquire()
+            try:
+                self.builders[builder.target_image.identifier] = builder
+                self._start_flight(key, builder, builder.target_image)
+            finally:
+                self.builders_lock.release()
         return builder
 
     def builder_for_provider_image(self, provider, credentials, target, image_id=None, template=None, parameters=None, my_image_id=None):
-        builder = Builder()
-        builder.create_image_on_provider(provider, credentials, target, image_id, template, parameters, my_image_id)
+        # A secondary factory or worker of a build farm is told which image to create - never share it
+        key = None if my_image_id else self._single_flight_key('provider', image_id, template, parameters,
+                                                                [ provider, credentials, target ])
+        with self.flights_lock:
+            if key:
+                follower = self._follow(key, 'provider_image', parameters)
+                if follower:
+                    return follower
+            # Built from a template it takes a target stage first, on the same worker
+            stage = 'target' if (template and not (parameters and parameters.get('snapshot', False))) else 'provider'
+            builder = self._builder(stage, template, target, image_id, my_image_id)
+            builder.create_image_on_provider(provider, credentials, target, image_id, template, parameters, my_image_id)
+            self.builders_lock.acquire()
+            try:
+                self.builders[builder.provider_image.identifier] = builder
+                self._start_flight(key, builder, builder.provider_image)
+            finally:
+                self.builders_lock.release()
+        return builder
+
+    def builders_for_provider_images(self, providers, credentials, target, image_id, parameters=None):
+        """
+        Push the TargetImage image_id to each of providers, running at most
+        push_parallelism (from parameters or the configuration) pushes at once.
+
+        @return A list of Builders, one per provider, in the order of providers
+        """
+        if not providers:
+            raise ImageFactoryException("Asked to push to a list of providers without any providers")
+        if not image_id:
+            raise ImageFactoryException("Pushing to several providers requires an existing TargetImage")
+        if parameters and parameter_cast_to_bool(parameters.get('snapshot', False)):
+            raise ImageFactoryException("Snapshot builds cannot be pushed to several providers at once")
+        try:
+            parallelism = int(parameters.get('push_parallelism', self.push_parallelism) if parameters else self.push_parallelism)
+        except (TypeError, ValueError):
+            raise ImageFactoryException("push_parallelism must be an integer")
+        fanout = PushFanout(parallelism)
+        builders = [ ]
+        for provider in providers:
+            builder = self._builder('provider', target=target, image_id=image_id)
+            if isinstance(builder, RemoteBuilder):
+                # Pushes on workers are limited by the workers' own pools
+                builder.create_image_on_provider(provider, credentials, target, image_id, None, parameters)
+            else:
+                builder.push_image_to_provider(provider, credentials, target, image_id, None, parameters, None, fanout=fanout)
+            self.builders_lock.acquire()
+            try:
+                self.builders[builder.provider_image.identifier] = builder
+            finally:
+                self.builders_lock.release()
+            builders.append(builder)
+        return builders
+
+    def start_build_plan(self, template=None, targets=None, parameters=None, base_image_id=None):
+        """
+        Start a BuildPlan - see BuildPlan for the arguments.
+
+        @return The started BuildPlan
+        """
+        plan = BuildPlan(template=template, targets=targets, parameters=parameters, base_image_id=base_image_id, dispatcher=self)
+        plan.start()
+        self.builders_lock.acquire()
+        try:
+            expired = time.time() - self.build_plan_retention
+            for plan_id in [ plan_id for plan_id, old_plan in self.plans.items() if old_plan.finished_at and (old_plan.finished_at < expired) ]:
+                del self.plans[plan_id]
+            self.plans[plan.identifier] = plan
+        finally:
+            self.builders_lock.release()
+        return plan
+
+    def build_plan_with_id(self, plan_id):
+        self.builders_lock.acquire()
+        try:
+            return self.plans.get(plan_id)
+        finally:
+            self.builders_lock.release()
+
+    def builder_for_interrupted_image(self, image):
+        """
+        Carry on with the build of a BaseImage or TargetImage that a restart of the
+        factory interrupted, or carry on following an image being built on a worker of
+        the build farm.
+        """
+        if image.farm_node:
+            if not self.farm:
+                raise ImageFactoryException("Image was being built on worker (%s) of a build farm this factory no longer coordinates" % (image.farm_node))
+            builder = RemoteBuilder(self.farm, image.farm_node)
+            builder.follow_image(image)
+        elif type(image).__name__ == 'BaseImage':
+            builder = Builder()
+            builder.resume_base_image(image)
+        elif type(image).__name__ == 'TargetImage':
+            builder = Builder()
+            builder.resume_target_image(image)
+        else:
+            raise ImageFactoryException("Builds of %s cannot be resumed" % (type(image).__name__))
         self.builders_lock.acquire()
         try:
-            self.builders[builder.provider_image.identifier] = builder
+            self.builders[image.identifier] = builder
         finally:
             self.builders_lock.release()
         return builder
@@ -0,0 +1,201 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import uuid
+import time
+from threading import Lock, Thread
+from .NotificationCenter import NotificationCenter
+from .PersistentImageManager import PersistentImageManager
+from .ImageFactoryException import ImageFactoryException
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+# A node that has not been started yet, or never will be because an input failed
+WAITING = 'WAITING'
+SKIPPED = 'SKIPPED'
+
+
+class BuildPlanNode(object):
+    """
+    One image of a BuildPlan - the BaseImage, a TargetImage or a ProviderImage.
+    """
+
+    def __init__(self, stage, parent=None, target=None, provider=None, credentials=None, parameters=None, image_id=None):
+        self.identifier = str(uuid.uuid4())
+        self.stage = stage
+        self.parent = parent
+        self.children = [ ]
+        self.target = target
+        self.provider = provider
+        self.credentials = credentials
+        self.parameters = parameters
+        self.image_id = image_id
+        self.status = WAITING
+        self.error = None
+        self.finished = False
+        if parent:
+            parent.children.append(self)
+
+    def as_dict(self):
+        # Credentials are never reported
+        return {'id': self.identifier, 'stage': self.stage, 'image_id': self.image_id, 'status': self.status,
+                'error': self.error, 'depends_on': self.parent.identifier if self.parent else None,
+                'target': self.target, 'provider': self.provider}
+
+
+class BuildPlan(object):
+    """
+    Builds one template for several targets and pushes each TargetImage to several
+    providers, as a tree of stages.
+
+    Each node is started as soon as the image it depends on is COMPLETE, so independent
+    branches run concurrently and no thread sits waiting for an earlier stage.  Progress
+    is followed through 'image.status' notifications.  When an image fails, everything
+    depending on it is SKIPPED and the rest of the plan carries on.
+    """
+
+    def __init__(self, template=None, targets=None, parameters=None, base_image_id=None, dispatcher=None):
+        """
+        @param template Template to build the BaseImage from
+        @param targets List of dicts with 'target', optional 'parameters' and an
+                       optional list of 'providers', each a dict with 'provider',
+                       'credentials' and optional 'parameters'
+        @param parameters Parameters for the BaseImage build
+        @param base_image_id An existing COMPLETE BaseImage to use instead of a template
+        @param dispatcher The BuildDispatcher to start builds with
+        """
+        if bool(template) == bool(base_image_id):
+            raise ImageFactoryException("A build plan needs either a template or a BaseImage ID, not both")
+        if not targets:
+            raise ImageFactoryException("A build plan needs at least one target")
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.identifier = str(uuid.uuid4())
+        self.template = template
+        self.dispatcher = dispatcher
+        self.lock = Lock()
+        self.finished_at = None
+        self.root = BuildPlanNode('base', parameters=parameters, image_id=base_image_id)
+        self.nodes = [ self.root ]
+        for target in targets:
+            if not target.get('target'):
+                raise ImageFactoryException("Every target of a build plan needs a 'target' value")
+            target_node = BuildPlanNode('target', self.root, target=target['target'], parameters=target.get('parameters'))
+            self.nodes.append(target_node)
+            for provider in target.get('providers', [ ]):
+                if not (provider.get('provider') and provider.get('credentials')):
+                    raise ImageFactoryException("Every provider of a build plan needs 'provider' and 'credentials' values")
+                self.nodes.append(BuildPlanNode('provider', target_node, target=target['target'], provider=provider['provider'],
+                                                credentials=provider['credentials'], parameters=provider.get('parameters')))
+        self._nodes_by_image = { }
+
+    @property
+    def status(self):
+        statuses = [ node.status for node in self.nodes ]
+        if not all([ (status in FINAL_STATUSES) or (status == SKIPPED) for status in statuses ]):
+            return 'BUILDING'
+        return 'COMPLETE' if all([ status == 'COMPLETE' for status in statuses ]) else 'FAILED'
+
+    def as_dict(self):
+        with self.lock:
+            return {'id': self.identifier, 'status': self.status, 'nodes': [ node.as_dict() for node in self.nodes ]}
+
+    def start(self):
+        NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
+        if self.root.image_id:
+            # An existing BaseImage - go straight to the targets
+            image = PersistentImageManager.default_manager().image_with_id(self.root.image_id)
+            if (not image) or (image.status != 'COMPLETE'):
+                NotificationCenter().remove_observer(self, 'handle_state_change', 'image.status')
+                raise ImageFactoryException("BaseImage (%s) of the build plan is missing or not COMPLETE" % (self.root.image_id))
+            with self.lock:
+                self.root.status = 'COMPLETE'
+                self.root.finished = True
+                self._nodes_by_image[self.root.image_id] = self.root
+            self._start_children(self.root)
+        else:
+            self._start_node(self.root)
+
+    def _start_node(self, node):
+        try:
+            if node.stage == 'base':
+                image = self.dispatcher.builder_for_base_image(self.template, parameters=node.parameters).base_image
+            elif node.stage == 'target':
+                image = self.dispatcher.builder_for_target_image(node.target, image_id=node.parent.image_id,
+                                                                 parameters=node.parameters).target_image
+            else:
+                image = self.dispatcher.builder_for_provider_image(node.provider, node.credentials, node.target,
+                                                                   image_id=node.parent.image_id,
+                                                                   parameters=node.parameters).provider_image
+        except Exception as e:
+            self.log.exception(e)
+            self._node_finished(node, 'FAILED', str(e))
+            return
+        with self.lock:
+            node.image_id = image.identifier
+            node.status = image.status
+            self._nodes_by_image[image.identifier] = node
+        # The build may have finished before we knew its image ID
+        if image.status in FINAL_STATUSES:
+            self._node_finished(node, image.status, (image.status_detail or { }).get('error'))
+
+    def handle_state_change(self, notification):
+        image = notification.sender
+        status = notification.user_info['new_status']
+        with self.lock:
+            node = self._nodes_by_image.get(image.identifier)
+            if (not node) or node.finished:
+                return
+            node.status = status
+        if status in FINAL_STATUSES:
+            self._node_finished(node, status, (image.status_detail or { }).get('error'))
+
+    def _node_finished(self, node, status, error=None):
+        with self.lock:
+            # Only the first report of a final status counts
+            if node.finished:
+                return
+            node.finished = True
+            node.status = status
+            node.error = error
+        if status == 'COMPLETE':
+            # Starting builds posts notifications of its own - not something to do while
+            # the notification that got us here is still being delivered
+            Thread(target=self._start_children, args=(node, ), name='plan-%s' % (self.identifier[0:8])).start()
+        else:
+            self._skip(node)
+            self._check_finished()
+
+    def _start_children(self, node):
+        for child in node.children:
+            self._start_node(child)
+        self._check_finished()
+
+    def _skip(self, node):
+        with self.lock:
+            pending = list(node.children)
+            while pending:
+                child = pending.pop()
+                child.status = SKIPPED
+                child.finished = True
+                pending.extend(child.children)
+
+    def _check_finished(self):
+        with self.lock:
+            if self.finished_at or (self.status == 'BUILDING'):
+                return
+            self.finished_at = time.time()
+        NotificationCenter().remove_observer(self, 'handle_state_change', 'image.status')
+        self.log.info("Build plan (%s) finished with status %s" % (self.identifier, self.status))
@@ -0,0 +1,116 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os.path
+from .ApplicationConfiguration import ApplicationConfiguration
+from .PersistentImageManager import PersistentImageManager
+
+# Only a running builder moves an image out of these
+INTERRUPTED_STATUSES = ('NEW', 'PENDING', 'BUILDING', 'DELETING')
+# Resumed in this order so that targets find their base images already queued
+RESUME_ORDER = ('BaseImage', 'TargetImage', 'ProviderImage')
+
+
+class BuildRecovery(object):
+    """
+    Deals with the images a previous run of the factory left unfinished.
+
+    A BaseImage whose ICICLE was generated only lacked its final status and is marked
+    COMPLETE.  Other BaseImages and TargetImages are built again, with the OS plugin
+    skipping the stages recorded in the image's checkpoints.  ProviderImages cannot be
+    resumed as credentials are never stored - they are marked FAILED, naming the
+    checkpoints reached so a new push can carry on with resume_from.  Interrupted
+    deletions are marked DELETEFAILED.  With resume disabled everything is marked FAILED.
+    Images being built on a worker of a build farm were not interrupted at all - the
+    coordinator simply follows them again.
+
+    Must only run while no other factory process builds images in the same storage.
+    """
+
+    def __init__(self, pim, dispatcher=None, resume=True):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.pim = pim
+        self.dispatcher = dispatcher
+        self.resume = resume
+
+    @classmethod
+    def from_configuration(cls, dispatcher):
+        app_config = ApplicationConfiguration().configuration
+        return cls(PersistentImageManager.default_manager(), dispatcher,
+                   resume=app_config.get('resume_interrupted_builds', True))
+
+    def recover(self):
+        """
+        @return A dict of the identifiers of the images completed, resumed and failed
+        """
+        report = {'completed': [ ], 'resumed': [ ], 'failed': [ ]}
+        # Collected first - we are about to change the statuses we query on
+        image_ids = [ ]
+        for status in INTERRUPTED_STATUSES:
+            image_ids.extend([ (RESUME_ORDER.index(metadata['type']) if metadata['type'] in RESUME_ORDER else len(RESUME_ORDER),
+                                metadata['identifier'])
+                               for metadata in self.pim.metadata_from_query({'status': status}, fields=['status']) ])
+        for order, image_id in sorted(image_ids):
+            image = self.pim.image_with_id(image_id)
+            if (not image) or (image.status not in INTERRUPTED_STATUSES):
+                continue
+            try:
+                self._recover_image(image, report)
+            except Exception as e:
+                self.log.exception(e)
+                self._fail(image, "Unable to resume the build after a restart of the factory: %s" % (e), report)
+        self.log.info("Recovered interrupted builds - %d completed, %d resumed, %d failed" %
+                      (len(report['completed']), len(report['resumed']), len(report['failed'])))
+        return report
+
+    def _recover_image(self, image, report):
+        image_type = type(image).__name__
+        checkpoints = image.checkpoints if image.checkpoints else { }
+        if image.status == 'DELETING':
+            self._fail(image, "Deletion was interrupted by a restart of the factory - delete the image again", report,
+                       status='DELETEFAILED')
+        elif (image_type == 'BaseImage') and ('icicle_done' in checkpoints) and self._has_body(image):
+            image.status_detail = {'activity': 'Base Image build complete', 'error': None}
+            image.status = 'COMPLETE'
+            self.pim.save_image(image)
+            report['completed'].append(image.identifier)
+        elif image.farm_node:
+            self.log.info("Following build of %s (%s) on worker (%s) again" % (image_type, image.identifier, image.farm_node))
+            self.dispatcher.builder_for_interrupted_image(image)
+            report['resumed'].append(image.identifier)
+        elif not self.resume:
+            self._fail(image, "Build was interrupted by a restart of the factory", report)
+        elif image_type in ('BaseImage', 'TargetImage') and image.template:
+            self.log.info("Resuming build of %s (%s) from checkpoints %s" % (image_type, image.identifier, sorted(checkpoints.keys())))
+            self.dispatcher.builder_for_interrupted_image(image)
+            report['resumed'].append(image.identifier)
+        elif image_type == 'ProviderImage':
+            reached = ', '.join(sorted(checkpoints.keys())) if checkpoints else 'none'
+            self._fail(image, "Push was interrupted by a restart of the factory and cannot be resumed without credentials. "
+                              "Checkpoints reached: %s.  Push again with the parameter resume_from=%s to carry on from them."
+                              % (reached, image.identifier), report)
+        else:
+            self._fail(image, "Build was interrupted by a restart of the factory", report)
+
+    def _has_body(self, image):
+        return bool(image.data) and os.path.isfile(image.data) and (os.path.getsize(image.data) > 0)
+
+    def _fail(self, image, reason, report, status='FAILED'):
+        image.status_detail = {'activity': 'Interrupted by a restart of the factory', 'error': reason}
+        image.status = status
+        self.pim.save_image(image)
+        report['failed'].append(image.identifier)
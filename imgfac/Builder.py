@@ -16,6 +16,8 @@
 
 import uuid
 import logging
+import os.path
+import time
 import signal
 import sys
 from threading import Thread
@@ -30,7 +32,12 @@ from .TargetImage import TargetImage
 from .ProviderImage import ProviderImage
 from .ImageFactoryException import ImageFactoryException
 from .CallbackWorker import CallbackWorker
-from time import sleep
+from .ImageStatusWaiter import ImageStatusWaiter
+from .JobScheduler import JobScheduler
+from .BuildCache import BuildCache, build_cache_key
+from .BlobStore import copy_file
+from .FactoryUtils import parameter_cast_to_bool
+from .Cancellation import CancellationToken
 
 class Builder(object):
     """ TODO: Docstring for Builder  """
@@ -63,6 +70,10 @@ class Builder(object):
         self.target_thread = None
         self.push_thread = None
         self.snapshot_thread = None
+        # The PushFanout our push waits in for a slot, if it is one of several
+        self.fanout = None
+        # Checked by the stages and plugins of this builder - see cancel()
+        self.cancellation = CancellationToken()
         try:
             from imgfac.secondary.SecondaryDispatcher import SecondaryDispatcher
             from imgfac.secondary.SecondaryPlugin import SecondaryPlugin
@@ -92,42 +103,179 @@ class Builder(object):
         self.log.debug("Waiting for image of type (%s) and id (%s) to enter a final status" % (str(type(image)), image_id ) )
         # Wait forever - Short of a factory crash, we have timeouts elsewhere that should ensure
         #                that the pending images eventually hit success or failure
-        while(True):
-            # Our local image object isn't necessarily the one that is being actively updated
-            # In fact, we know it isn't.  It has been created out of a PIM retrieval.
-            # To update its metadata, we just re-fetch it.
-            image = self.pim.image_with_id(image_id)
-            if image.status not in [ 'NEW','PENDING' ]:
-                self.log.debug("Image of type (%s) entered final status of (%s)" % (str(type(image)), image.status) )
-                return image
-            sleep(5)
+        # Our local image object isn't necessarily the one that is being actively updated
+        # In fact, we know it isn't.  The waiter hands back the updated one.
+        image = ImageStatusWaiter().wait_for_final_status(image_id, self.pim,
+                                                          poll_interval=self.app_config.get('status_poll_interval', 1),
+                                                          max_poll_interval=self.app_config.get('status_poll_max_interval', 30),
+                                                          cancellation=self.cancellation)
+        self.log.debug("Image of type (%s) entered final status of (%s)" % (str(type(image)), image.status) )
+        return image
+
+#####  CHECKPOINTS
+    def checkpoint(self, image, name, **details):
+        """
+        Record that a stage of the build of image is done and save the image, so that a
+        build interrupted by a restart can carry on from here.
+
+        @param image The image being built
+        @param name Name of the stage, e.g. 'install_done' or 'snapshot_taken'
+        @param details Anything needed to carry on from this stage, e.g. a snapshot ID
+        """
+        checkpoints = dict(image.checkpoints if image.checkpoints else { })
+        details['time'] = time.time()
+        checkpoints[name] = details
+        image.checkpoints = checkpoints
+        self.pim.save_image(image)
+        self.log.debug("Image (%s) reached checkpoint (%s)" % (image.identifier, name))
+
+#####  CANCELLATION
+    def is_building(self):
+        """
+        @return True while any build stage started by this builder is queued or running
+        """
+        return any([ thread and thread.is_alive() for thread in
+                     (self.base_thread, self.target_thread, self.push_thread, self.snapshot_thread) ]) or \
+               bool(self.fanout and self.fanout.is_pending(self))
+
+    def abort(self):
+        """
+        Have the plugins in use destroy whatever they are running - local guests, EC2
+        instances - without touching the status of our images.  Used on shutdown, where
+        the interrupted builds are left for BuildRecovery to pick up.
+        """
+        if self.fanout:
+            # Pushes not given a slot yet stay PENDING rather than starting now
+            self.fanout.withdraw(self)
+        for plugin in (self.os_plugin, self.cloud_plugin):
+            if plugin and hasattr(plugin, 'abort'):
+                try:
+                    self.log.debug("Executing abort method for plugin (%s)" % (type(plugin).__name__))
+                    plugin.abort()
+                except Exception as e:
+                    self.log.warning("Got exception when attempting to abort plugin (%s)" % (type(plugin).__name__))
+                    self.log.exception(e)
+
+    def cancel(self, reason='Cancelled by request'):
+        """
+        Cancel the build of all images of this builder that are not finished yet.
+        Stages still waiting for a worker never start, running ones stop at the next
+        check of self.cancellation, and the plugins are aborted so nothing is left
+        running.  The images end up FAILED with the reason in their status_detail.
+
+        @return False if there was nothing left to cancel
+        """
+        unfinished = [ image for image in (self.base_image, self.target_image, self.provider_image)
+                       if image and (image.status in ('NEW', 'PENDING', 'BUILDING')) ]
+        if (not unfinished) or (not self.cancellation.cancel(reason)):
+            return False
+        self.log.info("Cancelling build of image(s) %s: %s" % ([ image.identifier for image in unfinished ], reason))
+        for job in (self.base_thread, self.target_thread, self.push_thread, self.snapshot_thread):
+            if JobScheduler().withdraw(job):
+                # Run outside the pool - it fails straight away on the cancelled token
+                # and leaves the image and callbacks as any other failed build does
+                Thread(target=job.run, name=job.name).start()
+        if self.fanout:
+            for kwargs in self.fanout.withdraw(self):
+                # Never given a slot - fails the same way on the cancelled token
+                Thread(target=self._push_image_to_provider, name=str(uuid.uuid4())[0:8], kwargs=kwargs).start()
+        self.abort()
+        return True
+
+    def _failure_detail(self, activity, exception):
+        if self.cancellation.cancelled:
+            return {'activity': 'Build cancelled', 'error': self.cancellation.reason}
+        return {'activity': activity, 'error': str(exception)}
+
+#####  JOB SCHEDULING
+    def _submit_job(self, stage, image, target, kwargs, parameters):
+        # Until a worker in the pool for this stage is free the image is PENDING
+        image.status = "PENDING"
+        self.pim.save_image(image)
+        return JobScheduler().submit(stage, target, kwargs, str(uuid.uuid4())[0:8], image=image, parameters=parameters)
 
 #####  BUILD IMAGE
-    def build_image_from_template(self, template, parameters=None):
+    def build_image_from_template(self, template, parameters=None, my_image_id=None):
         """
         TODO: Docstring for build_image_from_template
 
         @param template TODO 
+        @param my_image_id The ID to give the image - set when a build farm coordinator hands us the build
 
         @return TODO
         """
         # Create what is essentially an empty BaseImage here
-        self.base_image = BaseImage()
+        self.base_image = BaseImage(image_id=my_image_id)
         self.base_image.template = template
         if parameters:
             self.base_image.parameters = parameters
-        self.pim.add_image(self.base_image)
+        source_id = None
+        cache_key = self._build_cache_key(template, parameters)
+        if cache_key:
+            source_id = BuildCache().register(self.pim, cache_key, self.base_image,
+                                              ttl=self.app_config.get('base_image_cache_ttl', 0))
+        else:
+            self.pim.add_image(self.base_image)
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(self.base_image, parameters['callbacks'], self._base_image_cbws)
 
-        thread_name = str(uuid.uuid4())[0:8]
-        thread_kwargs = {'template':template, 'parameters':parameters}
-        self.base_thread = Thread(target=self._build_image_from_template, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.base_thread.start()
+        if source_id:
+            # Copying an existing body is cheap and waiting for an identical build must not
+            # hold a place in the base pool that the build itself may be queued for
+            self.base_image.status = "PENDING"
+            self.pim.save_image(self.base_image)
+            thread_kwargs = {'source_id':source_id, 'template':template, 'parameters':parameters}
+            self.base_thread = Thread(target=self._clone_base_image, name=str(uuid.uuid4())[0:8], kwargs=thread_kwargs)
+            self.base_thread.start()
+        else:
+            thread_kwargs = {'template':template, 'parameters':parameters}
+            self.base_thread = self._submit_job('base', self.base_image, self._build_image_from_template, thread_kwargs, parameters)
+
+    def _build_cache_key(self, template, parameters):
+        # None if this build should neither reuse nor be reused
+        if not self.app_config.get('base_image_cache', False):
+            return None
+        if parameters and (parameter_cast_to_bool(parameters.get('build_cache', True)) is False):
+            return None
+        return build_cache_key(template, parameters)
+
+    def _clone_base_image(self, source_id, template, parameters=None):
+        source = self.pim.image_with_id(source_id)
+        if source and (source.status != 'COMPLETE'):
+            self.base_image.status_detail = {'activity': 'Waiting for identical Base Image (%s) to be built' % (source_id), 'error': None}
+            self.pim.save_image(self.base_image)
+            source = self._wait_for_final_status(source)
+        if (not source) or (source.status != 'COMPLETE') or (not source.data) or (not os.path.isfile(source.data)):
+            self.log.info("Base Image (%s) cannot be reused - building image (%s) from its template" % (source_id, self.base_image.identifier))
+            thread_kwargs = {'template':template, 'parameters':parameters}
+            # Stay alive until the build is done for anyone joining base_thread
+            self._submit_job('base', self.base_image, self._build_image_from_template, thread_kwargs, parameters).join()
+            return
+        try:
+            self.cancellation.check()
+            self.base_image.status = "BUILDING"
+            self.base_image.status_detail = {'activity': 'Copying identical Base Image (%s)' % (source_id), 'error': None}
+            copy_file(source.data, self.base_image.data)
+            self.base_image.icicle = source.icicle
+            if source.parameters and ('libvirt_xml' in source.parameters):
+                self.base_image.parameters = dict(self.base_image.parameters if self.base_image.parameters else { })
+                self.base_image.parameters['libvirt_xml'] = source.parameters['libvirt_xml']
+            self.base_image.status_detail = {'activity': 'Base Image reused from (%s)' % (source_id), 'error': None}
+            self.base_image.status = "COMPLETE"
+            self.pim.save_image(self.base_image)
+        except Exception as e:
+            self.base_image.status_detail = self._failure_detail('Copying Base Image (%s) failed with exception.' % (source_id), e)
+            self.base_image.status = "FAILED"
+            self.pim.save_image(self.base_image)
+            self.log.error("Exception encountered in _clone_base_image thread")
+            self.log.exception(e)
+        finally:
+            self._shutdown_callback_workers(self.base_image, self._base_image_cbws)
 
     def _build_image_from_template(self, template, parameters=None):
         try:
+            self.cancellation.check()
             template = template if(isinstance(template, Template)) else Template(template)
             plugin_mgr = PluginManager(self.app_config['plugins'])
             self.os_plugin = plugin_mgr.plugin_for_target((template.os_name, template.os_version, template.os_arch))
@@ -139,7 +287,7 @@ class Builder(object):
             self.base_image.status="COMPLETE"
             self.pim.save_image(self.base_image)
         except Exception as e:
-            self.base_image.status_detail = {'activity': 'Base Image build failed with exception.', 'error': str(e)}
+            self.base_image.status_detail = self._failure_detail('Base Image build failed with exception.', e)
             self.base_image.status="FAILED"
             self.pim.save_image(self.base_image)
             self.log.error("Exception encountered in _build_image_from_template thread")
@@ -148,19 +296,49 @@ class Builder(object):
             # We only shut the workers down after a known-final state change
             self._shutdown_callback_workers(self.base_image, self._base_image_cbws)
 
+##### RESUME INTERRUPTED BUILDS
+    def resume_base_image(self, image):
+        """
+        Build again a BaseImage whose build was interrupted by a restart of the factory.
+        The OS plugin carries on from the checkpoints the image reached.
+
+        @param image The BaseImage as loaded from storage
+        """
+        self.base_image = image
+        if image.parameters and ('callbacks' in image.parameters):
+            self._init_callback_workers(self.base_image, image.parameters['callbacks'], self._base_image_cbws)
+        thread_kwargs = {'template':image.template, 'parameters':image.parameters}
+        self.base_thread = self._submit_job('base', self.base_image, self._build_image_from_template, thread_kwargs, image.parameters)
+
+    def resume_target_image(self, image):
+        """
+        Build again a TargetImage whose build was interrupted by a restart of the factory.
+
+        @param image The TargetImage as loaded from storage
+        """
+        self.base_image = self.pim.image_with_id(image.base_image_id)
+        if not self.base_image:
+            raise ImageFactoryException("Unable to retrieve base image with id (%s) from storage" % (image.base_image_id))
+        self.target_image = image
+        if image.parameters and ('callbacks' in image.parameters):
+            self._init_callback_workers(self.target_image, image.parameters['callbacks'], self._target_image_cbws)
+        thread_kwargs = {'target':image.target, 'image_id':image.base_image_id, 'template':image.template, 'parameters':image.parameters}
+        self.target_thread = self._submit_job('target', self.target_image, self._customize_image_for_target, thread_kwargs, image.parameters)
+
 ##### CUSTOMIZE IMAGE FOR TARGET
-    def customize_image_for_target(self, target, image_id=None, template=None, parameters=None):
+    def customize_image_for_target(self, target, image_id=None, template=None, parameters=None, my_image_id=None):
         """
         TODO: Docstring for customize_image_for_target
 
         @param factory_image TODO
         @param target TODO 
         @param target_params TODO
+        @param my_image_id The ID to give the image - set when a build farm coordinator hands us the build
 
         @return TODO
         """
 
-        self.target_image = TargetImage()
+        self.target_image = TargetImage(image_id=my_image_id)
         self.target_image.target = target
         self.target_image.base_image_id = image_id
         self.target_image.template = template
@@ -189,10 +367,8 @@ class Builder(object):
         # Both base_image and target_image exist at this point and have IDs and status
         # We can now launch our thread and return to the caller
         
-        thread_name = str(uuid.uuid4())[0:8]
         thread_kwargs = {'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.target_thread = Thread(target=self._customize_image_for_target, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.target_thread.start()
+        self.target_thread = self._submit_job('target', self.target_image, self._customize_image_for_target, thread_kwargs, parameters)
 
     def _customize_image_for_target(self, target, image_id=None, template=None, parameters=None):
         try:
@@ -205,10 +381,11 @@ class Builder(object):
                 self.log.debug("BaseImage builder thread (%s) finished - continuing with TargetImage tasks" % (threadname))
 
             # If we were called against an ongoing base_image build, wait for a terminal status on it
-            if self.base_image.status in [ "NEW", "PENDING" ]:
+            if self.base_image.status in [ "NEW", "PENDING", "BUILDING" ]:
                 self.target_image.status="PENDING"
                 self.base_image = self._wait_for_final_status(self.base_image)
 
+            self.cancellation.check()
             if self.base_image.status == "FAILED":
                 raise ImageFactoryException("The BaseImage (%s) for our TargetImage has failed its build.  Cannot continue." % (self.base_image.identifier))
 
@@ -246,7 +423,7 @@ class Builder(object):
             self.target_image.status = "COMPLETE"
             self.pim.save_image(self.target_image)
         except Exception as e:
-            self.target_image.status_detail={'activity': 'Target Image build failed with exception', 'error': str(e)}
+            self.target_image.status_detail = self._failure_detail('Target Image build failed with exception', e)
             self.target_image.status = "FAILED"
             self.pim.save_image(self.target_image)
             self.log.error("Exception encountered in _customize_image_for_target thread")
@@ -263,7 +440,7 @@ class Builder(object):
             self.push_image_to_provider(provider, credentials, target, image_id, template, parameters, my_image_id)
 
 ##### PUSH IMAGE TO PROVIDER
-    def push_image_to_provider(self, provider, credentials, target, image_id, template, parameters, my_image_id):
+    def push_image_to_provider(self, provider, credentials, target, image_id, template, parameters, my_image_id, fanout=None):
         """
         TODO: Docstring for push_image_to_provider
 
@@ -271,6 +448,7 @@ class Builder(object):
         @param provider TODO
         @param credentials TODO
         @param provider_params TODO 
+        @param fanout A PushFanout if this is one of several pushes of the same TargetImage
 
         @return TODO
         """
@@ -309,12 +487,27 @@ class Builder(object):
         else:
             raise ImageFactoryException("Asked to create a ProviderImage without a TargetImage or a template")
 
-        thread_name = str(uuid.uuid4())[0:8]
+        # Carry on from the checkpoints of an earlier, interrupted push of the same image
+        resume_from = parameters.get('resume_from') if parameters else None
+        if resume_from:
+            previous = self.pim.image_with_id(resume_from)
+            if (not previous) or (type(previous).__name__ != 'ProviderImage') or (previous.target_image_id != image_id) \
+                    or (previous.provider != provider):
+                raise ImageFactoryException("Cannot resume from (%s) - it is not a push of TargetImage (%s) to the same provider" % (resume_from, image_id))
+            self.provider_image.checkpoints = dict(previous.checkpoints if previous.checkpoints else { })
+
         thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.push_thread = Thread(target=self._push_image_to_provider, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.push_thread.start()
+        if fanout:
+            # Submitted to the provider pool by the fanout once it has a free slot
+            thread_kwargs['fanout'] = fanout
+            self.fanout = fanout
+            self.provider_image.status = "PENDING"
+            self.pim.save_image(self.provider_image)
+            fanout.enqueue(self, thread_kwargs, parameters)
+        else:
+            self.push_thread = self._submit_job('provider', self.provider_image, self._push_image_to_provider, thread_kwargs, parameters)
 
-    def _push_image_to_provider(self, provider, credentials, target, image_id, template, parameters):
+    def _push_image_to_provider(self, provider, credentials, target, image_id, template, parameters, fanout=None):
         try:
             # If there is an ongoing target_image build that we started, wait for it to finish
             if self.target_thread:
@@ -325,10 +518,11 @@ class Builder(object):
                 self.log.debug("TargetImage builder thread (%s) finished - continuing with ProviderImage tasks" % (threadname))
 
             # If we were called against an ongoing target_image build, wait for a terminal status on it
-            if self.target_image.status in [ "NEW", "PENDING" ]:
+            if self.target_image.status in [ "NEW", "PENDING", "BUILDING" ]:
                 self.provider_image.status = "PENDING"
                 self.target_image = self._wait_for_final_status(self.target_image) 
 
+            self.cancellation.check()
             if self.target_image.status == "FAILED":
                 raise ImageFactoryException("The TargetImage (%s) for our ProviderImage has failed its build.  Cannot continue." % (self.target_image.identifier))
 
@@ -354,13 +548,16 @@ class Builder(object):
                 plugin_mgr = PluginManager(self.app_config['plugins'])
                 if not self.cloud_plugin:
                     self.cloud_plugin = plugin_mgr.plugin_for_target(target)
+            if fanout:
+                fanout.prepare(self.cloud_plugin, self, target, parameters)
+            self.cancellation.check()
             self.provider_image.status="BUILDING"
             self.cloud_plugin.push_image_to_provider(self, provider, credentials, target, image_id, parameters)
             self.provider_image.status_detail = { 'activity': 'Provider Image build complete', 'error':None }
             self.provider_image.status="COMPLETE"
             self.pim.save_image(self.provider_image)
         except Exception as e:
-            self.provider_image.status_detail={'activity': 'Provider Image build failed with exception', 'error': str(e)}
+            self.provider_image.status_detail = self._failure_detail('Provider Image build failed with exception', e)
             self.provider_image.status="FAILED"
             self.pim.save_image(self.provider_image)
             self.log.error("Exception encountered in _push_image_to_provider thread")
@@ -397,13 +594,12 @@ class Builder(object):
         if not template:
             raise ImageFactoryException("Must specify a template when requesting a snapshot-style build")
 
-        thread_name = str(uuid.uuid4())[0:8]
         thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.snapshot_thread = Thread(target=self._snapshot_image, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.snapshot_thread.start()
+        self.snapshot_thread = self._submit_job('provider', self.provider_image, self._snapshot_image, thread_kwargs, parameters)
 
     def _snapshot_image(self, provider, credentials, target, image_id, template, parameters):
         try:
+            self.cancellation.check()
             if not self.app_config['secondary'] and self.secondary_dispatcher:
                 secondary = self.secondary_dispatcher.get_secondary(target, provider)
             else:
@@ -421,8 +617,7 @@ class Builder(object):
             self.provider_image.status="COMPLETE"
             self.pim.save_image(self.provider_image)
         except Exception as e:
-            self.provider_image.status_detail = {'activity': 'Provider Image build failed with exception',
-                                                 'error': str(e)}
+            self.provider_image.status_detail = self._failure_detail('Provider Image build failed with exception', e)
             self.provider_image.status="FAILED"
             self.pim.save_image(self.provider_image)
             self.log.error("Exception encountered in _snapshot_image thread")
@@ -432,7 +627,7 @@ class Builder(object):
             self._shutdown_callback_workers(self.provider_image, self._provider_image_cbws)
 
 ##### DELETE IMAGE
-    def delete_image(self, provider, credentials, target, image_object, parameters):
+    def delete_image(self, provider, credentials, target, image_object, parameters, wait_for_build=False):
         """
         Delete an image of any type - We only need plugin-specific methods to delete ProviderImages
         Both TargetImages and BaseImages can be deleted directly at the PersistentImageManager layer only.
@@ -442,23 +637,34 @@ class Builder(object):
         @param target - Target type if applicable - None if not
         @param image_object - Already-retrieved and populated PersistentImage object
         @param parameters TODO
+        @param wait_for_build True if the build of the image has been cancelled and must
+                              finish cleaning up before the image is deleted
 
         @return TODO
         """
-        if parameters and ('callbacks' in parameters):
+        if parameters and ('callbacks' in parameters) and (not wait_for_build):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(image_object, parameters['callbacks'], self._deletion_cbws)
 
         thread_name = str(uuid.uuid4())[0:8]
-        thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_object':image_object, 'parameters':parameters}
+        thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_object':image_object,
+                         'parameters':parameters, 'wait_for_build':wait_for_build}
         self.delete_thread = Thread(target=self._delete_image, name=thread_name, args=(), kwargs=thread_kwargs)
         self.delete_thread.start()
 
 
-    def _delete_image(self, provider, credentials, target, image_object, parameters):
+    def _delete_image(self, provider, credentials, target, image_object, parameters, wait_for_build=False):
         try:
+            if wait_for_build:
+                # The waiter hands back the image object the build updated
+                image_object = ImageStatusWaiter().wait_for_final_status(image_object.identifier, self.pim,
+                                                                         poll_interval=self.app_config.get('status_poll_interval', 1),
+                                                                         max_poll_interval=self.app_config.get('status_poll_max_interval', 30))
+                if parameters and ('callbacks' in parameters):
+                    self._init_callback_workers(image_object, parameters['callbacks'], self._deletion_cbws)
             image_object.status = "DELETING"
-            if type(image_object).__name__ == "ProviderImage":
+            # An alias only shares the provider side image of the push it joined
+            if (type(image_object).__name__ == "ProviderImage") and (not getattr(image_object, 'alias_of', None)):
                 self.provider_image = image_object
                 plugin_mgr = PluginManager(self.app_config['plugins'])
                 self.cloud_plugin = plugin_mgr.plugin_for_target(target)
@@ -482,12 +688,5 @@ class Builder(object):
             # Run the abort() method in any running target builder
             self.log.warn('caught signal SIGINT, stopping...')
 
-            if self.os_plugin:
-                try:
-                    self.log.debug("Executing abort method for builder")
-                    self.os_plugin.abort()
-                except Exception as e:
-                    self.log.warn("Got exception when attempting to abort build during shutdown")
-                    self.log.exception(e)
-
+            self.abort()
             sys.exit(0)
@@ -0,0 +1,210 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import json
+import time
+import heapq
+import itertools
+import httplib2
+from collections import defaultdict, deque
+from threading import Condition, Thread
+from urllib.parse import urlsplit
+from .Singleton import Singleton
+from .ApplicationConfiguration import ApplicationConfiguration
+
+# Worth trying again - the endpoint is unavailable rather than rejecting the update
+RETRY_STATUSES = (408, 429)
+# Latencies kept for the metrics
+LATENCY_WINDOW = 1000
+
+
+class CallbackDelivery(Singleton):
+    """
+    Sends the callback updates of all images over a bounded pool of threads.
+
+    Updates for one image to one URL are delivered in the order they were made.
+    An update still waiting when a newer one for the same image and URL comes in is
+    replaced by it, so a slow endpoint gets the latest state rather than a backlog.
+    Failed deliveries are retried with exponential backoff, and keep-alive
+    connections are reused for each host.
+    """
+
+    def _singleton_init(self, http_factory=None):
+        """
+        @param http_factory Called with no arguments for a new httplib2.Http like connection
+        """
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        app_config = ApplicationConfiguration().configuration
+        self.pool_size = app_config.get('callback_workers', 8)
+        self.max_attempts = app_config.get('callback_max_attempts', 5)
+        self.backoff = app_config.get('callback_backoff', 1)
+        self.max_backoff = app_config.get('callback_max_backoff', 60)
+        timeout = app_config.get('callback_timeout', 30)
+        self.http_factory = http_factory if http_factory else (lambda: httplib2.Http(timeout=timeout))
+        self.cond = Condition()
+        # (url, image ID) to the newest update not sent yet
+        self.pending = dict()
+        # Keys with an update to send now, oldest first, and (due time, sequence, key) of retries
+        self.ready = deque()
+        self.delayed = [ ]
+        self.sequence = itertools.count()
+        self.scheduled = set()
+        self.in_flight = set()
+        # (scheme, host) to idle connections
+        self.connections = defaultdict(list)
+        self.threads = [ ]
+        self.counts = {'delivered': 0, 'failed': 0, 'retried': 0, 'coalesced': 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def enqueue(self, url, image_id, body, headers=None):
+        """
+        Queue an update for delivery.
+
+        @param url The callback URL to PUT to
+        @param image_id The image the update is about
+        @param body Anything that can be sent as JSON
+        @param headers Headers to send with it
+        """
+        key = (url, image_id)
+        delivery = {'url': url, 'body': body, 'headers': headers if headers else { }, 'enqueued_at': time.time(), 'attempts': 0}
+        with self.cond:
+            previous = self.pending.get(key)
+            if previous:
+                # Superseded before it was sent - keep its place and any backoff it is in
+                self.counts['coalesced'] += 1
+                delivery['attempts'] = previous['attempts']
+            self.pending[key] = delivery
+            self._schedule(key)
+            self._start_threads()
+            self.cond.notify()
+
+    def _schedule(self, key):
+        # Caller holds self.cond.  An update in flight is followed up when it is done.
+        if (key not in self.scheduled) and (key not in self.in_flight):
+            self.ready.append(key)
+            self.scheduled.add(key)
+
+    def _start_threads(self):
+        # Caller holds self.cond
+        while len(self.threads) < self.pool_size:
+            thread = Thread(target=self._run, name='callback-%d' % (len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def wait(self, keys, timeout=None):
+        """
+        Block until the updates queued for keys, each a (url, image ID), are delivered
+        or given up on.
+
+        @return False if the timeout expired first
+        """
+        deadline = (time.time() + timeout) if (timeout is not None) else None
+        with self.cond:
+            while any([ (key in self.pending) or (key in self.in_flight) for key in keys ]):
+                remaining = (deadline - time.time()) if deadline else None
+                if (remaining is not None) and (remaining <= 0):
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _next(self):
+        # Caller holds self.cond - blocks until there is an update to send
+        while True:
+            now = time.time()
+            while self.delayed and (self.delayed[0][0] <= now):
+                self.ready.append(heapq.heappop(self.delayed)[2])
+            if self.ready:
+                key = self.ready.popleft()
+                self.scheduled.discard(key)
+                self.in_flight.add(key)
+                return key, self.pending.pop(key)
+            self.cond.wait((self.delayed[0][0] - now) if self.delayed else None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                key, delivery = self._next()
+            delivered, retry = self._send(delivery)
+            with self.cond:
+                self.in_flight.discard(key)
+                delivery['attempts'] += 1
+                if (not delivered) and retry and (delivery['attempts'] < self.max_attempts):
+                    self.counts['retried'] += 1
+                    # Anything newer goes out in its place, after the same backoff
+                    retried = self.pending.get(key, delivery)
+                    retried['attempts'] = delivery['attempts']
+                    self.pending[key] = retried
+                    delay = min(self.backoff * (2 ** (delivery['attempts'] - 1)), self.max_backoff)
+                    heapq.heappush(self.delayed, (time.time() + delay, next(self.sequence), key))
+                    self.scheduled.add(key)
+                else:
+                    if delivered:
+                        self.counts['delivered'] += 1
+                        self.latencies.append(time.time() - delivery['enqueued_at'])
+                    else:
+                        self.counts['failed'] += 1
+                        self.log.warning("Giving up on callback to (%s) after %d attempt(s)" % (delivery['url'], delivery['attempts']))
+                    if key in self.pending:
+                        self._schedule(key)
+                self.cond.notify_all()
+
+    def _send(self, delivery):
+        """
+        @return A tuple of whether the update was delivered and, if not, whether to try again
+        """
+        url = delivery['url']
+        if url == 'debug':
+            self.log.debug("Executing a debug callback - no actual PUT sent: (%s)" % (str(delivery['body'])))
+            return True, False
+        host = tuple(urlsplit(url)[0:2])
+        with self.cond:
+            connection = self.connections[host].pop() if self.connections[host] else None
+        if not connection:
+            connection = self.http_factory()
+        self.log.debug("PUTing update to URL (%s)" % (url))
+        try:
+            response, content = connection.request(url, "PUT", body=json.dumps(delivery['body']), headers=delivery['headers'])
+        except Exception as e:
+            # The connection may be broken - it is not reused
+            self.log.debug("Caught exception (%s) when attempting to PUT callback to (%s)" % (str(e), url))
+            return False, True
+        with self.cond:
+            if len(self.connections[host]) < self.pool_size:
+                self.connections[host].append(connection)
+        status = int(response.status)
+        if status < 300:
+            return True, False
+        self.log.debug("Callback to (%s) returned HTTP status %d" % (url, status))
+        return False, (status >= 500) or (status in RETRY_STATUSES)
+
+    def stats(self):
+        """
+        @return Delivery counts, queue lengths and the latency, in seconds from an
+                update being queued to its delivery, of recent deliveries
+        """
+        with self.cond:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counts, queued=len(self.pending), in_flight=len(self.in_flight), workers=len(self.threads))
+        latency = {'count': len(latencies)}
+        if latencies:
+            latency.update({'mean': sum(latencies) / len(latencies),
+                            'p50': latencies[int(len(latencies) * 0.5)],
+                            'p95': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+                            'max': latencies[-1]})
+        stats['latency'] = latency
+        return stats
@@ -0,0 +1,101 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+from threading import Event, Lock
+from .ImageFactoryException import ImageFactoryException
+
+
+class BuildCancelled(ImageFactoryException):
+    """
+    Raised inside a build once it has been cancelled.
+    """
+    pass
+
+
+class CancellationToken(object):
+    """
+    Lets a build be cancelled from another thread.
+
+    Cancellation is cooperative - the build calls check() between its steps and
+    sleeps with sleep() so it notices promptly.  Work that blocks for a long time
+    without checking, like a mounted guest filesystem, registers a callback with
+    on_cancel() that interrupts it.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.reason = None
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = [ ]
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='Cancelled by request'):
+        """
+        @return False if the token had already been cancelled
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(reversed(self._callbacks))
+            self._callbacks = [ ]
+        # Most recently registered first, like unwinding the steps that registered them
+        for callback in callbacks:
+            self._run(callback)
+        return True
+
+    def check(self):
+        """
+        Raise BuildCancelled if the token has been cancelled.
+        """
+        if self._event.is_set():
+            raise BuildCancelled("Build cancelled: %s" % (self.reason))
+
+    def sleep(self, seconds):
+        """
+        Sleep like time.sleep() but raise BuildCancelled as soon as the token is cancelled.
+        """
+        self._event.wait(seconds)
+        self.check()
+
+    def on_cancel(self, callback):
+        """
+        Call callback with no arguments when the token is cancelled - straight away if
+        it already is.  Callbacks run in the thread that cancels and must not block for long.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+    def remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def _run(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            self.log.warning("Exception in cancellation callback (%s)" % (callback))
+            self.log.exception(e)
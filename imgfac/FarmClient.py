@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import json
+import os
+import shutil
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from .ApplicationConfiguration import ApplicationConfiguration
+from .ImageFactoryException import ImageFactoryException
+
+
+class FarmRequestFailed(ImageFactoryException):
+    """
+    The other factory answered a request with an HTTP error status.
+    """
+
+    def __init__(self, status, message):
+        super(FarmRequestFailed, self).__init__(message)
+        self.status = status
+
+
+class FarmClient(object):
+    """
+    Makes requests to the REST API of another factory of the build farm.
+
+    With credentials every request is signed with two legged OAuth - the key and
+    secret must be among the 'clients' of the factory at the other end.  Image bodies
+    are streamed to disk rather than read into memory.
+    """
+
+    def __init__(self, credentials=None, timeout=60):
+        """
+        @param credentials A dict with the OAuth 'key' and 'secret', or None
+        @param timeout Seconds to wait for the other factory before giving up
+        """
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.credentials = credentials
+        self.timeout = timeout
+
+    @classmethod
+    def from_configuration(cls):
+        app_config = ApplicationConfiguration().configuration
+        return cls(credentials=app_config.get('farm_credentials'), timeout=app_config.get('farm_request_timeout', 60))
+
+    def _signed(self, method, url, headers):
+        if not self.credentials:
+            return url
+        # Only needed when the farm is protected - the daemon itself requires it anyway
+        import oauth2 as oauth
+        consumer = oauth.Consumer(self.credentials['key'], self.credentials['secret'])
+        oauth_request = oauth.Request.from_consumer_and_token(consumer, http_method=method, http_url=url)
+        oauth_request.sign_request(oauth.SignatureMethod_HMAC_SHA1(), consumer, None)
+        # The factory wants the consumer key among the request parameters as well as the header
+        headers.update(oauth_request.to_header())
+        return oauth_request.to_url()
+
+    def _open(self, method, url, body=None):
+        headers = {'Accept': 'application/json'}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        url = self._signed(method, url, headers)
+        try:
+            return urlopen(Request(url, data=data, headers=headers, method=method), timeout=self.timeout)
+        except HTTPError as e:
+            raise FarmRequestFailed(e.code, "%s %s failed with HTTP status %s: %s" % (method, url.split('?')[0], e.code,
+                                                                                      e.read().decode('utf-8', 'replace')))
+
+    def request(self, method, url, body=None):
+        """
+        @param method HTTP method
+        @param url URL of the resource
+        @param body Anything that can be sent as JSON, or None
+
+        @return The decoded JSON response, or None if the response was empty
+        """
+        response = self._open(method, url, body)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        return json.loads(content.decode('utf-8')) if content else None
+
+    def stream(self, url):
+        """
+        @return A file like object reading the resource at url, to be closed by the caller
+        """
+        return self._open('GET', url)
+
+    def download(self, url, path, chunk_size=1024*1024):
+        """
+        Stream the resource at url to the file path, replacing it only once the whole
+        body has arrived.
+        """
+        partial = '%s.partial' % (path)
+        response = self.stream(url)
+        try:
+            with open(partial, 'wb') as body:
+                shutil.copyfileobj(response, body, chunk_size)
+        except:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        finally:
+            response.close()
+        os.rename(partial, path)
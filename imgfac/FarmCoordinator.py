@@ -0,0 +1,309 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import time
+from threading import Lock, Thread, Event
+from .Singleton import Singleton
+from .ApplicationConfiguration import ApplicationConfiguration
+from .PersistentImageManager import PersistentImageManager
+from .NotificationCenter import NotificationCenter
+from .ImageFactoryException import ImageFactoryException
+from .FarmClient import FarmClient, FarmRequestFailed
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+COLLECTIONS = {'BaseImage': 'base_images', 'TargetImage': 'target_images', 'ProviderImage': 'provider_images'}
+IMAGE_KEYS = {'BaseImage': 'base_image', 'TargetImage': 'target_image', 'ProviderImage': 'provider_image'}
+# Metadata this factory keeps its own value of rather than taking the worker's
+LOCAL_METADATA = ('identifier', 'data', 'parameters', 'status', 'farm_node', 'checkpoints', 'base_image_id', 'target_image_id')
+# A worker that missed this many heartbeats in a row is no longer given builds
+MISSED_HEARTBEATS = 3
+
+
+def supports_target(targets, target):
+    """
+    Whether a factory whose plugins are registered for targets, as reported by
+    FarmWorker.capabilities(), has a plugin for target.  Matched left to right like
+    PluginManager.plugin_for_target.
+    """
+    registered = set([ tuple(registered_target) for registered_target in targets ])
+    if isinstance(target, str):
+        return (target, ) in registered
+    _target = list(target)
+    for index in range(1, len(_target) + 1):
+        if tuple(_target) in registered:
+            return True
+        _target[-index] = None
+    return False
+
+
+class FarmCoordinator(Singleton):
+    """
+    Hands build stages to the workers of a build farm and follows them there.
+
+    Workers register, and keep their registration alive, with their capabilities -
+    the targets their plugins handle, KVM, free disk and how busy their job pools
+    are.  place() picks the worker for a stage: one that can run it, preferring the
+    worker already holding the body of the image the stage starts from, then the
+    least busy one.  Images built on a worker have a record here with the worker in
+    farm_node.  The coordinator polls the worker's REST API for each of them and
+    copies what it reports into that record, posting the usual notifications.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        app_config = ApplicationConfiguration().configuration
+        self.url = app_config.get('farm_url')
+        self.heartbeat_interval = app_config.get('farm_heartbeat_interval', 30)
+        self.poll_interval = app_config.get('farm_poll_interval', 5)
+        self.client = FarmClient.from_configuration()
+        self.pim = PersistentImageManager.default_manager()
+        self.lock = Lock()
+        # Worker ID to its registration
+        self.workers = dict()
+        # Image ID to the image followed and what to call once it is finished
+        self.followed = dict()
+        self.started_at = time.time()
+        self.poll_thread = None
+        self.stopped = Event()
+
+    def start(self):
+        # Forwarding a deletion is a request to the worker - not made in the thread deleting the image
+        NotificationCenter().add_observer(self, 'handle_state_change', 'image.status', asynchronous=True)
+        self._start_polling()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _start_polling(self):
+        with self.lock:
+            if self.poll_thread and self.poll_thread.is_alive():
+                return
+            self.poll_thread = Thread(target=self._poll_loop, name='farm-poll')
+            self.poll_thread.daemon = True
+            self.poll_thread.start()
+
+##### WORKERS
+    def register(self, registration, now=None):
+        """
+        Add a worker or renew its registration.
+
+        @param registration A dict with the worker's 'id', 'url' and 'capabilities'
+
+        @return The registration as kept here
+        """
+        if (not isinstance(registration, dict)) or (not registration.get('id')) or (not registration.get('url')):
+            raise ImageFactoryException("A worker registration needs an 'id' and a 'url'")
+        now = now if now else time.time()
+        with self.lock:
+            worker = self.workers.get(registration['id'])
+            if not worker:
+                self.log.info("Worker (%s) joined the build farm at (%s)" % (registration['id'], registration['url']))
+                worker = {'id': registration['id'], 'registered_at': now}
+                self.workers[registration['id']] = worker
+            worker.update({'url': registration['url'].rstrip('/'), 'capabilities': registration.get('capabilities') or { },
+                           'last_seen': now, 'placed': 0})
+            return dict(worker, heartbeat_interval=self.heartbeat_interval)
+
+    def _alive(self, worker, now):
+        return worker['last_seen'] >= (now - (self.heartbeat_interval * MISSED_HEARTBEATS))
+
+    def worker(self, worker_id):
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            return dict(worker) if worker else None
+
+    def workers_as_list(self, now=None):
+        now = now if now else time.time()
+        with self.lock:
+            return [ dict(worker, alive=self._alive(worker, now)) for worker in self.workers.values() ]
+
+##### PLACEMENT
+    def _capable(self, worker, stage, os_target, target):
+        capabilities = worker['capabilities']
+        targets = capabilities.get('targets', [ ])
+        if stage == 'provider':
+            return supports_target(targets, target)
+        if not (capabilities.get('kvm') and supports_target(targets, os_target)):
+            return False
+        return (stage == 'base') or supports_target(targets, target)
+
+    def _load(self, worker, stage):
+        jobs = worker['capabilities'].get('jobs', { }).get(stage, { })
+        # Builds placed since the last heartbeat are not in the reported queues yet
+        waiting = jobs.get('running', 0) + jobs.get('queued', 0) + worker['placed']
+        return float(waiting) / max(jobs.get('pool_size', 1), 1)
+
+    def place(self, stage, os_target, target=None, input_image=None, now=None):
+        """
+        Pick the worker to run a build stage on.
+
+        @param stage 'base', 'target' or 'provider'
+        @param os_target The (os_name, os_version, os_arch) of the template
+        @param target The target of a 'target' or 'provider' stage
+        @param input_image The image the stage starts from, if any
+
+        @return The ID of the worker, or None if no live worker can run the stage
+        """
+        now = now if now else time.time()
+        holder = getattr(input_image, 'farm_node', None) if input_image else None
+        with self.lock:
+            candidates = [ worker for worker in self.workers.values()
+                           if self._alive(worker, now) and self._capable(worker, stage, os_target, target) ]
+            if not candidates:
+                return None
+            local = [ worker for worker in candidates if worker['id'] == holder ]
+            if local:
+                # Building where the input body already is saves copying it across
+                chosen = local[0]
+            else:
+                chosen = min(candidates, key=lambda worker: (self._load(worker, stage),
+                                                             -worker['capabilities'].get('free_disk', 0), worker['id']))
+            chosen['placed'] += 1
+        self.log.info("Placed %s stage on worker (%s)" % (stage, chosen['id']))
+        return chosen['id']
+
+##### REMOTE IMAGES
+    def image_url(self, worker_id, image, suffix=''):
+        worker = self.worker(worker_id)
+        if not worker:
+            raise ImageFactoryException("Worker (%s) is not registered with the build farm" % (worker_id))
+        return '%s/imagefactory/%s/%s%s' % (worker['url'], COLLECTIONS[type(image).__name__], image.identifier, suffix)
+
+    def body_url(self, image):
+        if getattr(image, 'farm_node', None):
+            return self.image_url(image.farm_node, image, '/raw_image')
+        if not self.url:
+            raise ImageFactoryException("farm_url must be set for workers to fetch image bodies from this factory")
+        return '%s/imagefactory/%s/%s/raw_image' % (self.url.rstrip('/'), COLLECTIONS[type(image).__name__], image.identifier)
+
+    def input_spec(self, image):
+        """
+        @return What a worker needs to make its own copy of image - see FarmWorker.import_inputs
+        """
+        metadata = dict([ (key, getattr(image, key, None)) for key in image.metadata()
+                          if key not in ('identifier', 'data', 'status', 'status_detail', 'percent_complete', 'farm_node',
+                                         'checkpoints', 'alias_of') ])
+        # Callbacks are made by this factory, not by the worker copying the image
+        metadata['parameters'] = dict([ (key, value) for key, value in (image.parameters or { }).items() if key != 'callbacks' ])
+        return {'_type': type(image).__name__, 'id': image.identifier, 'metadata': metadata, 'body_url': self.body_url(image)}
+
+    def open_body(self, image):
+        """
+        @return A file like response streaming the body of image from the worker holding it
+        """
+        return self.client.stream(self.body_url(image))
+
+    def dispatch(self, worker_id, image, request):
+        """
+        Ask a worker to build image - request is what a client would POST for it.
+        """
+        worker = self.worker(worker_id)
+        if not worker:
+            raise ImageFactoryException("Worker (%s) is not registered with the build farm" % (worker_id))
+        self.client.request('POST', '%s/imagefactory/%s' % (worker['url'], COLLECTIONS[type(image).__name__]),
+                            {IMAGE_KEYS[type(image).__name__]: dict(request, farm_image_id=image.identifier)})
+
+    def cancel(self, image):
+        self.client.request('POST', self.image_url(image.farm_node, image, '/cancel'))
+
+    def is_following(self, image_id):
+        with self.lock:
+            return image_id in self.followed
+
+    def follow(self, image, finished=None):
+        """
+        Copy what the worker in image.farm_node reports about image into it until it
+        reaches a final status.
+
+        @param finished Called with the image once it has
+        """
+        with self.lock:
+            self.followed[image.identifier] = (image, finished)
+        self._start_polling()
+
+    def _poll_loop(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                self.log.exception(e)
+
+    def poll(self, now=None):
+        with self.lock:
+            followed = list(self.followed.values())
+        for image, finished in followed:
+            try:
+                self._poll_image(image, now if now else time.time())
+            except Exception as e:
+                self.log.exception(e)
+                self._fail(image, "Following the build on worker (%s) failed: %s" % (image.farm_node, e))
+            if image.status in FINAL_STATUSES:
+                with self.lock:
+                    self.followed.pop(image.identifier, None)
+                if finished:
+                    finished(image)
+
+    def _poll_image(self, image, now):
+        worker = self.worker(image.farm_node)
+        if not worker:
+            # After a restart of this factory the workers need a heartbeat to reappear
+            if now - self.started_at > self.heartbeat_interval * MISSED_HEARTBEATS:
+                self._fail(image, "Worker (%s) building the image left the build farm" % (image.farm_node))
+            return
+        try:
+            reported = self.client.request('GET', self.image_url(worker['id'], image))[IMAGE_KEYS[type(image).__name__]]
+        except FarmRequestFailed as e:
+            if e.status == 404:
+                self._fail(image, "Worker (%s) has no record of the image" % (worker['id']))
+            elif not self._alive(worker, now):
+                self._fail(image, "Lost contact with worker (%s): %s" % (worker['id'], e))
+            return
+        except Exception as e:
+            if not self._alive(worker, now):
+                self._fail(image, "Lost contact with worker (%s): %s" % (worker['id'], e))
+            else:
+                self.log.debug("Worker (%s) did not report on image (%s): %s" % (worker['id'], image.identifier, e))
+            return
+        self.update(image, reported)
+
+    def update(self, image, reported):
+        """
+        Copy the metadata a worker reported for image into our record of it.
+        """
+        for key in image.metadata().difference(LOCAL_METADATA):
+            if key in reported:
+                setattr(image, key, reported[key])
+        self.pim.save_image(image)
+        if reported.get('status') and (reported['status'] != image.status):
+            image.status = reported['status']
+            self.pim.save_image(image)
+
+    def _fail(self, image, reason):
+        image.status_detail = {'activity': 'Build on worker (%s) failed' % (image.farm_node), 'error': reason}
+        image.status = 'FAILED'
+        self.pim.save_image(image)
+
+    def handle_state_change(self, notification):
+        image = notification.sender
+        # A deleted Base or TargetImage leaves its body on the worker.  ProviderImages
+        # were removed from the provider by the deletion here.
+        if (notification.user_info['new_status'] == 'DELETED') and getattr(image, 'farm_node', None) and \
+                (type(image).__name__ in ('BaseImage', 'TargetImage')):
+            try:
+                self.client.request('DELETE', self.image_url(image.farm_node, image))
+            except Exception as e:
+                self.log.warning("Unable to delete the copy of image (%s) on worker (%s): %s" % (image.identifier, image.farm_node, e))
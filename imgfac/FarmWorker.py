@@ -0,0 +1,133 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+from threading import Event, Lock, Thread
+from .Singleton import Singleton
+from .ApplicationConfiguration import ApplicationConfiguration
+from .PersistentImageManager import PersistentImageManager
+from .PluginManager import PluginManager
+from .JobScheduler import JobScheduler
+from .BaseImage import BaseImage
+from .TargetImage import TargetImage
+from .ImageFactoryException import ImageFactoryException
+from .FarmClient import FarmClient
+
+INPUT_CLASSES = {'BaseImage': BaseImage, 'TargetImage': TargetImage}
+# Metadata of an input that describes its copy here rather than the image
+COPY_METADATA = ('identifier', 'data', 'status', 'status_detail', 'percent_complete', 'farm_node')
+
+
+class FarmWorker(Singleton):
+    """
+    Makes this factory a worker of a build farm.
+
+    The worker registers with the coordinator and renews the registration every
+    farm_heartbeat_interval seconds, reporting its capabilities.  The coordinator
+    then asks it for builds through the usual REST API, telling it the ID to give
+    the image and, when a stage starts from an image held elsewhere, where to fetch
+    that image from - see import_inputs().
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.app_config = ApplicationConfiguration().configuration
+        self.url = self.app_config.get('farm_url')
+        self.coordinator_url = self.app_config.get('farm_coordinator')
+        self.heartbeat_interval = self.app_config.get('farm_heartbeat_interval', 30)
+        self.client = FarmClient.from_configuration()
+        self.pim = PersistentImageManager.default_manager()
+        self.lock = Lock()
+        self.thread = None
+        self.stopped = Event()
+
+    def capabilities(self):
+        storage_path = self.app_config.get('image_manager_args', { }).get('storage_path') or self.app_config.get('imgdir', '/tmp')
+        try:
+            stat = os.statvfs(storage_path)
+            free_disk = stat.f_bavail * stat.f_frsize
+        except OSError:
+            free_disk = 0
+        return {'targets': PluginManager(self.app_config['plugins']).registered_targets(),
+                'kvm': os.access('/dev/kvm', os.R_OK | os.W_OK),
+                'free_disk': free_disk,
+                'jobs': JobScheduler().stats()}
+
+    def start(self):
+        if not (self.url and self.coordinator_url):
+            raise ImageFactoryException("A farm worker needs farm_url and farm_coordinator to be set")
+        self.thread = Thread(target=self._run, name='farm-heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def heartbeat(self):
+        self.client.request('POST', '%s/imagefactory/farm/workers' % (self.coordinator_url.rstrip('/')),
+                            {'worker': {'id': self.url, 'url': self.url, 'capabilities': self.capabilities()}})
+
+    def _run(self):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception as e:
+                self.log.warning("Unable to register with the build farm coordinator (%s): %s" % (self.coordinator_url, e))
+            if self.stopped.wait(self.heartbeat_interval):
+                return
+
+    def import_inputs(self, inputs):
+        """
+        Make local copies of the images a stage handed to us starts from.  Each gets a
+        record with the same identifier and metadata as on the factory holding it and
+        stays PENDING until its body is fetched, so the stage waits for it like for
+        any image still being built.
+
+        @param inputs A list of dicts from FarmCoordinator.input_spec()
+        """
+        for spec in inputs or [ ]:
+            image_class = INPUT_CLASSES.get(spec.get('_type'))
+            if (not image_class) or (not spec.get('id')) or (not spec.get('body_url')):
+                raise ImageFactoryException("Unable to import build input (%s)" % (spec.get('id')))
+            with self.lock:
+                image = self.pim.image_with_id(spec['id'])
+                if image and (image.status != 'FAILED'):
+                    # Already here or on its way
+                    continue
+                if not image:
+                    image = image_class(image_id=spec['id'])
+                    self.pim.add_image(image)
+                for key, value in (spec.get('metadata') or { }).items():
+                    if (key in image.metadata()) and (key not in COPY_METADATA):
+                        setattr(image, key, value)
+                image.status_detail = {'activity': 'Fetching image from the build farm', 'error': None}
+                image.status = 'PENDING'
+                self.pim.save_image(image)
+            Thread(target=self._fetch, args=(image, spec['body_url']), name='farm-fetch-%s' % (spec['id'][0:8])).start()
+
+    def _fetch(self, image, body_url):
+        try:
+            image.status = 'BUILDING'
+            self.client.download(body_url, image.data)
+            image.status_detail = {'activity': 'Image fetched from the build farm', 'error': None}
+            image.status = 'COMPLETE'
+        except Exception as e:
+            self.log.exception(e)
+            image.status_detail = {'activity': 'Fetching image from the build farm failed', 'error': str(e)}
+            image.status = 'FAILED'
+        finally:
+            self.pim.save_image(image)
@@ -0,0 +1,210 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import json
+import sqlite3
+from threading import Lock
+
+INDEX_FILENAME = 'index.sqlite'
+# Bump this whenever the table layout changes - a mismatch forces a rebuild
+SCHEMA_VERSION = 2
+# cache_key - looked up by the BuildCache for every BaseImage request
+INDEXED_KEYS = ('type', 'identifier', 'base_image_id', 'target_image_id', 'status', 'cache_key')
+
+
+class FileMetadataIndex(object):
+    """
+    SQLite index of the image metadata held in the .meta files of a FilePersistentImageManager.
+
+    The .meta files remain the authoritative record.  The index only stores the handful of
+    keys we routinely query on so that lookups do not require reading every file in the store.
+    """
+
+    def __init__(self, storage_path, metadata_ext):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.storage_path = storage_path
+        self.metadata_ext = metadata_ext
+        self.index_path = os.path.join(storage_path, INDEX_FILENAME)
+        self.lock = Lock()
+        is_new = not os.path.isfile(self.index_path)
+        self.db = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if is_new or version != SCHEMA_VERSION:
+            self._create_schema()
+            self.rebuild()
+        else:
+            self.reconcile()
+
+    def _create_schema(self):
+        self.db.execute('DROP TABLE IF EXISTS images')
+        self.db.execute('CREATE TABLE images (identifier TEXT PRIMARY KEY, type TEXT, base_image_id TEXT, '
+                        'target_image_id TEXT, status TEXT, cache_key TEXT, mtime REAL)')
+        for key in INDEXED_KEYS:
+            if key != 'identifier':
+                self.db.execute('CREATE INDEX images_%s ON images (%s)' % (key, key))
+        self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def _metadata_path(self, image_id):
+        return os.path.join(self.storage_path, image_id + self.metadata_ext)
+
+    def _stored_metadata_files(self):
+        files = { }
+        for storefileshortname in os.listdir(self.storage_path):
+            if storefileshortname.endswith(self.metadata_ext):
+                image_id = storefileshortname[:-len(self.metadata_ext)]
+                try:
+                    files[image_id] = os.stat(self._metadata_path(image_id)).st_mtime
+                except OSError:
+                    pass
+        return files
+
+    def _index_file(self, image_id, mtime):
+        try:
+            with open(self._metadata_path(image_id), 'r') as mdf:
+                metadata = json.load(mdf)
+        except (IOError, OSError, ValueError) as e:
+            # add_image() creates an empty file ahead of the first save - nothing to index yet
+            self.log.debug("Not indexing metadata file for image (%s): %s" % (image_id, e))
+            self._delete(image_id)
+            return
+        self._upsert(metadata, mtime)
+
+    def _upsert(self, metadata, mtime):
+        row = [ metadata.get(key) for key in INDEXED_KEYS ]
+        row.append(mtime)
+        self.db.execute('INSERT OR REPLACE INTO images (%s, mtime) VALUES (%s)' %
+                        (', '.join(INDEXED_KEYS), ', '.join('?' * (len(INDEXED_KEYS) + 1))), row)
+
+    def _delete(self, image_id):
+        self.db.execute('DELETE FROM images WHERE identifier = ?', (image_id,))
+
+    def rebuild(self):
+        """
+        Discard the index contents and re-read every .meta file in the storage directory.
+        """
+        self.log.info("Rebuilding metadata index (%s)" % (self.index_path))
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM images')
+                for image_id, mtime in self._stored_metadata_files().items():
+                    self._index_file(image_id, mtime)
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def reconcile(self):
+        """
+        Bring an existing index up to date with the .meta files, re-reading only those files
+        that were added, changed or removed behind our back (e.g. while the daemon was down).
+        """
+        with self.lock:
+            stored = self._stored_metadata_files()
+            indexed = dict(self.db.execute('SELECT identifier, mtime FROM images').fetchall())
+            stale = [ image_id for image_id, mtime in stored.items() if indexed.get(image_id) != mtime ]
+            vanished = [ image_id for image_id in indexed if image_id not in stored ]
+            if stale or vanished:
+                self.log.info("Metadata index is stale - refreshing %d and dropping %d entries" % (len(stale), len(vanished)))
+            self.db.execute('BEGIN')
+            try:
+                for image_id in stale:
+                    self._index_file(image_id, stored[image_id])
+                for image_id in vanished:
+                    self._delete(image_id)
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def update(self, metadata, mtime):
+        """
+        Record the current metadata for an image.
+
+        @param metadata The metadata dict as written to the .meta file
+        @param mtime Modification time of the .meta file after the write
+        """
+        with self.lock:
+            self._upsert(metadata, mtime)
+
+    def remove(self, image_id):
+        """
+        Drop an image from the index.
+
+        @param image_id Identifier of the image
+        """
+        with self.lock:
+            self._delete(image_id)
+
+    def covers(self, query):
+        """
+        @param query Dict of metadata key/value pairs
+
+        @return True if identifiers_matching() alone decides whether an image matches query
+        """
+        for key, value in query.items():
+            if key not in INDEXED_KEYS:
+                return False
+            if (value is not None) and not isinstance(value, (str, int, float)):
+                return False
+        return True
+
+    def identifiers_matching(self, query, after=None, offset=0, limit=None, modified_after=None, modified_before=None):
+        """
+        Return the identifiers of all images whose indexed keys equal the values in query,
+        ordered by identifier.  Keys that are not indexed are ignored and must be checked
+        by the caller.
+
+        @param query Dict of metadata key/value pairs
+        @param after Only return identifiers sorting after this one
+        @param offset Number of matching identifiers to skip
+        @param limit Maximum number of identifiers to return
+        @param modified_after Only images whose metadata was written at or after this time
+        @param modified_before Only images whose metadata was written before this time
+
+        @return List of image identifiers
+        """
+        clauses = [ ]
+        values = [ ]
+        for key in INDEXED_KEYS:
+            if key in query:
+                if query[key] is None:
+                    clauses.append('%s IS NULL' % key)
+                elif isinstance(query[key], (str, int, float)):
+                    clauses.append('%s = ?' % key)
+                    values.append(query[key])
+        if after is not None:
+            clauses.append('identifier > ?')
+            values.append(after)
+        # Writes deferred by write-behind have no mtime yet - they are as recent as it gets
+        if modified_after is not None:
+            clauses.append('(mtime IS NULL OR mtime >= ?)')
+            values.append(modified_after)
+        if modified_before is not None:
+            clauses.append('mtime < ?')
+            values.append(modified_before)
+        sql = 'SELECT identifier FROM images'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY identifier'
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            values.extend([ limit if limit is not None else -1, offset ])
+        with self.lock:
+            return [ row[0] for row in self.db.execute(sql, values) ]
@@ -15,27 +15,39 @@
 #   limitations under the License.
 
 import logging
-import re
 import os
 import os.path
 import stat
 import json
-import importlib
+import tempfile
+import time
+import atexit
+import copy
+from threading import Thread, Condition
 from .props import prop
 from .ImageFactoryException import ImageFactoryException
 from .PersistentImageManager import PersistentImageManager
-from threading import BoundedSemaphore
+from .FileMetadataIndex import FileMetadataIndex
+from .ReadWriteLock import StripedReadWriteLock
+from .LRUCache import LRUCache
+from .BlobStore import BlobStore
 
 STORAGE_PATH = '/var/lib/imagefactory/storage'
 METADATA_EXT = '.meta'
 BODY_EXT = '.body'
+TEMP_EXT = '.tmp'
+# Saves carrying one of these statuses are never deferred by write-behind
+TERMINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+# Number of identifiers fetched from the index at a time while walking a query
+QUERY_CHUNK_SIZE = 500
 
 class FilePersistentImageManager(PersistentImageManager):
     """ TODO: Docstring for PersistentImageManager  """
 
     storage_path = prop("_storage_path")
 
-    def __init__(self, storage_path=STORAGE_PATH):
+    def __init__(self, storage_path=STORAGE_PATH, metadata_lock_stripes=64, write_behind_window=0,
+                 image_cache_size=1024, dedupe_bodies=False):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         if not os.path.exists(storage_path):
             self.log.debug("Creating directory (%s) for persistent storage" % (storage_path))
@@ -47,38 +59,57 @@ class FilePersistentImageManager(PersistentImageManager):
             # TODO: verify that we can write to this location
             pass
         self.storage_path = storage_path
-        self.metadata_lock = BoundedSemaphore()
-
-
-    def _image_from_metadata(self, metadata):
-        # Given the retrieved metadata from mongo, return a PersistentImage type object
-        # with us as the persistent_manager.
-
-        image_module = importlib.import_module( ".." + metadata['type'], __name__)
-        image_class = getattr(image_module, metadata['type'])
-        image = image_class(metadata['identifier'])
-
-        # We don't actually want a 'type' property in the resulting PersistentImage object
-        del metadata['type']
-
-        for key in image.metadata().union(list(metadata.keys())):
-            setattr(image, key, metadata.get(key))
-
-        #set ourselves as the manager
-        image.persistent_manager = self
-
-        return image
-
-
-    def _metadata_from_file(self, metadatafile):
-        self.metadata_lock.acquire()
-        try:
-            mdf = open(metadatafile, 'r')
-            metadata = json.load(mdf)
-            mdf.close()
-        finally:
-            self.metadata_lock.release()
-        return metadata
+        # Readers of an image share its lock, writers of the same image exclude each other
+        self.metadata_locks = StripedReadWriteLock(metadata_lock_stripes)
+        # Built from, or brought up to date with, the .meta files if missing or stale
+        self.index = FileMetadataIndex(storage_path, METADATA_EXT)
+        # Parsed metadata keyed by image ID and validated against the inode and mtime
+        # of the .meta file, so pollers do not re-read and re-parse unchanged files
+        self.metadata_cache = LRUCache(image_cache_size)
+        # With a non-zero window, repeated saves of an image within that many seconds
+        # are coalesced into a single write of the most recent metadata
+        self.write_behind_window = write_behind_window
+        self._pending_writes = { }
+        self._pending_cond = Condition()
+        self._flush_thread = None
+        # Bodies of completed images are stored once per distinct content
+        if dedupe_bodies:
+            self.blob_store = BlobStore(storage_path)
+        if self.write_behind_window > 0:
+            self._flush_thread = Thread(target=self._flush_pending_writes, name='metadata-write-behind')
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+            atexit.register(self.flush)
+
+
+    def _metadata_from_file(self, image_id):
+        metadatafile = self.storage_path + '/' + image_id + METADATA_EXT
+        with self.metadata_locks.lock_for(image_id).reading():
+            with self._pending_cond:
+                pending = self._pending_writes.get(image_id)
+            if pending:
+                # Newer than what is on disk
+                return json.loads(pending[1])
+            # Every save renames a new file into place so the inode changes even when
+            # two writes land within the resolution of the mtime
+            mdstat = os.stat(metadatafile)
+            token = (mdstat.st_ino, mdstat.st_mtime_ns, mdstat.st_size)
+            metadata = self.metadata_cache.get(image_id, token)
+            if metadata is None:
+                mdf = open(metadatafile, 'r')
+                try:
+                    metadata = json.load(mdf)
+                finally:
+                    mdf.close()
+                self.metadata_cache.put(image_id, metadata, token)
+        # Callers are free to modify what they get back
+        return copy.deepcopy(metadata)
+
+    def cache_stats(self):
+        """
+        @return Hit and miss counters and the size of the metadata cache
+        """
+        return self.metadata_cache.stats()
 
 
     def image_with_id(self, image_id):
@@ -89,9 +120,8 @@ class FilePersistentImageManager(PersistentImageManager):
 
         @return TODO
         """
-        metadatafile = self.storage_path + '/' + image_id + METADATA_EXT
         try:
-            metadata = self._metadata_from_file(metadatafile)
+            metadata = self._metadata_from_file(image_id)
         except Exception as e:
             self.log.debug('Exception caught: %s' % e)
             return None
@@ -100,23 +130,56 @@ class FilePersistentImageManager(PersistentImageManager):
 
 
     def images_from_query(self, query):
-        images = [ ]
-        for storefileshortname in os.listdir(self.storage_path):
-            storefilename = self.storage_path + '/' + storefileshortname
-            if re.search(METADATA_EXT, storefilename):
-                try:
-                    metadata = self._metadata_from_file(storefilename)
-                    match = True
-                    for querykey in query:
-                        if metadata[querykey] != query[querykey]:
-                            match = False
-                            break
-                    if match:
-                        images.append(self._image_from_metadata(metadata))
-                except:
-                    self.log.warn("Could not extract image metadata from file (%s)" % (storefilename))
-
-        return images              
+        return [ self._image_from_metadata(metadata) for metadata in self.metadata_from_query(query) ]
+
+    def metadata_from_query(self, query, fields=None, offset=0, limit=None, after=None,
+                            modified_after=None, modified_before=None):
+        # Walk the index in identifier order, a chunk at a time, so that neither the
+        # identifiers nor the metadata of the whole result are ever held at once
+        exact = self.index.covers(query)
+        # Offsets can only be handed to the index if it decides the match by itself
+        skip = 0 if exact else offset
+        index_offset = offset if exact else 0
+        remaining = limit
+        while (remaining is None) or (remaining > 0):
+            chunk = self.index.identifiers_matching(query, after=after, offset=index_offset, limit=QUERY_CHUNK_SIZE,
+                                                    modified_after=modified_after, modified_before=modified_before)
+            index_offset = 0
+            for image_id in chunk:
+                after = image_id
+                metadata = self._metadata_for_query(image_id, query)
+                if metadata is None:
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                if fields is not None:
+                    metadata = dict([ (key, metadata.get(key)) for key in set(fields).union(('type', 'identifier')) ])
+                yield metadata
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+            if len(chunk) < QUERY_CHUNK_SIZE:
+                return
+
+    def _metadata_for_query(self, image_id, query):
+        storefilename = self.storage_path + '/' + image_id + METADATA_EXT
+        try:
+            metadata = self._metadata_from_file(image_id)
+        except (IOError, OSError):
+            # Removed behind our back - stop returning it
+            self.log.warn("Indexed image (%s) has no metadata file - dropping it from the index" % (image_id))
+            self.index.remove(image_id)
+            return None
+        except:
+            self.log.warn("Could not extract image metadata from file (%s)" % (storefilename))
+            return None
+        # The index only covers a few keys so we always confirm the match against the file
+        for querykey in query:
+            if (querykey not in metadata) or (metadata[querykey] != query[querykey]):
+                return None
+        return metadata
 
 
     def add_image(self, image):
@@ -161,19 +224,88 @@ class FilePersistentImageManager(PersistentImageManager):
             for mdprop in image.metadata():
                 meta[mdprop] = getattr(image, mdprop, None)
  
-            self.metadata_lock.acquire()
-            try:
-                mdf = open(metadata_path, 'w')
-                json.dump(meta, mdf)
-                mdf.close()
-            finally:
-                self.metadata_lock.release()
+            serialized = json.dumps(meta)
+            if (self.write_behind_window > 0) and (meta.get('status') not in TERMINAL_STATUSES):
+                with self._pending_cond:
+                    if image_id in self._pending_writes:
+                        deadline = self._pending_writes[image_id][0]
+                    else:
+                        deadline = time.time() + self.write_behind_window
+                    self._pending_writes[image_id] = (deadline, serialized, meta)
+                    # Before the flush can pop the entry, or this would wipe the mtime it records
+                    self.index.update(meta, None)
+                    self._pending_cond.notify()
+            else:
+                with self.metadata_locks.lock_for(image_id).writing():
+                    with self._pending_cond:
+                        self._pending_writes.pop(image_id, None)
+                    self._write_metadata(image_id, serialized, meta)
+                self._store_body(meta)
 
             self.log.debug("Saved metadata for image (%s): %s" % (image_id, meta))
         except Exception as e:
             self.log.debug('Exception caught: %s' % e)
             raise ImageFactoryException('Unable to save image metadata: %s' % e)
 
+    def _write_metadata(self, image_id, serialized, meta):
+        # Caller must hold the write lock for image_id
+        # Write to a temporary file and rename it over the old one so that a crash
+        # at any point leaves either the old or the new metadata, never a partial file
+        metadata_path = self.storage_path + '/' + image_id + METADATA_EXT
+        fd, temp_path = tempfile.mkstemp(prefix='.%s-' % image_id, suffix=TEMP_EXT, dir=self.storage_path)
+        try:
+            with os.fdopen(fd, 'w') as mdf:
+                mdf.write(serialized)
+                mdf.flush()
+                os.fsync(mdf.fileno())
+            os.chmod(temp_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(temp_path, metadata_path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        dirfd = os.open(self.storage_path, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self.metadata_cache.invalidate(image_id)
+        self.index.update(meta, os.stat(metadata_path).st_mtime)
+
+    def _flush_pending_writes(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending_writes:
+                    self._pending_cond.wait()
+                image_id, pending = min(self._pending_writes.items(), key=lambda item: item[1][0])
+                delay = pending[0] - time.time()
+                if delay > 0:
+                    self._pending_cond.wait(delay)
+                    continue
+            self._flush_image(image_id)
+
+    def _flush_image(self, image_id):
+        with self.metadata_locks.lock_for(image_id).writing():
+            with self._pending_cond:
+                pending = self._pending_writes.pop(image_id, None)
+            if pending:
+                try:
+                    self._write_metadata(image_id, pending[1], pending[2])
+                except Exception as e:
+                    self.log.error("Deferred metadata write for image (%s) failed" % (image_id))
+                    self.log.exception(e)
+
+    def flush(self):
+        """
+        Write out any metadata still held back by write-behind.
+        """
+        with self._pending_cond:
+            image_ids = list(self._pending_writes.keys())
+        for image_id in image_ids:
+            self._flush_image(image_id)
+
     def delete_image_with_id(self, image_id):
         """
         TODO: Docstring for delete_image_with_id
@@ -186,7 +318,16 @@ class FilePersistentImageManager(PersistentImageManager):
         metadata_path = basename + METADATA_EXT
         body_path = basename + BODY_EXT
         try:
-            os.remove(metadata_path)
+            with self.metadata_locks.lock_for(image_id).writing():
+                with self._pending_cond:
+                    self._pending_writes.pop(image_id, None)
+                self.metadata_cache.invalidate(image_id)
+                os.remove(metadata_path)
             os.remove(body_path)
         except Exception as e:
             self.log.warn('Unable to delete file: %s' % e)
+        finally:
+            self.index.remove(image_id)
+            # A body left behind still uses its blob - the StorageCollector releases it with the body
+            if self.blob_store and not os.path.lexists(body_path):
+                self.blob_store.release(image_id)
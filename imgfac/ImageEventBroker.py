@@ -0,0 +1,189 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import json
+from collections import deque
+from threading import Condition, Lock
+from .Singleton import Singleton
+from .NotificationCenter import NotificationCenter
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+# Events a subscriber may fall behind by before it is dropped
+MAX_QUEUED_EVENTS = 1000
+
+
+def image_event(image, event='status'):
+    """
+    @return The event sent to subscribers for the current state of image
+    """
+    _event = {'event': event,
+              '_type': type(image).__name__,
+              'id': image.identifier,
+              'percent_complete': image.percent_complete}
+    if event == 'status':
+        _event.update({'status': image.status, 'status_detail': image.status_detail})
+    return _event
+
+
+class ImageEventSubscription(object):
+    """
+    The events, oldest first, of the images a client has subscribed to.
+
+    Only the newest percentage of an image is kept while the client is not reading,
+    status changes are all kept.  A client that falls MAX_QUEUED_EVENTS behind is
+    closed, and gets the current state when it subscribes again.
+    """
+
+    def __init__(self, image_ids):
+        self.image_ids = frozenset(image_ids)
+        self.cond = Condition()
+        self.events = deque()
+        # Image ID to its percentage event still waiting to be read
+        self.percentages = dict()
+        self.closed = False
+        self.overflowed = False
+
+    def push(self, event):
+        with self.cond:
+            if self.closed:
+                return
+            if event['event'] == 'percentage':
+                waiting = self.percentages.get(event['id'])
+                if waiting:
+                    waiting.update(event)
+                    return
+                self.percentages[event['id']] = event
+            else:
+                # A later percentage must not be moved ahead of this
+                self.percentages.pop(event['id'], None)
+            if len(self.events) >= MAX_QUEUED_EVENTS:
+                self.overflowed = True
+                self.closed = True
+            else:
+                self.events.append(event)
+            self.cond.notify_all()
+
+    def next_events(self, timeout=None):
+        """
+        Wait for events.
+
+        @return The events queued, an empty list if none came within timeout
+        """
+        with self.cond:
+            if not (self.events or self.closed):
+                self.cond.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            self.percentages.clear()
+            return events
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ImageEventBroker(Singleton):
+    """
+    Passes the 'image.status' and 'image.percentage' notifications of images on to
+    the clients subscribed to them, so that clients are told of changes instead of
+    polling storage for them.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.lock = Lock()
+        # Image ID to the subscriptions that include it
+        self.subscriptions = dict()
+        NotificationCenter().add_observer(self, 'status_changed', 'image.status')
+        NotificationCenter().add_observer(self, 'percentage_changed', 'image.percentage')
+
+    def subscribe(self, image_ids):
+        """
+        Start collecting the events of images.  Subscribe before reading the images
+        from storage so that no change is missed in between.
+
+        @param image_ids Identifiers of the images
+
+        @return An ImageEventSubscription, to be passed to unsubscribe() when done
+        """
+        subscription = ImageEventSubscription(image_ids)
+        with self.lock:
+            for image_id in subscription.image_ids:
+                self.subscriptions[image_id] = self.subscriptions.get(image_id, frozenset()) | {subscription}
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self.lock:
+            for image_id in subscription.image_ids:
+                remaining = self.subscriptions.get(image_id, frozenset()) - {subscription}
+                if remaining:
+                    self.subscriptions[image_id] = remaining
+                else:
+                    self.subscriptions.pop(image_id, None)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(set().union(*self.subscriptions.values()))
+
+    def status_changed(self, notification):
+        self._publish(notification.sender, 'status', old_status=notification.user_info['old_status'])
+
+    def percentage_changed(self, notification):
+        self._publish(notification.sender, 'percentage')
+
+    def _publish(self, image, event, **extra):
+        subscriptions = self.subscriptions.get(image.identifier)
+        if not subscriptions:
+            return
+        _event = image_event(image, event)
+        _event.update(extra)
+        for subscription in subscriptions:
+            # Each gets its own copy - percentages waiting to be read are updated in place
+            subscription.push(dict(_event))
+
+
+def event_stream(subscription, events, keepalive=15):
+    """
+    Generate a text/event-stream of the events of a subscription.  It ends once all
+    the images subscribed to have reached a final status.
+
+    @param subscription An ImageEventSubscription
+    @param events The events to start with, usually the state of each image when subscribed
+    @param keepalive Seconds without events after which a comment is sent, so that
+                     proxies and clients know the connection is still alive
+    """
+    unfinished = set(subscription.image_ids)
+    try:
+        while True:
+            for event in events:
+                yield 'event: %s\ndata: %s\n\n' % (event['event'], json.dumps(event))
+                if event.get('status') in FINAL_STATUSES:
+                    unfinished.discard(event['id'])
+            if not unfinished:
+                break
+            if subscription.overflowed:
+                yield ': too far behind - subscribe again for the current state\n\n'
+                break
+            if subscription.closed:
+                break
+            events = subscription.next_events(keepalive)
+            if not events:
+                yield ': keep-alive\n\n'
+    finally:
+        ImageEventBroker().unsubscribe(subscription)
@@ -0,0 +1,99 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+from collections import defaultdict
+from threading import Condition
+from .Singleton import Singleton
+from .NotificationCenter import NotificationCenter
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETING', 'DELETED', 'DELETEFAILED')
+
+
+class ImageStatusWaiter(Singleton):
+    """
+    Lets a thread block until an image reaches a final status.
+
+    Waiters are woken as soon as an 'image.status' notification for their image is posted
+    in this process.  Images being built by another process never generate a notification
+    here, so storage is also polled with an exponentially growing interval.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cond = Condition()
+        self.waiters = defaultdict(int)
+        self.final_images = { }
+        NotificationCenter().add_observer(self, 'status_changed', 'image.status')
+
+    def status_changed(self, notification):
+        image = notification.sender
+        if notification.user_info['new_status'] not in FINAL_STATUSES:
+            return
+        with self.cond:
+            if image.identifier in self.waiters:
+                self.final_images[image.identifier] = image
+                self.cond.notify_all()
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_for_final_status(self, image_id, pim, poll_interval=1, max_poll_interval=30, cancellation=None):
+        """
+        Block until the image with image_id reaches a final status.
+
+        @param image_id Identifier of the image to wait for
+        @param pim The PersistentImageManager to poll
+        @param poll_interval Seconds before the first storage poll
+        @param max_poll_interval Upper bound for the doubling poll interval
+        @param cancellation Optional CancellationToken - BuildCancelled is raised as soon as it is cancelled
+
+        @return The image in its final status.  If the change happened in this process
+                this is the object that was updated rather than a copy from storage, as
+                the status notification is posted before the image is saved.
+        """
+        with self.cond:
+            self.waiters[image_id] += 1
+        if cancellation:
+            cancellation.on_cancel(self._wake)
+        try:
+            interval = poll_interval
+            while True:
+                if cancellation:
+                    cancellation.check()
+                # Registered above, so a status change from here on cannot be missed
+                image = pim.image_with_id(image_id)
+                if not image:
+                    raise KeyError("No image found with id (%s)" % (image_id))
+                if image.status in FINAL_STATUSES:
+                    return image
+                with self.cond:
+                    # Checked under the lock so a cancellation cannot slip in before the wait
+                    if (image_id not in self.final_images) and not (cancellation and cancellation.cancelled):
+                        self.cond.wait(interval)
+                    if image_id in self.final_images:
+                        return self.final_images[image_id]
+                self.log.debug("No final status for image (%s) after %s seconds - polling storage" % (image_id, interval))
+                interval = min(interval * 2, max_poll_interval)
+        finally:
+            if cancellation:
+                cancellation.remove(self._wake)
+            with self.cond:
+                self.waiters[image_id] -= 1
+                if self.waiters[image_id] == 0:
+                    del self.waiters[image_id]
+                    self.final_images.pop(image_id, None)
@@ -0,0 +1,352 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import itertools
+import time
+import heapq
+from datetime import datetime
+from collections import deque
+from threading import Thread, Condition, Event, current_thread
+from .Singleton import Singleton
+from .ImageFactoryException import ImageFactoryException
+
+STAGES = ('base', 'target', 'provider')
+DEFAULT_POOL_SIZES = {'base': 4, 'target': 4, 'provider': 8}
+DEFAULT_TENANT = 'default'
+# A queued job gains one priority level for every this many seconds it waits
+DEFAULT_AGING_INTERVAL = 600
+# Rough first guesses at how long a job of each stage runs, in seconds - replaced
+# by a moving average of the measured durations as jobs finish
+DEFAULT_STAGE_ESTIMATES = {'base': 1800, 'target': 600, 'provider': 900}
+# Weight of the latest duration in the moving average
+ESTIMATE_WEIGHT = 0.3
+
+
+class Job(object):
+    """
+    A unit of work queued with the JobScheduler.
+
+    Offers the parts of the Thread interface that callers of Builder rely on -
+    join(), is_alive(), getName() and name - so it can stand in for the thread
+    that used to be started for every stage.
+    """
+
+    def __init__(self, stage, target, kwargs, name, image=None, priority=0, tenant=DEFAULT_TENANT, sequence=0, deadline=None):
+        self.stage = stage
+        self.target = target
+        self.kwargs = kwargs
+        self.name = name
+        self.image = image
+        self.priority = priority
+        self.tenant = tenant
+        self.sequence = sequence
+        self.deadline = deadline
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.started = False
+        self._done = Event()
+
+    def run(self):
+        self.started = True
+        self.started_at = time.time()
+        try:
+            self.target(**self.kwargs)
+        finally:
+            self._done.set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+    def getName(self):
+        return self.name
+
+    def effective_priority(self, now, aging_interval):
+        # Waiting raises the priority so that a steady stream of more important
+        # jobs cannot hold this one back forever
+        if not aging_interval:
+            return self.priority
+        return self.priority + int(max(now - self.submitted_at, 0) // aging_interval)
+
+    def urgent(self, now, estimate):
+        # Only meets its deadline if it starts now
+        return (self.deadline is not None) and (now + estimate >= self.deadline)
+
+    def rank(self, now, aging_interval, estimate):
+        # Jobs of equal rank are started with the tenants taking turns
+        return (not self.urgent(now, estimate), -self.effective_priority(now, aging_interval))
+
+    def sort_key(self, now, aging_interval, estimate):
+        # Urgent jobs first, then higher priority, then earliest deadline, then first come first served
+        return self.rank(now, aging_interval, estimate) + \
+               ((self.deadline if self.deadline is not None else float('inf')), self.sequence)
+
+
+class JobScheduler(Singleton):
+    """
+    Runs build stages on bounded pools of worker threads, one pool per stage.
+
+    Queued jobs are ordered by priority.  Among jobs of equal priority the tenants
+    (parameters['tenant']) take turns, so one tenant submitting a large batch cannot
+    starve everyone else.  Worker threads are started on demand up to the pool size.
+
+    The priority of a queued job rises by one for every aging_interval seconds it
+    waits.  A job with a deadline (parameters['deadline']) that would miss it unless
+    started now is urgent and goes before all others, earliest deadline first.
+    Deadlines also break ties between jobs of equal priority.
+    """
+
+    def _singleton_init(self, pool_sizes=None, aging_interval=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.cond = Condition()
+        self.pool_sizes = dict(DEFAULT_POOL_SIZES)
+        self.queues = dict([ (stage, { }) for stage in STAGES ])
+        # Tenants of each stage in the order they get their next turn
+        self.turns = dict([ (stage, deque()) for stage in STAGES ])
+        self.workers = dict([ (stage, [ ]) for stage in STAGES ])
+        self.idle = dict([ (stage, 0) for stage in STAGES ])
+        self.running = dict([ (stage, [ ]) for stage in STAGES ])
+        self._sequence = itertools.count()
+        self.aging_interval = DEFAULT_AGING_INTERVAL
+        self.estimates = dict(DEFAULT_STAGE_ESTIMATES)
+        self.configure(pool_sizes, aging_interval)
+
+    def configure(self, pool_sizes=None, aging_interval=None):
+        """
+        @param pool_sizes Dict of stage name to the maximum number of concurrent jobs
+        @param aging_interval Seconds of waiting that raise a job's priority by one - 0 turns aging off
+        """
+        with self.cond:
+            if aging_interval is not None:
+                self.aging_interval = max(float(aging_interval), 0)
+            for stage, size in (pool_sizes or { }).items():
+                if stage not in STAGES:
+                    raise ImageFactoryException("Unknown build stage (%s) in job pool sizes - use one of %s" % (stage, STAGES))
+                self.pool_sizes[stage] = max(int(size), 1)
+            for stage in STAGES:
+                self._start_workers(stage)
+
+    def submit(self, stage, target, kwargs, name, image=None, parameters=None):
+        """
+        Queue target(**kwargs) to run on the pool for stage.
+
+        @param stage One of 'base', 'target' or 'provider'
+        @param target The callable to run
+        @param kwargs Keyword arguments for target
+        @param name Name to give the worker thread while it runs the job
+        @param image The image the job works on, if any
+        @param parameters The build parameters - 'priority', 'tenant' and 'deadline' (seconds
+                          since the epoch or an ISO 8601 date and time) are used if present
+
+        @return The Job, which can be joined like a Thread
+        """
+        if stage not in STAGES:
+            raise ImageFactoryException("Unknown build stage (%s) - use one of %s" % (stage, STAGES))
+        parameters = parameters if parameters else { }
+        try:
+            priority = int(parameters.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ImageFactoryException("Job priority must be an integer, got (%s)" % (parameters.get('priority')))
+        tenant = str(parameters.get('tenant', DEFAULT_TENANT))
+        deadline = self._parse_deadline(parameters.get('deadline'))
+        with self.cond:
+            job = Job(stage, target, kwargs, name, image=image, priority=priority, tenant=tenant,
+                      sequence=next(self._sequence), deadline=deadline)
+            tenant_queue = self.queues[stage].setdefault(tenant, [ ])
+            if not tenant_queue:
+                self.turns[stage].append(tenant)
+            # Kept in submission order - _pick orders them as aging changes priorities
+            tenant_queue.append(job)
+            self._start_workers(stage)
+            self.cond.notify_all()
+        return job
+
+    @staticmethod
+    def _parse_deadline(deadline):
+        if deadline in (None, ''):
+            return None
+        try:
+            return float(deadline)
+        except (TypeError, ValueError):
+            pass
+        try:
+            return datetime.fromisoformat(str(deadline).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            raise ImageFactoryException("Job deadline must be seconds since the epoch or an ISO 8601 date and time, got (%s)" % (deadline))
+
+    def withdraw(self, job):
+        """
+        Take a job that has not been started yet out of its queue.
+
+        @return True if the job was withdrawn, False if it already started or is not queued
+        """
+        if not isinstance(job, Job):
+            return False
+        with self.cond:
+            jobs = self.queues[job.stage].get(job.tenant)
+            if (not jobs) or (job not in jobs):
+                return False
+            jobs.remove(job)
+            if not jobs:
+                del self.queues[job.stage][job.tenant]
+                self.turns[job.stage].remove(job.tenant)
+        return True
+
+    def _start_workers(self, stage):
+        # Caller holds self.cond
+        queued = sum([ len(jobs) for jobs in self.queues[stage].values() ])
+        while (len(self.workers[stage]) < self.pool_sizes[stage]) and (queued > self.idle[stage]):
+            worker = Thread(target=self._work, args=(stage, ), name='%s-worker-%d' % (stage, len(self.workers[stage])))
+            # Must not keep a CLI process alive once the job it waited for is done
+            worker.daemon = True
+            self.workers[stage].append(worker)
+            self.idle[stage] += 1
+            worker.start()
+
+    def _pick(self, stage, queues, turns, now, presorted=False):
+        # Take the next job out of queues - the best rank wins and tenants with a job
+        # of that rank take turns, except that urgent jobs go earliest deadline first.
+        # presorted - each queue is already in order for now, as when simulating.
+        if not queues:
+            return None
+        estimate = self.estimates[stage]
+        if not presorted:
+            for jobs in queues.values():
+                jobs.sort(key=lambda job: job.sort_key(now, self.aging_interval, estimate))
+        best = min([ jobs[0].sort_key(now, self.aging_interval, estimate) for jobs in queues.values() ])
+        if best[0] is False:
+            tenant = [ tenant for tenant, jobs in queues.items()
+                       if jobs[0].sort_key(now, self.aging_interval, estimate) == best ][0]
+            return self._take(queues, turns, tenant)
+        for i in range(len(turns)):
+            tenant = turns[0]
+            turns.rotate(-1)
+            if queues[tenant][0].rank(now, self.aging_interval, estimate) == best[0:2]:
+                return self._take(queues, turns, tenant)
+
+    def _take(self, queues, turns, tenant):
+        job = queues[tenant].pop(0)
+        if not queues[tenant]:
+            del queues[tenant]
+            turns.remove(tenant)
+        return job
+
+    def _work(self, stage):
+        thread = current_thread()
+        worker_name = thread.name
+        while True:
+            with self.cond:
+                job = None
+                while not job:
+                    # Workers beyond a reduced pool size simply stay idle
+                    if len(self.running[stage]) < self.pool_sizes[stage]:
+                        job = self._pick(stage, self.queues[stage], self.turns[stage], time.time())
+                    if not job:
+                        self.cond.wait()
+                self.idle[stage] -= 1
+                self.running[stage].append(job)
+            # Log lines from the job carry its name as they did when each job had its own thread
+            thread.name = job.name
+            try:
+                job.run()
+            except Exception as e:
+                self.log.error("Unhandled exception in %s job (%s)" % (stage, job.name))
+                self.log.exception(e)
+            finally:
+                thread.name = worker_name
+                with self.cond:
+                    self._record_duration(stage, time.time() - job.started_at)
+                    self.running[stage].remove(job)
+                    self.idle[stage] += 1
+                    self.cond.notify_all()
+
+    def _record_duration(self, stage, duration):
+        # Caller holds self.cond
+        self.estimates[stage] = (ESTIMATE_WEIGHT * duration) + ((1 - ESTIMATE_WEIGHT) * self.estimates[stage])
+
+    def _dispatch_order(self, stage, now, until=None):
+        # Caller holds self.cond - the order in which the queued jobs would be started
+        # if nothing else were submitted, worked out on copies of the queues.  Stops
+        # after the job for the image with identifier until.  Nothing ages while
+        # simulating, so each queue is sorted only once.
+        estimate = self.estimates[stage]
+        queues = dict([ (tenant, sorted(jobs, key=lambda job: job.sort_key(now, self.aging_interval, estimate)))
+                        for tenant, jobs in self.queues[stage].items() ])
+        turns = deque(self.turns[stage])
+        order = [ ]
+        job = self._pick(stage, queues, turns, now, presorted=True)
+        while job:
+            order.append(job)
+            if until and job.image and (job.image.identifier == until):
+                break
+            job = self._pick(stage, queues, turns, now, presorted=True)
+        return order
+
+    def queue_estimate(self, image_id):
+        """
+        Work out where the job for image_id stands in its stage's queue.  The start time
+        assumes every job runs for the average duration of its stage and nothing more
+        important is submitted.
+
+        @return A tuple of the 1 based position of the job and when it is expected to
+                start, in seconds since the epoch, or None if no such job is waiting to start
+        """
+        with self.cond:
+            now = time.time()
+            for stage in STAGES:
+                if not any([ job.image and (job.image.identifier == image_id)
+                             for jobs in self.queues[stage].values() for job in jobs ]):
+                    continue
+                order = self._dispatch_order(stage, now, until=image_id)
+                estimate = self.estimates[stage]
+                # A new job starts whenever fewer jobs than the pool size are running
+                ends = sorted([ max(job.started_at + estimate, now) for job in self.running[stage] ])
+                pool_size = self.pool_sizes[stage]
+                slots = ends[-pool_size:] if len(ends) >= pool_size else ends + [ now ] * (pool_size - len(ends))
+                heapq.heapify(slots)
+                for job in order[0:-1]:
+                    heapq.heappush(slots, heapq.heappop(slots) + estimate)
+                return len(order), slots[0]
+        return None
+
+    def queue_position(self, image_id):
+        """
+        @return The 1 based position in its stage's queue of the job for image_id,
+                or None if no such job is waiting to start
+        """
+        estimate = self.queue_estimate(image_id)
+        return estimate[0] if estimate else None
+
+    def predicted_start(self, image_id):
+        """
+        @return When the job for image_id is expected to start, in seconds since the epoch,
+                or None if no such job is waiting to start
+        """
+        estimate = self.queue_estimate(image_id)
+        return estimate[1] if estimate else None
+
+    def stats(self):
+        """
+        @return For each stage the pool size and the number of running and queued jobs
+        """
+        with self.cond:
+            return dict([ (stage, {'pool_size': self.pool_sizes[stage],
+                                   'running': len(self.running[stage]),
+                                   'queued': sum([ len(jobs) for jobs in self.queues[stage].values() ])})
+                          for stage in STAGES ])
@@ -15,73 +15,198 @@
 #   limitations under the License.
 
 import logging
+from collections import deque
+from threading import Condition, Lock, Thread, local
 from .Singleton import Singleton
-from .props import prop
-from collections import defaultdict
-from threading import RLock
+from .ApplicationConfiguration import ApplicationConfiguration
 from .Notification import Notification
 
 class NotificationCenter(Singleton):
-    """ TODO: Docstring for NotificationCenter  """
+    """
+    Delivers notifications to the observers registered for them.
 
-    observers = prop("_observers")
+    Observers are kept in a copy-on-write registry keyed by (message, sender), so
+    posting looks up only the observers that can match and never takes a lock.
+    Observers added as asynchronous are called from a bounded pool of threads
+    instead of the posting thread - each of them still gets its notifications in
+    the order they were posted.
+    """
 
     def _singleton_init(self, *args, **kwargs):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
-        self.observers = defaultdict(set)
-        self.lock = RLock()
+        # (message, id of sender or None) to a tuple of (observer, method, sender, asynchronous).
+        # Replaced, never changed, so that posting can read it without the lock.
+        self.registry = dict()
+        self.lock = Lock()
+        # Asynchronous delivery - (id of observer, method) to the notifications waiting for it
+        self.cond = Condition()
+        self.mailboxes = dict()
+        self.ready = deque()
+        self.queued = 0
+        self.threads = [ ]
+        self.pool_size = None
+        self.queue_size = None
+        self.local = local()
 
-    def add_observer(self, observer, method, message='all', sender=None):
+    @property
+    def observers(self):
         """
-        TODO: Docstring for add_observer
-        
-        @param observer TODO
-        @param method TODO
-        @param message TODO
-        @param sender TODO
+        The registered observers as a dict of message to a set of (observer, method, sender)
         """
-        self.lock.acquire()
-        self.observers[message].add((observer, method, sender))
-        self.lock.release()
+        observers = dict()
+        for (message, sender_key), entries in self.registry.items():
+            observers.setdefault(message, set()).update([ entry[0:3] for entry in entries ])
+        return observers
+
+    def add_observer(self, observer, method, message='all', sender=None, asynchronous=False):
+        """
+        Register an observer for notifications.
+
+        @param observer The object to notify
+        @param method Name of the method of observer called with each Notification
+        @param message The message to observe, 'all' for every message
+        @param sender Only observe notifications from this object, None for any sender
+        @param asynchronous Call the method from the notification threads rather than
+                            the thread posting the notification
+        """
+        key = (message, id(sender) if sender is not None else None)
+        with self.lock:
+            entries = self.registry.get(key, ())
+            if any([ (entry[0] is observer) and (entry[1] == method) and (entry[2] is sender) for entry in entries ]):
+                return
+            registry = dict(self.registry)
+            registry[key] = entries + ((observer, method, sender, asynchronous), )
+            self.registry = registry
 
     def remove_observer(self, observer, method, message='all', sender=None):
         """
-        TODO: Docstring for remove_observer
-        
-        @param observer TODO
-        @param message TODO
-        @param sender TODO
+        Stop notifying an observer.  Notifications already waiting for an
+        asynchronous observer are still delivered.
+
+        @param observer The object notified
+        @param method Name of the method it was registered with
+        @param message The message it was registered for
+        @param sender The sender it was registered for
         """
-        self.lock.acquire()
-        _observer = (observer, method, sender)
-        self.observers[message].discard(_observer)
-        if (len(self.observers[message]) == 0):
-            del self.observers[message]
-        self.lock.release()
+        key = (message, id(sender) if sender is not None else None)
+        with self.lock:
+            entries = self.registry.get(key, ())
+            remaining = tuple([ entry for entry in entries
+                                if not ((entry[0] is observer) and (entry[1] == method) and (entry[2] is sender)) ])
+            if len(remaining) == len(entries):
+                return
+            registry = dict(self.registry)
+            if remaining:
+                registry[key] = remaining
+            else:
+                del registry[key]
+            self.registry = registry
 
     def post_notification(self, notification):
         """
-        TODO: Docstring for post_notification
-        
-        @param notification TODO
+        Deliver a notification to the observers of its message and sender.  An
+        exception raised by one observer is logged and does not keep the others
+        from being notified.
+
+        @param notification The Notification to deliver
         """
-        self.lock.acquire()
-        _observers = self.observers['all'].union(self.observers[notification.message])
-        for _observer in _observers:
-            _sender = _observer[2]
-            if ((not _sender) or (_sender == notification.sender)):
-                try:
-                    getattr(_observer[0], _observer[1])(notification)
-                except AttributeError as e:
-                    self.log.exception('Caught exception: posting notification to object (%s) with method (%s)' % (_observer[0], _observer[1]))
-        self.lock.release()
+        registry = self.registry
+        message = notification.message
+        sender = notification.sender
+        keys = [ ('all', None), (message, None) ]
+        if sender is not None:
+            keys.extend([ ('all', id(sender)), (message, id(sender)) ])
+        matched = [ registry[key] for key in keys if key in registry ]
+        if not matched:
+            return
+        entries = matched[0] if len(matched) == 1 else self._unique(matched)
+        for entry in entries:
+            if (entry[2] is not None) and (entry[2] is not sender):
+                # Registered for another object that happened to have the same id
+                continue
+            if entry[3]:
+                self._post_async(entry, notification)
+            else:
+                self._deliver(entry, notification)
 
     def post_notification_with_info(self, message, sender, user_info=None):
         """
-        TODO: Docstring for post_notification_with_info
-        
-        @param message TODO
-        @param sender TODO
-        @param user_info TODO
+        Create a Notification and deliver it.
+
+        @param message The message of the notification
+        @param sender The object the notification is about
+        @param user_info A dict of details for the observers
         """
         self.post_notification(Notification(message, sender, user_info))
+
+    def _unique(self, matched):
+        # An observer of both 'all' and the message is notified once
+        seen = set()
+        entries = [ ]
+        for entry in [ entry for entries in matched for entry in entries ]:
+            key = (id(entry[0]), entry[1], id(entry[2]))
+            if key not in seen:
+                seen.add(key)
+                entries.append(entry)
+        return entries
+
+    def _deliver(self, entry, notification):
+        try:
+            getattr(entry[0], entry[1])(notification)
+        except Exception as e:
+            self.log.exception('Caught exception: posting notification to object (%s) with method (%s)' % (entry[0], entry[1]))
+
+    def _post_async(self, entry, notification):
+        key = (id(entry[0]), entry[1])
+        with self.cond:
+            if self.pool_size is None:
+                app_config = ApplicationConfiguration().configuration
+                self.pool_size = max(app_config.get('notification_workers', 4), 1)
+                self.queue_size = app_config.get('notification_queue_size', 1000)
+            # Bounded - a poster waits for the observers to catch up, unless it is one
+            # of the notification threads, which must keep going
+            while (self.queued >= self.queue_size) and not getattr(self.local, 'delivering', False):
+                self.cond.wait()
+            mailbox = self.mailboxes.get(key)
+            if mailbox is None:
+                mailbox = self.mailboxes[key] = deque()
+                self.ready.append(key)
+            mailbox.append((entry, notification))
+            self.queued += 1
+            while len(self.threads) < self.pool_size:
+                thread = Thread(target=self._run, name='notification-%d' % (len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.cond.notify_all()
+
+    def _run(self):
+        self.local.delivering = True
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = self.ready.popleft()
+            # Only this thread takes from the mailbox until it is empty, which keeps the
+            # notifications of one observer in order
+            while True:
+                with self.cond:
+                    mailbox = self.mailboxes[key]
+                    if not mailbox:
+                        del self.mailboxes[key]
+                        self.cond.notify_all()
+                        break
+                    entry, notification = mailbox.popleft()
+                    self.queued -= 1
+                    self.cond.notify_all()
+                self._deliver(entry, notification)
+
+    def wait_for_delivery(self, timeout=None):
+        """
+        Block until every notification posted to asynchronous observers so far has
+        been delivered.
+
+        @return False if the timeout expired first
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.mailboxes, timeout)
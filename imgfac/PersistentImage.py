@@ -17,16 +17,71 @@
 from .props import prop
 import uuid
 import logging
+import time
+import heapq
+import itertools
+from threading import Lock, Condition, Thread
 from .Notification import Notification
 from .NotificationCenter import NotificationCenter
+from .ApplicationConfiguration import ApplicationConfiguration
+from .Singleton import Singleton
 
 
+# checkpoints - stages of the build already done, so an interrupted build can carry on from there
+# farm_node - the worker of the build farm that built the image and holds its body, if not this factory
 METADATA = ('identifier', 'data', 'template', 'icicle', 'status_detail', 'status', 'percent_complete', 'parameters',
-            'properties')
+            'properties', 'checkpoints', 'farm_node')
 STATUS_STRINGS = ('NEW', 'PENDING', 'BUILDING', 'COMPLETE', 'FAILED', 'DELETING', 'DELETED', 'DELETEFAILED')
 NOTIFICATIONS = ('image.status', 'image.percentage')
 
 
+def percentage_interval():
+    """
+    Least number of seconds between two 'image.percentage' notifications of an image, from
+    percentage_notifications_per_second in the configuration.  0 when no configuration has
+    been loaded, as when the images are used as a library.
+    """
+    if ApplicationConfiguration._instance is None:
+        return 0
+    rate = ApplicationConfiguration().configuration.get('percentage_notifications_per_second', 0)
+    return (1.0 / rate) if rate else 0
+
+
+class PercentageFlusher(Singleton):
+    """
+    Posts the percentages held back by the rate limit of each image once their interval is
+    up.  One thread serves every image.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.condition = Condition()
+        # (due, sequence, image) - the sequence keeps images from being compared
+        self.due = [ ]
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def schedule(self, image, due):
+        with self.condition:
+            heapq.heappush(self.due, (due, next(self.sequence), image))
+            if not self.thread:
+                self.thread = Thread(target=self._run, name='percentage-flusher')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.due or self.due[0][0] > time.time():
+                    self.condition.wait((self.due[0][0] - time.time()) if self.due else None)
+                due, sequence, image = heapq.heappop(self.due)
+            try:
+                image._flush_percentage(due)
+            except Exception as e:
+                self.log.exception("Failed to post the percentage of image (%s): %s" % (image.identifier, e))
+
+
 class PersistentImage(object):
     """ TODO: Docstring for PersistentImage  """
 
@@ -39,6 +94,8 @@ class PersistentImage(object):
     status_detail = prop("_status_detail")
     parameters = prop("_parameters")
     properties = prop("_properties")
+    checkpoints = prop("_checkpoints")
+    farm_node = prop("_farm_node")
 
     def status():
         doc = "A string value."
@@ -54,6 +111,8 @@ class PersistentImage(object):
             if value in STATUS_STRINGS:
                 old_value = self._status
                 self._status = value
+                # Observers see the progress made before the status changed
+                self._flush_percentage()
                 notification = Notification(message=NOTIFICATIONS[0],
                                             sender=self,
                                             user_info=dict(old_status=old_value, new_status=value))
@@ -76,15 +135,46 @@ class PersistentImage(object):
                 # Do not update or send a notification if nothing has changed
                 return
             self._percent_complete = value
-            notification = Notification(message=NOTIFICATIONS[1],
-                                        sender=self,
-                                        user_info=dict(old_percentage=old_value, new_percentage=value))
-            self.notification_center.post_notification(notification)
+            if self.percentage_interval:
+                with self._percentage_lock:
+                    if self._percentage_due:
+                        # Posted by the flusher when due
+                        return
+                    due = self._percentage_posted_at + self.percentage_interval
+                    if due > time.time():
+                        self._percentage_last_posted = old_value
+                        self._percentage_due = due
+                    else:
+                        due = None
+                        self._percentage_posted_at = time.time()
+                if due:
+                    PercentageFlusher().schedule(self, due)
+                    return
+            self._post_percentage(old_value, value)
 
         return locals()
     percent_complete = property(**percent_complete())
 ##### End PROPERTIES
 
+    def _post_percentage(self, old_value, value):
+        notification = Notification(message=NOTIFICATIONS[1],
+                                    sender=self,
+                                    user_info=dict(old_percentage=old_value, new_percentage=value))
+        self.notification_center.post_notification(notification)
+
+    def _flush_percentage(self, due=None):
+        # Post the percentage held back by the rate limit, if there is one.  The flusher
+        # passes the due time it was scheduled for, so a stale entry flushes nothing newer.
+        with self._percentage_lock:
+            if not self._percentage_due or (due and due != self._percentage_due):
+                return
+            self._percentage_due = None
+            old_value = self._percentage_last_posted
+            self._percentage_posted_at = time.time()
+        value = self._percent_complete
+        if value != old_value:
+            self._post_percentage(old_value, value)
+
     def __init__(self, image_id=None):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.notification_center = NotificationCenter()
@@ -101,9 +191,19 @@ class PersistentImage(object):
         # Setting these to None or setting initial value via the properties breaks the prop code above
         self._status = "NEW"
         self._percent_complete = 0
+        # Rate limiting of percentage notifications - the least number of seconds between two,
+        # 0 to post every change.  Changes in between are coalesced and the newest posted when
+        # the interval is up.  Kept are the value last posted, when, and when the newest is due.
+        self.percentage_interval = percentage_interval()
+        self._percentage_lock = Lock()
+        self._percentage_last_posted = None
+        self._percentage_posted_at = 0
+        self._percentage_due = None
         self.icicle = None
         self.parameters = {}
         self.properties = {}
+        self.checkpoints = {}
+        self.farm_node = None
 
     def update(self, percentage=None, status=None, detail=None, error=None):
         if percentage:
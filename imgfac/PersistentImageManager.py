@@ -15,13 +15,22 @@
 #   limitations under the License.
 
 from .ApplicationConfiguration import ApplicationConfiguration
+from .ImageFactoryException import ImageFactoryException
 import importlib
+import os.path
+
+# Restored straight into the backing attributes - going through the properties would
+# post change notifications for what is only a reload from storage
+QUIET_PROPERTIES = {'status': '_status', 'percent_complete': '_percent_complete'}
 
 class PersistentImageManager(object):
     """ Abstract base class for the Persistence managers  """
 
 
     _default_manager = None
+    _image_classes = { }
+    # A BlobStore if the manager deduplicates image bodies
+    blob_store = None
 
     @classmethod
     def default_manager(cls):
@@ -39,6 +48,39 @@ class PersistentImageManager(object):
     def __init__(self, storage_path = None):
         raise NotImplementedError("PersistentImageManager is an abstract class.  You must instantiate a real manager.")
 
+    def _image_from_metadata(self, metadata):
+        # Given the retrieved metadata, return a PersistentImage type object
+        # with us as the persistent_manager.
+
+        image_class = self._image_classes.get(metadata['type'])
+        if not image_class:
+            image_module = importlib.import_module( ".." + metadata['type'], __name__)
+            image_class = getattr(image_module, metadata['type'])
+            self._image_classes[metadata['type']] = image_class
+        image = image_class(metadata['identifier'])
+
+        # We don't actually want a 'type' property in the resulting PersistentImage object
+        del metadata['type']
+
+        for key in image.metadata().union(list(metadata.keys())):
+            setattr(image, QUIET_PROPERTIES.get(key, key), metadata.get(key))
+
+        #set ourselves as the manager
+        image.persistent_manager = self
+
+        return image
+
+    def _store_body(self, meta):
+        # Bodies only stop changing once the image is complete.  Hashing a large body
+        # takes a while, so it is left to the blob store's thread and the COMPLETE
+        # status is not held up by it - the image keeps its own copy until then.
+        if (not self.blob_store) or (meta.get('status') != 'COMPLETE'):
+            return
+        body_path = meta.get('data')
+        if (not body_path) or (not os.path.isfile(body_path)) or (os.path.getsize(body_path) == 0):
+            return
+        self.blob_store.ingest_later(meta['identifier'], body_path)
+
     def image_with_id(self, image_id):
         """
         TODO: Docstring for image_with_id
@@ -59,6 +101,35 @@ class PersistentImageManager(object):
         """
         raise NotImplementedError("images_from_query() not implemented - cannot continue")
 
+    def metadata_from_query(self, query, fields=None, offset=0, limit=None, after=None,
+                            modified_after=None, modified_before=None):
+        """
+        Iterate over the metadata of the images matching query, ordered by identifier.
+        Managers should override this to push the paging and filtering down into their
+        storage - this fallback loads every match through images_from_query().
+
+        @param query Dict of metadata key/value pairs that must all match
+        @param fields If given, only these metadata keys (plus type and identifier) are returned
+        @param offset Number of matches to skip
+        @param limit Maximum number of matches to return
+        @param after Only return images whose identifier sorts after this one
+        @param modified_after Only images last saved at or after this time (seconds since the epoch)
+        @param modified_before Only images last saved before this time (seconds since the epoch)
+
+        @return A generator of metadata dicts
+        """
+        if (modified_after is not None) or (modified_before is not None):
+            raise ImageFactoryException("%s does not support filtering on modification time" % (self.__class__.__name__))
+        images = sorted(self.images_from_query(query), key=lambda image: image.identifier)
+        if after is not None:
+            images = [ image for image in images if image.identifier > after ]
+        end = (offset + limit) if limit is not None else None
+        for image in images[offset:end]:
+            keys = image.metadata() if fields is None else set(fields).union(('identifier',))
+            metadata = dict([ (key, getattr(image, key, None)) for key in keys ])
+            metadata['type'] = type(image).__name__
+            yield metadata
+
 
     def add_image(self, image):
         """
@@ -119,6 +119,13 @@ class PluginManager(Singleton):
                     fp.close()
                 return metadata
 
+    def registered_targets(self):
+        """
+        @return The targets a plugin is registered for, each a list as in the
+        plugin's .info file
+        """
+        return [ list(target) if isinstance(target, tuple) else [ target ] for target in self._targets ]
+
     def plugin_for_target(self, target):
         """
         Looks up the plugin for a given target and returns an instance of the 
@@ -18,7 +18,8 @@ from .PersistentImage import PersistentImage
 from .props import prop
 
 
-METADATA = ('target_image_id', 'provider', 'identifier_on_provider', 'provider_account_identifier', 'parameters')
+# alias_of - the image whose push this one shares, if it joined an identical push in progress
+METADATA = ('target_image_id', 'provider', 'identifier_on_provider', 'provider_account_identifier', 'parameters', 'alias_of')
 
 class ProviderImage(PersistentImage):
     """ TODO: Docstring for ProviderImage  """
@@ -28,6 +29,7 @@ class ProviderImage(PersistentImage):
     identifier_on_provider = prop("_identifier_on_provider")
     provider_account_identifier = prop("_provider_account_identifier")
     credentials = prop("_credentials")
+    alias_of = prop("_alias_of")
     parameters = prop("_parameters")
 
     def __init__(self, image_id=None):
@@ -43,6 +45,7 @@ class ProviderImage(PersistentImage):
         self.provider_account_identifier = None
         self.credentials = None
         self.parameters = None
+        self.alias_of = None
 
     def metadata(self):
         self.log.debug("Executing metadata in class (%s) my metadata is (%s)" % (self.__class__, METADATA))
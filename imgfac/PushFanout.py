@@ -0,0 +1,127 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+from collections import deque
+from threading import Lock, Event
+
+
+class PushFanout(object):
+    """
+    Pushes one TargetImage to several providers, each push with its own Builder and
+    ProviderImage.
+
+    At most parallelism pushes are handed to the provider job pool at a time - the
+    rest wait here, PENDING, without holding a pool worker.  Work that all pushes
+    would repeat is done once: before its first push starts the cloud plugin's
+    optional prepare_push_to_providers(builder, target, parameters) is called, and
+    later pushes go ahead only once it has succeeded.
+    """
+
+    def __init__(self, parallelism=4):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.parallelism = max(int(parallelism), 1)
+        self.lock = Lock()
+        self.pending = deque()
+        self.running = 0
+        self.prepare_lock = Lock()
+        self.prepared = False
+        self.done = Event()
+        self.done.set()
+
+    def enqueue(self, builder, kwargs, parameters):
+        """
+        Queue builder._push_image_to_provider(**kwargs), to be submitted to the
+        provider pool once one of our slots is free.
+        """
+        with self.lock:
+            self.done.clear()
+            self.pending.append((builder, kwargs, parameters))
+            ready = self._take_ready()
+        # Submitting saves the image and posts notifications - not done holding the lock
+        self._submit(ready)
+
+    def _take_ready(self):
+        # Caller holds self.lock - the pending pushes that now have a slot
+        ready = [ ]
+        while self.pending and (self.running < self.parallelism):
+            ready.append(self.pending.popleft())
+            self.running += 1
+        return ready
+
+    def _submit(self, ready):
+        for builder, kwargs, parameters in ready:
+            try:
+                builder.push_thread = builder._submit_job('provider', builder.provider_image, self._run,
+                                                          {'builder': builder, 'kwargs': kwargs}, parameters)
+            except:
+                self._finished()
+                raise
+
+    def _run(self, builder, kwargs):
+        try:
+            builder._push_image_to_provider(**kwargs)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self.lock:
+            self.running -= 1
+            ready = self._take_ready()
+            if (not self.running) and (not self.pending):
+                self.done.set()
+        self._submit(ready)
+
+    def is_pending(self, builder):
+        """
+        @return True if a push of builder is waiting here for a slot
+        """
+        with self.lock:
+            return any([ entry[0] is builder for entry in self.pending ])
+
+    def withdraw(self, builder):
+        """
+        Take the pushes of builder that are still waiting for a slot out of the queue.
+
+        @return The kwargs of each push withdrawn
+        """
+        with self.lock:
+            withdrawn = [ entry for entry in self.pending if entry[0] is builder ]
+            for entry in withdrawn:
+                self.pending.remove(entry)
+            if (not self.running) and (not self.pending):
+                self.done.set()
+        return [ kwargs for builder, kwargs, parameters in withdrawn ]
+
+    def prepare(self, cloud_plugin, builder, target, parameters):
+        """
+        Called by each push once its cloud plugin is known.  Runs the plugin's
+        preparation the first time only - if it fails the next push tries again.
+        """
+        hook = getattr(cloud_plugin, 'prepare_push_to_providers', None)
+        if not hook:
+            return
+        with self.prepare_lock:
+            if not self.prepared:
+                self.log.debug("Preparing TargetImage (%s) for all pushes" % (builder.target_image.identifier))
+                hook(builder, target, parameters)
+                self.prepared = True
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued push has finished.
+        """
+        return self.done.wait(timeout)
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from contextlib import contextmanager
+from threading import Condition, Lock
+from zlib import crc32
+
+
+class ReadWriteLock(object):
+    """
+    A lock allowing any number of concurrent readers or a single writer.
+
+    Waiting writers take precedence over newly arriving readers so that a steady
+    stream of readers cannot starve a writer.
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release_write()
+
+
+class StripedReadWriteLock(object):
+    """
+    A fixed set of ReadWriteLocks selected by hashing a key.
+
+    Operations on different keys usually proceed in parallel while the memory used
+    stays constant no matter how many keys are seen.
+    """
+
+    def __init__(self, stripes=64):
+        self._locks = [ ReadWriteLock() for i in range(stripes) ]
+
+    def lock_for(self, key):
+        """
+        @param key A string identifying the protected resource
+
+        @return The ReadWriteLock guarding key
+        """
+        return self._locks[crc32(key.encode('utf-8')) % len(self._locks)]
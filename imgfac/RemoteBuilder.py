@@ -0,0 +1,193 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import uuid
+from threading import Thread
+from .Builder import Builder
+from .BaseImage import BaseImage
+from .TargetImage import TargetImage
+from .ProviderImage import ProviderImage
+from .ImageFactoryException import ImageFactoryException
+
+FINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
+# Handled by this factory, which reports on the image itself
+LOCAL_PARAMETERS = ('callbacks', )
+
+
+class RemoteBuilder(Builder):
+    """
+    Builds images on a worker of the build farm instead of in this process.
+
+    Each image gets a record here with the worker in farm_node and the same
+    identifier as on the worker.  The FarmCoordinator follows the build there and
+    copies its progress into this record, so notifications, callbacks and anything
+    waiting on the image see it like any image built here.
+    """
+
+    def __init__(self, coordinator, worker_id):
+        super(RemoteBuilder, self).__init__()
+        self.coordinator = coordinator
+        self.worker_id = worker_id
+
+    def is_building(self):
+        return super(RemoteBuilder, self).is_building() or \
+               any([ image and self.coordinator.is_following(image.identifier)
+                     for image in (self.base_image, self.target_image, self.provider_image) ])
+
+    def abort(self):
+        # Nothing runs here.  The worker carries on and the build is followed again
+        # when this factory restarts.
+        pass
+
+    def cancel(self, reason='Cancelled by request'):
+        unfinished = [ image for image in (self.base_image, self.target_image, self.provider_image)
+                       if image and (image.status in ('NEW', 'PENDING', 'BUILDING')) ]
+        if (not unfinished) or (not self.cancellation.cancel(reason)):
+            return False
+        self.log.info("Cancelling build of image(s) %s on worker (%s): %s" % ([ image.identifier for image in unfinished ],
+                                                                             self.worker_id, reason))
+        for image in unfinished:
+            # Images not dispatched yet fail on the cancelled token before they are
+            if self.coordinator.is_following(image.identifier):
+                self._cancel_remote(image)
+        return True
+
+    def _cancel_remote(self, image):
+        try:
+            self.coordinator.cancel(image)
+        except Exception as e:
+            self.log.warning("Unable to cancel the build of image (%s) on worker (%s): %s" % (image.identifier, self.worker_id, e))
+
+##### DISPATCH
+    def _start(self, image, request, parameters, callbackworkers, input_image=None, after=None):
+        image.farm_node = self.worker_id
+        if parameters:
+            image.parameters = parameters
+        self.pim.add_image(image)
+        if parameters and ('callbacks' in parameters):
+            # This ensures we have workers in place before any potential state changes
+            self._init_callback_workers(image, parameters['callbacks'], callbackworkers)
+        image.status_detail = {'activity': 'Sending build to worker (%s)' % (self.worker_id), 'error': None}
+        image.status = 'PENDING'
+        self.pim.save_image(image)
+        request['parameters'] = dict([ (key, value) for key, value in (parameters or { }).items() if key not in LOCAL_PARAMETERS ])
+        thread = Thread(target=self._dispatch, name=str(uuid.uuid4())[0:8],
+                        args=(image, request, callbackworkers, input_image, after))
+        thread.start()
+        return thread
+
+    def _dispatch(self, image, request, callbackworkers, input_image, after):
+        try:
+            if after:
+                # The input is dispatched to the same worker by this builder - it must get there first
+                after.join()
+            if input_image and (getattr(input_image, 'farm_node', None) != self.worker_id):
+                # The worker fetches the input, so it has to be complete first
+                if input_image.status not in FINAL_STATUSES:
+                    input_image = self._wait_for_final_status(input_image)
+                if input_image.status != 'COMPLETE':
+                    raise ImageFactoryException("The %s (%s) this image is built from has failed its build.  Cannot continue." %
+                                                (type(input_image).__name__, input_image.identifier))
+                request['farm_inputs'] = [ self.coordinator.input_spec(input_image) ]
+            self.cancellation.check()
+            self.coordinator.dispatch(self.worker_id, image, request)
+            image.status_detail = {'activity': 'Building on worker (%s)' % (self.worker_id), 'error': None}
+            self.pim.save_image(image)
+            self.coordinator.follow(image, finished=lambda image: self._shutdown_callback_workers(image, callbackworkers))
+            if self.cancellation.cancelled:
+                # Cancelled while the request was on its way
+                self._cancel_remote(image)
+        except Exception as e:
+            image.status_detail = self._failure_detail('Sending build to worker (%s) failed with exception.' % (self.worker_id), e)
+            image.status = 'FAILED'
+            self.pim.save_image(image)
+            self.log.error("Exception encountered in _dispatch thread")
+            self.log.exception(e)
+            self._shutdown_callback_workers(image, callbackworkers)
+
+##### BUILD IMAGE
+    def build_image_from_template(self, template, parameters=None, my_image_id=None):
+        self.base_image = BaseImage(image_id=my_image_id)
+        self.base_image.template = template
+        self.base_thread = self._start(self.base_image, {'template': template}, parameters, self._base_image_cbws)
+
+##### CUSTOMIZE IMAGE FOR TARGET
+    def customize_image_for_target(self, target, image_id=None, template=None, parameters=None, my_image_id=None):
+        if template and image_id:
+            raise ImageFactoryException("Must specify either a template or a BaseImage ID, not both")
+        elif image_id:
+            self.base_image = self.pim.image_with_id(image_id)
+            if not self.base_image:
+                raise ImageFactoryException("Unable to retrieve base image with id (%s) from storage" % (image_id))
+            template = self.base_image.template
+        elif template:
+            # Built on the same worker, which then has the body at hand
+            self.build_image_from_template(template, parameters)
+            image_id = self.base_image.identifier
+        else:
+            raise ImageFactoryException("Asked to create a TargetImage without a BaseImage or a template")
+        self.target_image = TargetImage(image_id=my_image_id)
+        self.target_image.target = target
+        self.target_image.base_image_id = image_id
+        self.target_image.template = template
+        self.target_thread = self._start(self.target_image, {'target': target, 'base_image_id': image_id}, parameters,
+                                         self._target_image_cbws, input_image=self.base_image, after=self.base_thread)
+
+##### CREATE PROVIDER IMAGE
+    def create_image_on_provider(self, provider, credentials, target, image_id=None, template=None, parameters=None, my_image_id=None):
+        request = {'provider': provider, 'credentials': credentials, 'target': target}
+        if parameters and parameters.get('snapshot', False):
+            if not template:
+                raise ImageFactoryException("Must specify a template when requesting a snapshot-style build")
+            request['template'] = template
+        elif template and image_id:
+            raise ImageFactoryException("Must specify either a template or a TargetImage ID, not both")
+        elif image_id:
+            self.target_image = self.pim.image_with_id(image_id)
+            if not self.target_image:
+                raise ImageFactoryException("Unable to retrieve target image with id (%s) from storage" % (image_id))
+            template = self.target_image.template
+            request['target_image_id'] = image_id
+        elif template:
+            self.customize_image_for_target(target, None, template, parameters)
+            image_id = self.target_image.identifier
+            request['target_image_id'] = image_id
+        else:
+            raise ImageFactoryException("Asked to create a ProviderImage without a TargetImage or a template")
+        self.provider_image = ProviderImage(image_id=my_image_id)
+        self.provider_image.provider = provider
+        self.provider_image.target_image_id = image_id
+        self.provider_image.template = template
+        self.push_thread = self._start(self.provider_image, request, parameters, self._provider_image_cbws,
+                                       input_image=self.target_image if image_id else None, after=self.target_thread)
+
+##### RESUME INTERRUPTED BUILDS
+    def follow_image(self, image):
+        """
+        Carry on following the build of an image on its worker after a restart of
+        this factory.
+
+        @param image The image as loaded from storage
+        """
+        if type(image).__name__ == 'BaseImage':
+            self.base_image, callbackworkers = image, self._base_image_cbws
+        elif type(image).__name__ == 'TargetImage':
+            self.target_image, callbackworkers = image, self._target_image_cbws
+        else:
+            self.provider_image, callbackworkers = image, self._provider_image_cbws
+        if image.parameters and ('callbacks' in image.parameters):
+            self._init_callback_workers(image, image.parameters['callbacks'], callbackworkers)
+        self.coordinator.follow(image, finished=lambda image: self._shutdown_callback_workers(image, callbackworkers))
@@ -15,8 +15,10 @@
 import logging
 import os
 import os.path
+import time
 from imgfac.ApplicationConfiguration import ApplicationConfiguration
-from threading import BoundedSemaphore
+from imgfac.ImageFactoryException import ImageFactoryException
+from threading import BoundedSemaphore, Condition
 
 class ReservationManager(object):
     """ TODO: Docstring for ReservationManager """
@@ -27,6 +29,9 @@ class ReservationManager(object):
     MIN_PORT = 1025
     MAX_PORT = 65535
 
+    # Disk space is not released through us, so waiting admissions re-check it this often
+    ADMISSION_RECHECK_INTERVAL = 30
+
     ### Properties
     def default_minimum():
         """The property default_minimum"""
@@ -53,6 +58,20 @@ class ReservationManager(object):
             reservations.update(self._mounts[key]['reservations'])
         return reservations
 
+    @property
+    def resource_budgets(self):
+        """Dictionary of the memory (MB) and vCPU budgets with what is reserved and available,
+        the admitted reservations and the number of builds waiting for admission."""
+        with self._admission:
+            budgets = dict()
+            for resource in ('memory_mb', 'cpus'):
+                budgets[resource] = {'total': self._budget[resource],
+                                     'reserved': self._reserved[resource],
+                                     'available': self._budget[resource] - self._reserved[resource]}
+            budgets['admitted'] = dict([ (key, dict(reservation)) for key, reservation in self._admitted.items() ])
+            budgets['waiting'] = self._waiting
+            return budgets
+
     @property
     def queues(self):
         """The property queues"""
@@ -75,6 +94,14 @@ class ReservationManager(object):
             # TODO: This is TinMan/Oz specific - move it to the plugin
             i._listen_port = cls.MIN_PORT + (os.getpid() % (cls.MAX_PORT - cls.MIN_PORT))
             i._listen_port_lock = BoundedSemaphore()
+            # Memory and vCPU budgets for guests we launch - default to the whole host
+            budgets = i.appconfig.get('resource_budgets') or { }
+            i._budget = {'memory_mb': int(budgets.get('memory_mb', cls._host_memory_mb())),
+                         'cpus': int(budgets.get('cpus', os.cpu_count() or 1))}
+            i._reserved = {'memory_mb': 0, 'cpus': 0}
+            i._admitted = { }
+            i._waiting = 0
+            i._admission = Condition()
             cls.instance = i
         return cls.instance
 
@@ -84,6 +111,105 @@ class ReservationManager(object):
         """
         pass
 
+    @staticmethod
+    def _host_memory_mb():
+        try:
+            return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) // (1024 * 1024)
+        except (ValueError, OSError, AttributeError):
+            return 4096
+
+    def _fits(self, memory_mb, cpus, disk_bytes, disk_path):
+        # Caller holds self._admission
+        if (self._reserved['memory_mb'] + memory_mb) > self._budget['memory_mb']:
+            return False
+        if (self._reserved['cpus'] + cpus) > self._budget['cpus']:
+            return False
+        if disk_bytes and not self.reserve_space_for_file(disk_bytes, disk_path):
+            return False
+        return True
+
+    def _wake_admission(self):
+        with self._admission:
+            self._admission.notify_all()
+
+    def admit(self, key, memory_mb=0, cpus=0, disk_bytes=0, disk_path=None, timeout=None, cancellation=None):
+        """
+        Reserve memory, vCPUs and disk space for a build, all or nothing.  Blocks until
+        the whole request fits in the budgets.
+
+        @param key Identifies the reservation, normally the image identifier
+        @param memory_mb Guest memory in MB
+        @param cpus Guest vCPUs
+        @param disk_bytes Disk space needed for the file at disk_path
+        @param disk_path The file the disk space is for
+        @param timeout Give up after this many seconds - None waits forever
+        @param cancellation Optional CancellationToken - BuildCancelled is raised as soon as it is cancelled
+
+        @return True once admitted, False if the timeout expired first
+        """
+        if (memory_mb > self._budget['memory_mb']) or (cpus > self._budget['cpus']):
+            raise ImageFactoryException("Build (%s) needs %d MB and %d vCPUs, more than the total budget of %d MB and %d vCPUs" %
+                                        (key, memory_mb, cpus, self._budget['memory_mb'], self._budget['cpus']))
+        if disk_bytes and not disk_path:
+            raise ImageFactoryException("A disk reservation needs the path of the file it is for")
+        deadline = (time.time() + timeout) if timeout is not None else None
+        if cancellation:
+            cancellation.on_cancel(self._wake_admission)
+        try:
+            return self._admit(key, memory_mb, cpus, disk_bytes, disk_path, deadline, cancellation)
+        finally:
+            if cancellation:
+                cancellation.remove(self._wake_admission)
+
+    def _admit(self, key, memory_mb, cpus, disk_bytes, disk_path, deadline, cancellation):
+        with self._admission:
+            if key in self._admitted:
+                raise ImageFactoryException("Resources are already reserved for (%s)" % (key))
+            self._waiting += 1
+            try:
+                while not self._fits(memory_mb, cpus, disk_bytes, disk_path):
+                    # Checked under the lock so a cancellation cannot slip in before the wait
+                    if cancellation:
+                        cancellation.check()
+                    wait = self.ADMISSION_RECHECK_INTERVAL
+                    if deadline is not None:
+                        wait = min(wait, deadline - time.time())
+                        if wait <= 0:
+                            return False
+                    self.log.debug("Waiting for %d MB, %d vCPUs and %d bytes of disk for (%s)" % (memory_mb, cpus, disk_bytes, key))
+                    self._admission.wait(wait)
+            finally:
+                self._waiting -= 1
+            self._reserved['memory_mb'] += memory_mb
+            self._reserved['cpus'] += cpus
+            self._admitted[key] = {'memory_mb': memory_mb, 'cpus': cpus, 'disk_bytes': disk_bytes, 'disk_path': disk_path}
+            self.log.debug("Admitted (%s) with %d MB, %d vCPUs and %d bytes of disk" % (key, memory_mb, cpus, disk_bytes))
+            return True
+
+    def release(self, key):
+        """
+        Return everything reserved by admit() for key to the budgets.
+        """
+        with self._admission:
+            reservation = self._admitted.pop(key, None)
+            if not reservation:
+                self.log.warn('No admitted reservation for %s to release!' % key)
+                return
+            self._reserved['memory_mb'] -= reservation['memory_mb']
+            self._reserved['cpus'] -= reservation['cpus']
+            if reservation['disk_bytes']:
+                self.cancel_reservation_for_file(reservation['disk_path'])
+            self._admission.notify_all()
+
+    @staticmethod
+    def guest_resources(guest):
+        """
+        @param guest An Oz guest object
+
+        @return Tuple of the memory in MB and the vCPUs the guest will be started with
+        """
+        return (int(getattr(guest, 'install_memory', 1024) or 1024), int(getattr(guest, 'install_cpus', 1) or 1))
+
     def get_next_listen_port(self):
         self._listen_port_lock.acquire()
         try:
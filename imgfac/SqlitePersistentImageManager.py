@@ -0,0 +1,294 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import re
+import stat
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from threading import local, Lock
+from .props import prop
+from .ImageFactoryException import ImageFactoryException
+from .PersistentImageManager import PersistentImageManager
+from .BlobStore import BlobStore
+
+STORAGE_PATH = '/var/lib/imagefactory/storage'
+DATABASE_NAME = 'images.sqlite'
+BODY_EXT = '.body'
+# Metadata keys that get a real, indexed column - everything else is reachable
+# through the JSON blob
+COLUMNS = ('identifier', 'type', 'status', 'base_image_id', 'target_image_id', 'target', 'provider')
+INDEXED_COLUMNS = ('type', 'status', 'base_image_id', 'target_image_id')
+# Keys we are willing to build an expression index for on first use
+JSON_KEY_REGEX = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class SqlitePersistentImageManager(PersistentImageManager):
+    """
+    PersistentImageManager keeping image metadata in a SQLite database in WAL mode.
+
+    Select with "image_manager": "sqlite" in imagefactory.conf.  Image bodies are
+    kept as files in storage_path exactly as with the file based manager.
+    """
+
+    storage_path = prop("_storage_path")
+
+    def __init__(self, storage_path=STORAGE_PATH, database=None, busy_timeout=30, dedupe_bodies=False):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        if not os.path.exists(storage_path):
+            self.log.debug("Creating directory (%s) for persistent storage" % (storage_path))
+            os.makedirs(storage_path)
+            os.chmod(storage_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+        elif not os.path.isdir(storage_path):
+            raise ImageFactoryException("Storage location (%s) already exists and is not a directory - cannot init persistence" % (storage_path))
+        self.storage_path = storage_path
+        self.database = database if database else os.path.join(storage_path, DATABASE_NAME)
+        self.busy_timeout = busy_timeout
+        # One connection per thread - WAL lets readers proceed while another connection writes
+        self._local = local()
+        self._json_indexes = set()
+        self._json_indexes_lock = Lock()
+        self._create_schema()
+        if dedupe_bodies:
+            self.blob_store = BlobStore(storage_path)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.batch_depth = 0
+            # Bodies of images saved in the current batch, deduplicated once it is committed
+            self._local.deferred_bodies = [ ]
+        return conn
+
+    def _create_schema(self):
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS images (identifier TEXT PRIMARY KEY, type TEXT NOT NULL, '
+                     'status TEXT, base_image_id TEXT, target_image_id TEXT, target TEXT, provider TEXT, '
+                     'created REAL, modified REAL, metadata TEXT NOT NULL)')
+        for column in INDEXED_COLUMNS:
+            conn.execute('CREATE INDEX IF NOT EXISTS images_%s ON images (%s)' % (column, column))
+
+    def _ensure_json_index(self, key):
+        if key in self._json_indexes:
+            return
+        with self._json_indexes_lock:
+            if key not in self._json_indexes:
+                self._connection().execute('CREATE INDEX IF NOT EXISTS images_json_%s ON images '
+                                           '(json_extract(metadata, \'$.%s\'))' % (key, key))
+                self._json_indexes.add(key)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group any saves made by this thread inside the with block into one transaction.
+        """
+        conn = self._connection()
+        if self._local.batch_depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.batch_depth += 1
+        try:
+            yield self
+        except:
+            self._local.batch_depth -= 1
+            if self._local.batch_depth == 0:
+                conn.execute('ROLLBACK')
+                self._local.deferred_bodies = [ ]
+            raise
+        else:
+            self._local.batch_depth -= 1
+            if self._local.batch_depth == 0:
+                conn.execute('COMMIT')
+                # Hashing a body can take minutes - never while holding the write lock
+                deferred_bodies, self._local.deferred_bodies = self._local.deferred_bodies, [ ]
+                for meta in deferred_bodies:
+                    self._store_body(meta)
+
+    def _metadata_for_image(self, image):
+        meta = {'type': type(image).__name__}
+        for mdprop in image.metadata():
+            meta[mdprop] = getattr(image, mdprop, None)
+        return meta
+
+    def _write_metadata(self, meta, insert=False):
+        columns = [ meta.get(column) for column in COLUMNS ]
+        now = time.time()
+        with self.batch():
+            conn = self._connection()
+            if insert:
+                conn.execute('INSERT INTO images (%s, created, modified, metadata) VALUES (%s)' %
+                             (', '.join(COLUMNS), ', '.join('?' * (len(COLUMNS) + 3))),
+                             columns + [ now, now, json.dumps(meta) ])
+            else:
+                cursor = conn.execute('UPDATE images SET %s, modified = ?, metadata = ? WHERE identifier = ?' %
+                                      (', '.join([ '%s = ?' % column for column in COLUMNS ])),
+                                      columns + [ now, json.dumps(meta), meta['identifier'] ])
+                if cursor.rowcount == 0:
+                    raise ImageFactoryException('Image %s not managed, use "add_image()" first.' % meta['identifier'])
+
+    def image_with_id(self, image_id):
+        """
+        Retrieve an image by its identifier.
+
+        @param image_id The image identifier
+
+        @return The image or None if it does not exist
+        """
+        row = self._connection().execute('SELECT metadata FROM images WHERE identifier = ?', (image_id,)).fetchone()
+        if not row:
+            return None
+        return self._image_from_metadata(json.loads(row[0]))
+
+    def images_from_query(self, query):
+        """
+        Retrieve all images whose metadata equals every key/value pair in query.
+
+        @param query A dict of metadata keys and values
+
+        @return A list of images
+        """
+        return [ self._image_from_metadata(metadata) for metadata in self.metadata_from_query(query) ]
+
+    def metadata_from_query(self, query, fields=None, offset=0, limit=None, after=None,
+                            modified_after=None, modified_before=None):
+        clauses = [ ]
+        values = [ ]
+        unchecked = { }
+        for key, value in query.items():
+            if key in COLUMNS:
+                expression = key
+            elif JSON_KEY_REGEX.match(key):
+                self._ensure_json_index(key)
+                expression = 'json_extract(metadata, \'$.%s\')' % key
+            else:
+                unchecked[key] = value
+                continue
+            if value is None:
+                clauses.append('%s IS NULL' % expression)
+            elif isinstance(value, (str, int, float)):
+                clauses.append('%s = ?' % expression)
+                values.append(value)
+            else:
+                # Lists and dicts are compared after decoding
+                unchecked[key] = value
+        if after is not None:
+            clauses.append('identifier > ?')
+            values.append(after)
+        if modified_after is not None:
+            clauses.append('modified >= ?')
+            values.append(modified_after)
+        if modified_before is not None:
+            clauses.append('modified < ?')
+            values.append(modified_before)
+        sql = 'SELECT metadata FROM images'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY identifier'
+        # Paging can only be left to SQLite if it decides the whole match
+        skip = offset
+        if not unchecked:
+            if limit is not None or offset:
+                sql += ' LIMIT ? OFFSET ?'
+                values.extend([ limit if limit is not None else -1, offset ])
+            skip = 0
+        remaining = limit
+        for row in self._connection().execute(sql, values):
+            if (remaining is not None) and (remaining <= 0):
+                break
+            metadata = json.loads(row[0])
+            if not all([ metadata.get(key) == value for key, value in unchecked.items() ]):
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            if fields is not None:
+                metadata = dict([ (key, metadata.get(key)) for key in set(fields).union(('type', 'identifier')) ])
+            yield metadata
+            if remaining is not None:
+                remaining -= 1
+
+    def add_image(self, image):
+        """
+        Start managing a new image, creating its (empty) body file.
+
+        @param image The PersistentImage to add
+        """
+        image.persistent_manager = self
+        body_path = self.storage_path + '/' + str(image.identifier) + BODY_EXT
+        image.data = body_path
+        try:
+            if not os.path.isfile(body_path):
+                open(body_path, 'w').close()
+                self.log.debug('Created file %s' % body_path)
+        except IOError as e:
+            self.log.debug('Exception caught: %s' % e)
+        try:
+            self._write_metadata(self._metadata_for_image(image), insert=True)
+        except sqlite3.IntegrityError:
+            raise ImageFactoryException("Image %s already managed, use image_with_id() and save_image()" % (image.identifier))
+
+    def save_image(self, image):
+        """
+        Persist the current metadata of a managed image.
+
+        @param image The PersistentImage to save
+        """
+        try:
+            meta = self._metadata_for_image(image)
+            self._write_metadata(meta)
+            if self._local.batch_depth:
+                self._local.deferred_bodies.append(meta)
+            else:
+                self._store_body(meta)
+            self.log.debug("Saved metadata for image (%s): %s" % (image.identifier, meta))
+        except ImageFactoryException:
+            raise
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+
+    def save_images(self, images):
+        """
+        Persist several images in a single transaction.
+
+        @param images An iterable of PersistentImages
+        """
+        with self.batch():
+            for image in images:
+                self.save_image(image)
+
+    def delete_image_with_id(self, image_id):
+        """
+        Remove an image's metadata and body.
+
+        @param image_id The image identifier
+        """
+        body_path = self.storage_path + '/' + image_id + BODY_EXT
+        try:
+            os.remove(body_path)
+        except Exception as e:
+            self.log.warn('Unable to delete file: %s' % e)
+        if self.blob_store and not os.path.lexists(body_path):
+            self.blob_store.release(image_id)
+        with self.batch():
+            self._connection().execute('DELETE FROM images WHERE identifier = ?', (image_id,))
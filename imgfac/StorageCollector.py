@@ -0,0 +1,263 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import time
+from threading import Thread, Event
+from .ApplicationConfiguration import ApplicationConfiguration
+from .PersistentImageManager import PersistentImageManager
+
+# Files and directories we may remove are named after the image they belong to,
+# optionally with a leading '.' (atomic metadata writes), or come from mkdtemp()
+IMAGE_FILE_REGEX = re.compile(r'^\.?(?P<identifier>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?P<suffix>.*)$')
+TEMP_DIR_REGEX = re.compile(r'^tmp[A-Za-z0-9_]{8}$')
+TEMP_EXT_REGEX = re.compile(r'\.tmp(\.|$)')
+BODY_EXT = '.body'
+# An image in one of these is still being worked on and its scratch files may be in use
+ACTIVE_STATUSES = ('NEW', 'PENDING', 'BUILDING', 'DELETING')
+
+
+class StorageCollector(object):
+    """
+    Reclaims disk space left behind by failed or interrupted builds.
+
+    Removed once they are older than min_age:
+        - .body files and other image named files of images that no longer exist
+        - .tmp files (conversion outputs, interrupted metadata writes) unless their
+          image is still being built
+        - .gz files and their -factory-compressed markers for images that no longer exist
+        - mkdtemp() directories (OVF packaging, Docker) in the storage path
+        - blobs of deduplicated bodies no longer used by any image, and their refs
+    Optionally, FAILED images are deleted once older than failed_image_max_age, and
+    oldest first while the storage path holds more than max_storage_bytes.
+    Images in any other status are never touched.
+    """
+
+    def __init__(self, pim, paths=None, min_age=3600, failed_image_max_age=0, max_storage_bytes=0):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.pim = pim
+        self.paths = paths if paths else [ pim.storage_path ]
+        self.min_age = min_age
+        self.failed_image_max_age = failed_image_max_age
+        self.max_storage_bytes = max_storage_bytes
+        self._stop = Event()
+        self._thread = None
+
+    @classmethod
+    def from_configuration(cls):
+        """
+        @return A StorageCollector for the default image manager set up from imagefactory.conf
+        """
+        app_config = ApplicationConfiguration().configuration
+        pim = PersistentImageManager.default_manager()
+        paths = [ pim.storage_path ]
+        imgdir = app_config.get('imgdir')
+        # The shared system temporary directory holds other programs' files - leave it alone
+        if imgdir and os.path.isdir(imgdir) and (os.path.realpath(imgdir) != os.path.realpath(tempfile.gettempdir())) \
+                and (os.path.realpath(imgdir) != os.path.realpath(pim.storage_path)):
+            paths.append(imgdir)
+        return cls(pim, paths,
+                   min_age=app_config.get('gc_min_age', 3600),
+                   failed_image_max_age=app_config.get('gc_failed_image_max_age', 0),
+                   max_storage_bytes=app_config.get('gc_max_storage_bytes', 0))
+
+    def start(self, interval):
+        """
+        Run collect() every interval seconds in a daemon thread.
+        """
+        self._thread = Thread(target=self._run, args=(interval, ), name='storage-collector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.collect()
+            except Exception as e:
+                self.log.error("Storage collection failed")
+                self.log.exception(e)
+
+    def collect(self, dry_run=False):
+        """
+        Find and (unless dry_run) remove everything described above.
+
+        @param dry_run Only report what would be removed
+
+        @return A dict with the list of removed paths, the bytes reclaimed and the
+                identifiers of deleted FAILED images
+        """
+        report = {'dry_run': dry_run, 'removed': [ ], 'deleted_images': [ ], 'reclaimed_bytes': 0}
+        now = time.time()
+        statuses = { }
+
+        def status_of(image_id):
+            if image_id not in statuses:
+                image = self.pim.image_with_id(image_id)
+                if image:
+                    statuses[image_id] = image.status
+                elif os.path.exists(os.path.join(self.pim.storage_path, image_id + '.meta')):
+                    # Metadata we cannot read is still an image - leave it for a human
+                    statuses[image_id] = 'UNKNOWN'
+                else:
+                    statuses[image_id] = None
+            return statuses[image_id]
+
+        for path in self.paths:
+            try:
+                entries = os.listdir(path)
+            except OSError as e:
+                self.log.warning("Unable to scan (%s): %s" % (path, e))
+                continue
+            for entry in entries:
+                full_path = os.path.join(path, entry)
+                if self._newest_mtime(full_path) > (now - self.min_age):
+                    continue
+                match = IMAGE_FILE_REGEX.match(entry)
+                if match:
+                    status = status_of(match.group('identifier'))
+                    if status is None:
+                        # The image is gone - everything named after it is junk
+                        if match.group('suffix') == BODY_EXT:
+                            self._remove_body(full_path, match.group('identifier'), report)
+                        else:
+                            self._remove(full_path, report)
+                    elif (TEMP_EXT_REGEX.search(match.group('suffix'))) and (status not in ACTIVE_STATUSES):
+                        self._remove(full_path, report)
+                elif (path == self.pim.storage_path) and os.path.isdir(full_path) and TEMP_DIR_REGEX.match(entry):
+                    self._remove(full_path, report)
+
+        self._collect_blobs(report)
+        self._collect_failed_images(now, report)
+        verb = 'Would reclaim' if dry_run else 'Reclaimed'
+        self.log.info("%s %d bytes from %d files and %d FAILED images" % (verb, report['reclaimed_bytes'],
+                                                                         len(report['removed']), len(report['deleted_images'])))
+        return report
+
+    def _collect_failed_images(self, now, report):
+        if (not self.failed_image_max_age) and (not self.max_storage_bytes):
+            return
+        failed = [ ]
+        for metadata in self.pim.metadata_from_query({'status': 'FAILED'}, fields=['data']):
+            body = metadata.get('data')
+            try:
+                st = os.stat(body)
+                failed.append((st.st_mtime, metadata['identifier'], self._disk_usage(body)))
+            except (OSError, TypeError):
+                failed.append((0, metadata['identifier'], 0))
+        failed.sort()
+        if self.max_storage_bytes:
+            used = self._disk_usage(self.pim.storage_path) - report['reclaimed_bytes']
+        for mtime, image_id, size in failed:
+            expired = self.failed_image_max_age and (mtime < (now - self.failed_image_max_age))
+            over_quota = self.max_storage_bytes and (used > self.max_storage_bytes)
+            if not (expired or over_quota):
+                continue
+            self.log.debug("Deleting FAILED image (%s)" % (image_id))
+            if not report['dry_run']:
+                self.pim.delete_image_with_id(image_id)
+            report['deleted_images'].append(image_id)
+            report['reclaimed_bytes'] += size
+            if self.max_storage_bytes:
+                used -= size
+        if self.max_storage_bytes and (used > self.max_storage_bytes):
+            self.log.warning("Storage in (%s) still uses %d bytes, above the quota of %d, after removing all FAILED images" %
+                             (self.pim.storage_path, used, self.max_storage_bytes))
+
+    def _collect_blobs(self, report):
+        blob_store = getattr(self.pim, 'blob_store', None)
+        if not blob_store:
+            return
+        for path, size in blob_store.collect_orphans(dry_run=report['dry_run']):
+            self.log.debug("%s unused (%s) of %d bytes" % ('Found' if report['dry_run'] else 'Removed', path, size))
+            report['removed'].append(path)
+            report['reclaimed_bytes'] += size
+
+    def _remove_body(self, path, image_id, report):
+        blob_store = getattr(self.pim, 'blob_store', None)
+        if (not blob_store) or (not blob_store.digest_for(image_id)):
+            self._remove(path, report)
+            return
+        # The blob goes along with the body unless another image shares it
+        try:
+            st = os.lstat(path)
+            size = (st.st_blocks * 512) if (st.st_nlink <= 2) else 0
+        except OSError:
+            size = 0
+        if self._remove(path, report, size) and not report['dry_run']:
+            blob_store.release(image_id)
+
+    def _remove(self, path, report, size=None):
+        """
+        @return True if path was (or in a dry run would be) removed
+        """
+        if size is None:
+            size = self._disk_usage(path)
+        self.log.debug("%s orphaned (%s) of %d bytes" % ('Found' if report['dry_run'] else 'Removing', path, size))
+        if not report['dry_run']:
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                self.log.warning("Unable to remove (%s): %s" % (path, e))
+                return False
+        report['removed'].append(path)
+        report['reclaimed_bytes'] += size
+        return True
+
+    def _newest_mtime(self, path):
+        try:
+            newest = os.lstat(path).st_mtime
+            if os.path.isdir(path) and not os.path.islink(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for name in dirnames + filenames:
+                        newest = max(newest, os.lstat(os.path.join(dirpath, name)).st_mtime)
+            return newest
+        except OSError:
+            # Vanished while we were looking - certainly not ours to remove
+            return time.time()
+
+    def _disk_usage(self, path):
+        # Allocated rather than apparent size - image bodies are usually sparse
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                total = 0
+                # Bodies and their blobs are hard links to the same blocks - count them once
+                seen = set()
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for name in filenames:
+                        st = os.lstat(os.path.join(dirpath, name))
+                        if (st.st_dev, st.st_ino) not in seen:
+                            seen.add((st.st_dev, st.st_ino))
+                            total += st.st_blocks * 512
+                return total
+            st = os.lstat(path)
+            # A hard link into the blob store frees nothing until its last link goes
+            if st.st_nlink > 1:
+                return 0
+            return st.st_blocks * 512
+        except OSError:
+            return 0
+
@@ -18,19 +18,22 @@ from .PersistentImage import PersistentImage
 from .props import prop
 
 
-METADATA = ('base_image_id', 'target')
+# alias_of - the image whose build this one shares, if it joined an identical build in progress
+METADATA = ('base_image_id', 'target', 'alias_of')
 
 class TargetImage(PersistentImage):
     """ TODO: Docstring for TargetImage  """
 
     base_image_id = prop("_base_image_id")
     target = prop("_target")
+    alias_of = prop("_alias_of")
     parameters = prop("_parameters")
 
     def __init__(self, image_id=None):
         super(TargetImage, self).__init__(image_id)
         self.base_image_id = None
         self.target = None
+        self.alias_of = None
 
     def metadata(self):
         self.log.debug("Executing metadata in class (%s) my metadata is (%s)" % (self.__class__, METADATA))
@@ -14,7 +14,12 @@
 #   limitations under the License.
 
 import logging
+import os
+import time
+import uuid
+import zlib
 from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ImageFactoryException import ImageFactoryException
 from imgfac.rest.bottle import *
 #from imgfac.picklingtools.xmlloader import *
 
@@ -22,15 +27,16 @@ log = logging.getLogger(__name__)
 
 def form_data_for_content_type(content_type):
     def dencode(a_dict, encoding='ascii'):
+        # Native strings throughout - keys encoded to bytes would never be found by the handlers
+        def native(value):
+            return value.decode(encoding) if isinstance(value, bytes) else value
         new_dict = {}
         for k,v in a_dict.items():
-            ek = k.encode(encoding)
-            if(isinstance(v, str)):
-                new_dict[ek] = v.encode(encoding)
-            elif(isinstance(v, dict)):
+            ek = native(k)
+            if(isinstance(v, dict)):
                 new_dict[ek] = dencode(v)
             else:
-                new_dict[ek] = v
+                new_dict[ek] = native(v)
         return new_dict
 
     try:
@@ -46,17 +52,28 @@ def form_data_for_content_type(content_type):
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
 
+# Most of a request body logged in debug mode - image uploads are never read
+LOGGED_BODY_LIMIT = 4096
+
 def log_request(f):
     def decorated_function(*args, **kwargs):
         if(ApplicationConfiguration().configuration['debug']):
-            request_body = request.body.read()
-            if('credentials' in request_body):
-                marker = 'provider_credentials'
-                starting_index = request_body.find(marker)
-                ending_index = request_body.rfind(marker) + len(marker)
-                sensitive = request_body[starting_index:ending_index]
-                request_body = request_body.replace(sensitive, 'REDACTED')
-            log.debug('Handling %s HTTP %s REQUEST for resource at %s: %s' % (request.headers.get('Content-Type'),
+            content_type = request.headers.get('Content-Type') or ''
+            if content_type.startswith('application/json') or content_type.startswith('application/x-www-form-urlencoded'):
+                # Only a prefix - the body is read again by the handler
+                request_body = request.body.read(LOGGED_BODY_LIMIT).decode('utf-8', 'replace')
+                if('credentials' in request_body):
+                    marker = 'provider_credentials'
+                    starting_index = request_body.find(marker)
+                    ending_index = request_body.rfind(marker) + len(marker)
+                    if (starting_index < 0) or (ending_index <= starting_index + len(marker)):
+                        # The closing marker is past the prefix, or there is none
+                        starting_index = max(starting_index, request_body.find('credentials'))
+                        ending_index = len(request_body)
+                    request_body = request_body[:starting_index] + 'REDACTED' + request_body[ending_index:]
+            else:
+                request_body = '(%s bytes not logged)' % (request.content_length)
+            log.debug('Handling %s HTTP %s REQUEST for resource at %s: %s' % (content_type,
                                                                               request.method,
                                                                               request.path,
                                                                               request_body))
@@ -74,3 +91,209 @@ def check_accept_header(f):
             return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
     return decorated_function
+
+class CherootServer(ServerAdapter):
+    """
+    The WSGI server of CherryPy as packaged since CherryPy dropped cherrypy.wsgiserver.
+    Options are passed on to cheroot.wsgi.Server.
+    """
+
+    def run(self, handler): # pragma: no cover
+        from cheroot import wsgi
+        server = wsgi.Server((self.host, self.port), handler, **self.options)
+        try:
+            server.start()
+        finally:
+            server.stop()
+
+class TunedWaitressServer(ServerAdapter):
+    """
+    Waitress, with options passed on to waitress.serve().  Connections are read and
+    written asynchronously, so idle keep-alive connections and slow clients do not
+    hold one of the request threads.
+    """
+
+    def run(self, handler): # pragma: no cover
+        from waitress import serve
+        serve(handler, host=self.host, port=self.port, **self.options)
+
+def rest_server(app_config):
+    """
+    Choose the WSGI server for the REST API from the configuration.
+
+    @param app_config The configuration dict - rest_server, rest_threads,
+                      rest_request_queue_size and rest_keepalive_timeout are used
+
+    @return A tuple of the bottle ServerAdapter class and the options to run it with
+    """
+    name = app_config.get('rest_server', 'cherrypy')
+    threads = app_config.get('rest_threads', 30)
+    queue_size = app_config.get('rest_request_queue_size', 64)
+    keepalive_timeout = app_config.get('rest_keepalive_timeout', 10)
+    if name == 'cherrypy':
+        try:
+            from cherrypy import wsgiserver
+        except ImportError:
+            name = 'cheroot'
+    if name in ('cherrypy', 'cheroot'):
+        # timeout is how long a connection kept alive may sit idle
+        return (CherryPyServer if name == 'cherrypy' else CherootServer), \
+               {'numthreads': threads, 'request_queue_size': queue_size, 'timeout': keepalive_timeout}
+    elif name == 'waitress':
+        # send_bytes of 1 so that event streams are not held back to fill a buffer
+        return TunedWaitressServer, {'threads': threads, 'backlog': queue_size,
+                                     'channel_timeout': keepalive_timeout, 'send_bytes': 1}
+    elif name == 'wsgiref':
+        # One request at a time - for debugging only
+        return WSGIRefServer, { }
+    raise ImageFactoryException("Unknown rest_server (%s) - use one of cherrypy, cheroot, waitress or wsgiref" % (name))
+
+class FileRange(object):
+    """
+    A read only view of length bytes of a file starting at offset.
+
+    fileno() and tell() are passed through so a WSGI server whose file_wrapper uses
+    sendfile can transfer the range without copying it through Python, stopping at the
+    Content-Length.  Everywhere else it is read like any other file.
+    """
+
+    def __init__(self, fp, offset, length, maxread=1024*1024):
+        self.fp = fp
+        self.remaining = length
+        self.maxread = maxread
+        fp.seek(offset)
+
+    def read(self, size=-1):
+        if (size is None) or (size < 0):
+            size = self.maxread
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b''
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+def _http_date(timestamp):
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
+
+def _etag_matches(header, etag):
+    # Weak comparison, as required for If-None-Match
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    candidates = [ candidate.strip() for candidate in header.split(',') ]
+    return etag.replace('W/', '') in [ candidate.replace('W/', '') for candidate in candidates ]
+
+def _gzip_file(fp, chunk_size=1024*1024):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        fp.close()
+
+def _multipart_ranges(fp, ranges, size, content_type, boundary):
+    try:
+        for start, end in ranges:
+            yield ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                   (boundary, content_type, start, end - 1, size)).encode('ascii')
+            part = FileRange(fp, start, end - start)
+            chunk = part.read()
+            while chunk:
+                yield chunk
+                chunk = part.read()
+            yield b'\r\n'
+        yield ('--%s--\r\n' % boundary).encode('ascii')
+    finally:
+        fp.close()
+
+def file_response(path, etag_prefix, download_name=None, compress=False):
+    """
+    Serve a (potentially very large) file, honoring conditional and Range requests.
+
+    @param path Path of the file to send
+    @param etag_prefix Identifies the resource, combined with the file's mtime and size
+                       to produce the ETag
+    @param download_name File name suggested to the client
+    @param compress Allow gzip Content-Encoding for full downloads if the client accepts it
+
+    @return An HTTPResponse - 200, 206, 304 or 416
+    """
+    if not os.path.isfile(path):
+        return HTTPResponse(status=404, output='File does not exist.')
+    stats = os.stat(path)
+    size = stats.st_size
+    etag = '"%s-%x-%x"' % (etag_prefix, stats.st_mtime_ns, size)
+    last_modified = _http_date(stats.st_mtime)
+    content_type = 'application/octet-stream'
+    headers = {'ETag': etag,
+               'Last-Modified': last_modified,
+               'Accept-Ranges': 'bytes',
+               'Content-Type': content_type}
+    if download_name:
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % download_name
+    if compress:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if _etag_matches(if_none_match, etag):
+            return HTTPResponse(status=304, **headers)
+    else:
+        if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            if_modified_since = parse_date(if_modified_since.split(";")[0].strip())
+            if (if_modified_since is not None) and (if_modified_since >= int(stats.st_mtime)):
+                return HTTPResponse(status=304, **headers)
+
+    range_header = request.environ.get('HTTP_RANGE')
+    if range_header:
+        # A resumed download must not splice together two different versions of the file
+        if_range = request.environ.get('HTTP_IF_RANGE')
+        if if_range and (if_range.strip() not in (etag, last_modified)):
+            range_header = None
+    is_head = (request.method == 'HEAD')
+
+    if range_header:
+        ranges = list(parse_range_header(range_header, size))
+        if not ranges:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return HTTPResponse(status=416, output='Requested Range Not Satisfiable', **headers)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+            headers['Content-Length'] = str(end - start)
+            body = '' if is_head else FileRange(open(path, 'rb'), start, end - start)
+            return HTTPResponse(body, status=206, **headers)
+        boundary = uuid.uuid4().hex
+        headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        body = '' if is_head else _multipart_ranges(open(path, 'rb'), ranges, size, content_type, boundary)
+        return HTTPResponse(body, status=206, **headers)
+
+    if compress and ('gzip' in request.environ.get('HTTP_ACCEPT_ENCODING', '')):
+        # The compressed length is not known up front, so this is sent chunked
+        headers['Content-Encoding'] = 'gzip'
+        headers['ETag'] = 'W/%s' % etag
+        body = '' if is_head else _gzip_file(open(path, 'rb'))
+        return HTTPResponse(body, **headers)
+
+    headers['Content-Length'] = str(size)
+    # A plain file object goes to the server's wsgi.file_wrapper, which may use sendfile
+    body = '' if is_head else open(path, 'rb')
+    return HTTPResponse(body, **headers)
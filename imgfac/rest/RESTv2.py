@@ -15,6 +15,9 @@
 
 import sys
 import traceback
+import itertools
+import json
+from urllib.parse import urlencode
 
 sys.path.insert(1, '%s/imgfac/rest' % sys.path[0])
 
@@ -27,8 +30,16 @@ from imgfac.BuildDispatcher import BuildDispatcher
 from imgfac.PluginManager import PluginManager
 from imgfac.PersistentImageManager import PersistentImageManager
 from imgfac.Version import VERSION as VERSION
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
 #from imgfac.picklingtools.xmldumper import *
 from imgfac.Builder import Builder
+from imgfac.JobScheduler import JobScheduler
+from imgfac.ReservationManager import ReservationManager
+from imgfac.BuildCache import BuildCache
+from imgfac.FarmWorker import FarmWorker
+from imgfac.CallbackDelivery import CallbackDelivery
+from imgfac.ImageEventBroker import ImageEventBroker, image_event, event_stream
+from imgfac.ImageFactoryException import ImageFactoryException
 
 log = logging.getLogger(__name__)
 
@@ -69,8 +80,126 @@ def get_image_file(image_id, base_image_id=None, target_image_id=None, provider_
         image = PersistentImageManager.default_manager().image_with_id(image_id)
         if(not image):
             raise HTTPResponse(status=404, output='No image found with id: %s' % image_id)
-        path, filename = os.path.split(image.data)
-        return static_file(filename, path, download=True)
+        farm = BuildDispatcher().farm
+        if farm and image.farm_node:
+            # The worker of the build farm that built the image holds the body
+            body = farm.open_body(image)
+            headers = {'Content-Type': 'application/octet-stream',
+                       'Content-Disposition': 'attachment; filename="%s"' % os.path.basename(image.data)}
+            if body.headers.get('Content-Length'):
+                headers['Content-Length'] = body.headers['Content-Length']
+            return HTTPResponse(body, status=200, **headers)
+        return file_response(image.data, image.identifier, download_name=os.path.basename(image.data),
+                             compress=bool(ApplicationConfiguration().configuration.get('compress_downloads', False)))
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+def _query_param(name, convert=str):
+    value = request.query.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        raise HTTPResponse(status=400, output='Invalid value for query parameter %s: %s' % (name, value))
+
+def _request_url_without_query():
+    return '%s://%s%s' % (request.urlparts[0], request.urlparts[1], request.urlparts[2])
+
+def _image_list_items(image_collection, fetch_spec, list_url, fields=None, **paging):
+    for metadata in PersistentImageManager.default_manager().metadata_from_query(fetch_spec, fields=fields, **paging):
+        resp_item = {'_type': metadata['type'],
+                     'id': metadata['identifier'],
+                     'href': '%s/%s' % (list_url, metadata['identifier'])}
+        if fields:
+            for key in fields:
+                if key not in ('identifier', 'type', 'data'):
+                    resp_item[key] = metadata.get(key)
+        yield {image_collection[0:-1]: resp_item}
+
+def _image_list(image_collection, fetch_spec, list_url):
+    return {image_collection: list(_image_list_items(image_collection, fetch_spec, list_url))}
+
+def _stream_image_list(image_collection, first_item, items, limit, next_url):
+    # Emit the JSON document piece by piece so the response never has to be built in memory
+    yield '{"%s": [' % image_collection
+    count = 0
+    last_id = None
+    if first_item:
+        for item in itertools.chain([first_item], items):
+            yield ('%s%s' % (', ' if count else '', json.dumps(item)))
+            count += 1
+            last_id = item[image_collection[0:-1]]['id']
+    tail = ']'
+    if (limit is not None) and (count == limit) and last_id:
+        tail += ', "next": %s' % (json.dumps(next_url(last_id)))
+    yield tail + '}'
+
+def _image_events(images):
+    accept_header = request.get_header('Accept', None)
+    if accept_header and ('*/*' not in accept_header) and ('text/event-stream' not in accept_header):
+        raise HTTPResponse(status=406, output='Events are only available as text/event-stream.')
+    app_config = ApplicationConfiguration().configuration
+    # Each stream holds a request thread for as long as it is open - keep some for everything else
+    max_streams = app_config.get('max_event_streams', 0) or (app_config.get('rest_threads', 30) // 2)
+    if ImageEventBroker().subscriber_count() >= max_streams:
+        raise HTTPResponse(status=503, output='Too many event streams open - try again later', **{'Retry-After': '30'})
+    pim = PersistentImageManager.default_manager()
+    # Subscribed before the images are read, so no change in between is missed
+    subscription = ImageEventBroker().subscribe([ image_id for collection_type, image_id in images ])
+    try:
+        snapshots = [ ]
+        for collection_type, image_id in images:
+            image = pim.image_with_id(image_id)
+            if (not image) or (collection_type and (type(image).__name__ != IMAGE_TYPES[collection_type])):
+                raise HTTPResponse(status=404, output='No image found with id: %s' % image_id)
+            snapshots.append(image_event(image))
+    except:
+        ImageEventBroker().unsubscribe(subscription)
+        raise
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    return event_stream(subscription, snapshots, app_config.get('events_keepalive', 15))
+
+@rest_api.get('/imagefactory/events')
+@log_request
+@oauth_protect
+def image_events():
+    """
+    The events of several images in one stream, for clients watching many builds.
+    The images are given as a comma separated list in the ids query parameter.
+    """
+    try:
+        image_ids = [ image_id.strip() for image_id in (_query_param('ids') or '').split(',') if image_id.strip() ]
+        if not image_ids:
+            raise HTTPResponse(status=400, output='No image ids given in the ids query parameter')
+        return _image_events([ (None, image_id) for image_id in image_ids ])
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+@rest_api.get('/imagefactory/<collection_type>/<image_id>/events')
+@rest_api.get('/imagefactory/base_images/<base_image_id>/<collection_type>/<image_id>/events')
+@rest_api.get('/imagefactory/base_images/<base_image_id>/target_images/<target_image_id>/<collection_type>/<image_id>/events')
+@rest_api.get('/imagefactory/target_images/<target_image_id>/<collection_type>/<image_id>/events')
+@log_request
+@oauth_protect
+def events_for_image(collection_type, image_id, base_image_id=None, target_image_id=None):
+    """
+    Stream the status and progress of an image as Server-Sent Events until it
+    reaches a final status.
+    """
+    try:
+        if collection_type not in ('base_images', 'target_images', 'provider_images'):
+            raise HTTPResponse(status=404, output='Unknown resource type: %s' % collection_type)
+        return _image_events([ (collection_type, image_id) ])
+    except HTTPResponse:
+        raise
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
@@ -81,7 +210,16 @@ def get_image_file(image_id, base_image_id=None, target_image_id=None, provider_
 @log_request
 @oauth_protect
 @check_accept_header
-def list_images(image_collection, base_image_id=None, target_image_id=None, list_url=None):
+def list_images(image_collection, base_image_id=None, target_image_id=None):
+    """
+    Optional query parameters:
+        status - only images with this status
+        modified_after, modified_before - only images last saved in this range (seconds since the epoch)
+        fields - comma separated metadata keys to include for each image
+        limit - maximum number of images to return.  A full page includes a "next" link.
+        offset - number of matching images to skip
+        after - only images whose id sorts after this one (the cursor used by "next")
+    """
     try:
         _type = IMAGE_TYPES[image_collection]
         if _type:
@@ -93,18 +231,110 @@ def list_images(image_collection, base_image_id=None, target_image_id=None, list
         else:
             raise HTTPResponse(status=404, output='%s not found' % image_collection)
 
-        fetched_images = PersistentImageManager.default_manager().images_from_query(fetch_spec)
-        images = list()
-        _url = list_url if list_url else request.url
-        for image in fetched_images:
-            resp_item = {image_collection[0:-1]:
-                            {'_type':type(image).__name__,
-                            'id':image.identifier,
-                            'href':'%s/%s' % (_url, image.identifier)}
-                        }
-            images.append(resp_item)
-
-        return converted_response({image_collection:images})
+        status = _query_param('status')
+        if status:
+            fetch_spec['status'] = status.upper()
+        fields = _query_param('fields')
+        if fields:
+            fields = [ field.strip() for field in fields.split(',') if field.strip() ]
+        paging = {'limit': _query_param('limit', int),
+                  'offset': _query_param('offset', int) or 0,
+                  'after': _query_param('after'),
+                  'modified_after': _query_param('modified_after', float),
+                  'modified_before': _query_param('modified_before', float)}
+        if ((paging['limit'] is not None) and (paging['limit'] < 0)) or (paging['offset'] < 0):
+            raise HTTPResponse(status=400, output='limit and offset must not be negative')
+
+        list_url = _request_url_without_query()
+        items = _image_list_items(image_collection, fetch_spec, list_url, fields, **paging)
+        # Pull the first item here so that query errors are still reported with a proper status
+        try:
+            first_item = next(items, None)
+        except ImageFactoryException as e:
+            raise HTTPResponse(status=400, output=str(e))
+
+        def next_url(last_id):
+            next_query = dict([ (key, value) for key, value in request.query.items() if key not in ('offset', 'after') ])
+            next_query['after'] = last_id
+            return '%s?%s' % (list_url, urlencode(next_query))
+
+        response.content_type = 'application/json'
+        return _stream_image_list(image_collection, first_item, items, paging['limit'], next_url)
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+def _created_image_dict(image):
+    _response = {'_type':type(image).__name__,
+                 'id':image.identifier,
+                 'href':'%s/%s' % (request.url, image.identifier)}
+    for key in image.metadata():
+        if key not in ('identifier', 'data'):
+            _response[key] = getattr(image, key, None)
+    return _response
+
+# Defined before create_image, whose routes would otherwise take 'cancel' for a collection
+@rest_api.post('/imagefactory/<collection_type>/<image_id>/cancel')
+@rest_api.post('/imagefactory/base_images/<base_image_id>/<collection_type>/<image_id>/cancel')
+@rest_api.post('/imagefactory/base_images/<base_image_id>/target_images/<target_image_id>/<collection_type>/<image_id>/cancel')
+@rest_api.post('/imagefactory/target_images/<target_image_id>/<collection_type>/<image_id>/cancel')
+@log_request
+@oauth_protect
+@check_accept_header
+def cancel_image_build(collection_type, image_id, base_image_id=None, target_image_id=None):
+    try:
+        image = PersistentImageManager.default_manager().image_with_id(image_id)
+        if(not image) or (IMAGE_TYPES.get(collection_type) != type(image).__name__):
+            raise HTTPResponse(status=404, output='No %s found with id: %s' % (collection_type, image_id))
+        if image.status not in ('NEW', 'PENDING', 'BUILDING'):
+            raise HTTPResponse(status=409, output='Image %s is not being built - its status is %s' % (image_id, image.status))
+        if not BuildDispatcher().cancel_build(image_id):
+            raise HTTPResponse(status=409, output='Image %s is not being built by this factory' % image_id)
+        response.status = 202
+        return converted_response({'_type': type(image).__name__, 'id': image_id, 'href': request.url,
+                                   'status_detail': {'activity': 'Build cancelled', 'error': 'Cancelled by request'}})
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+@rest_api.post('/imagefactory/farm/workers')
+@log_request
+@oauth_protect
+@check_accept_header
+def register_farm_worker():
+    try:
+        farm = BuildDispatcher().farm
+        if not farm:
+            raise HTTPResponse(status=404, output='This factory does not coordinate a build farm')
+        form_data = form_data_for_content_type(request.headers.get('Content-Type'))
+        try:
+            worker = farm.register(form_data.get('worker') if form_data else None)
+        except ImageFactoryException as e:
+            raise HTTPResponse(status=400, output=str(e))
+        return converted_response({'worker': worker})
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+# Defined before image_with_id, which would otherwise take 'farm' for a collection
+@rest_api.get('/imagefactory/farm/workers')
+@log_request
+@oauth_protect
+@check_accept_header
+def list_farm_workers():
+    try:
+        farm = BuildDispatcher().farm
+        if not farm:
+            raise HTTPResponse(status=404, output='This factory does not coordinate a build farm')
+        return converted_response({'workers': farm.workers_as_list()})
+    except HTTPResponse:
+        raise
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
@@ -133,16 +363,48 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
         base_img_id = req_base_img_id if req_base_img_id else base_image_id
         target_img_id = req_target_img_id if req_target_img_id else target_image_id
 
+        my_image_id = None
+        if ApplicationConfiguration().configuration.get('farm_role') == 'worker':
+            # Sent by the coordinator of the build farm - see FarmCoordinator.dispatch
+            my_image_id = request_data.get('farm_image_id')
+            if my_image_id and PersistentImageManager.default_manager().image_with_id(my_image_id):
+                raise HTTPResponse(status=409, output='An image with id %s already exists' % my_image_id)
+            try:
+                FarmWorker().import_inputs(request_data.get('farm_inputs'))
+            except ImageFactoryException as e:
+                raise HTTPResponse(status=400, output=str(e))
+
         if(image_collection == 'base_images'):
             builder = BuildDispatcher().builder_for_base_image(template=request_data.get('template'),
-                                                               parameters=request_data.get('parameters'))
+                                                               parameters=request_data.get('parameters'),
+                                                               my_image_id=my_image_id)
             image = builder.base_image
         elif(image_collection == 'target_images'):
             builder = BuildDispatcher().builder_for_target_image(target=request_data.get('target'),
                                                                  image_id=base_img_id,
                                                                  template=request_data.get('template'),
-                                                                 parameters=request_data.get('parameters'))
+                                                                 parameters=request_data.get('parameters'),
+                                                                 my_image_id=my_image_id)
             image = builder.target_image
+        elif((image_collection == 'provider_images') and ('providers' in request_data)):
+            # One TargetImage pushed to several providers - each gets a ProviderImage of its own
+            _providers = request_data.get('providers')
+            _credentials = request_data.get('credentials')
+            _target = request_data.get('target')
+            if not (isinstance(_providers, list) and _providers and _credentials and _target and target_img_id):
+                _credentials = 'REDACTED' if _credentials else None
+                raise HTTPResponse(status=400, output="Missing key/value pair: providers(%s), credentials(%s), target(%s), target_image_id(%s)" %
+                                                      (_providers, _credentials, _target, target_img_id))
+            try:
+                builders = BuildDispatcher().builders_for_provider_images(providers=_providers,
+                                                                          credentials=_credentials,
+                                                                          target=_target,
+                                                                          image_id=target_img_id,
+                                                                          parameters=request_data.get('parameters'))
+            except ImageFactoryException as e:
+                raise HTTPResponse(status=400, output=str(e))
+            response.status = 202
+            return converted_response({image_collection: [ _created_image_dict(builder.provider_image) for builder in builders ]})
         elif(image_collection == 'provider_images'):
             _provider = request_data.get('provider')
             _credentials = request_data.get('credentials')
@@ -153,7 +415,8 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
                                                                    target=_target,
                                                                    image_id=target_img_id,
                                                                    template=request_data.get('template'),
-                                                                   parameters=request_data.get('parameters'))
+                                                                   parameters=request_data.get('parameters'),
+                                                                   my_image_id=my_image_id)
                 image = builder.provider_image
             else:
                 _credentials = 'REDACTED' if _credentials else None
@@ -161,15 +424,10 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
         else:
             raise HTTPResponse(status=404, output="%s not found" % image_collection)
 
-        _response = {'_type':type(image).__name__,
-                     'id':image.identifier,
-                     'href':'%s/%s' % (request.url, image.identifier)}
-        for key in image.metadata():
-            if key not in ('identifier', 'data'):
-                _response[key] = getattr(image, key, None)
-
         response.status = 202
-        return converted_response({image_collection[0:-1]:_response})
+        return converted_response({image_collection[0:-1]:_created_image_dict(image)})
+    except HTTPResponse:
+        raise
     except KeyError as e:
         log.exception(e)
         raise HTTPResponse(status=400, output='Missing value for key: %s' % e)
@@ -177,6 +435,52 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
 
+@rest_api.post('/imagefactory/build_plans')
+@log_request
+@oauth_protect
+@check_accept_header
+def create_build_plan():
+    try:
+        content_type = request.headers.get('Content-Type')
+        form_data = form_data_for_content_type(content_type)
+        request_data = form_data.get('build_plan') if form_data else None
+        if(not request_data):
+            raise HTTPResponse(status=400, output='build_plan not found in request.')
+        try:
+            plan = BuildDispatcher().start_build_plan(template=request_data.get('template'),
+                                                      targets=request_data.get('targets'),
+                                                      parameters=request_data.get('parameters'),
+                                                      base_image_id=request_data.get('base_image_id'))
+        except ImageFactoryException as e:
+            raise HTTPResponse(status=400, output=str(e))
+        _response = plan.as_dict()
+        _response.update({'_type': 'build_plan', 'href': '%s/%s' % (request.url, plan.identifier)})
+        response.status = 202
+        return converted_response({'build_plan': _response})
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+@rest_api.get('/imagefactory/build_plans/<plan_id>')
+@log_request
+@oauth_protect
+@check_accept_header
+def build_plan_with_id(plan_id):
+    try:
+        plan = BuildDispatcher().build_plan_with_id(plan_id)
+        if not plan:
+            raise HTTPResponse(status=404, output='No build plan found with id: %s' % plan_id)
+        _response = plan.as_dict()
+        _response.update({'_type': 'build_plan', 'href': request.url})
+        return converted_response({'build_plan': _response})
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
 @rest_api.get('/imagefactory/<collection_type>/<image_id>')
 @rest_api.get('/imagefactory/base_images/<base_image_id>/<collection_type>/<image_id>')
 @rest_api.get('/imagefactory/base_images/<base_image_id>/target_images/<target_image_id>/<collection_type>/<image_id>')
@@ -198,14 +502,20 @@ def image_with_id(collection_type, image_id, base_image_id=None, target_image_id
                 for key in image.metadata():
                     if key not in ('identifier', 'data', 'base_image_id', 'target_image_id'):
                         _response[key] = getattr(image, key, None)
+                if image.status == 'PENDING':
+                    # Only known to the scheduler, so added here rather than stored with the image
+                    queue_estimate = JobScheduler().queue_estimate(image.identifier)
+                    if queue_estimate:
+                        _response['status_detail'] = dict(image.status_detail or { }, queue_position=queue_estimate[0],
+                                                          predicted_start=queue_estimate[1])
 
                 api_url = '%s://%s/imagefactory' % (request.urlparts[0], request.urlparts[1])
 
                 if (_type == "BaseImage"):
                     _objtype = 'base_image'
-                    _response['target_images'] = list_images('target_images',
-                                                             base_image_id=image.identifier,
-                                                             list_url='%s/target_images' % api_url)
+                    _response['target_images'] = _image_list('target_images',
+                                                             {'type': 'TargetImage', 'base_image_id': image.identifier},
+                                                             '%s/target_images' % api_url)
                 elif (_type == "TargetImage"):
                     _objtype = 'target_image'
                     base_image_id = image.base_image_id
@@ -215,9 +525,9 @@ def image_with_id(collection_type, image_id, base_image_id=None, target_image_id
                         _response['base_image'] = base_image_dict
                     else:
                         _response['base_image'] = None
-                    _response['provider_images'] = list_images('provider_images',
-                                                               target_image_id=image.identifier,
-                                                               list_url='%s/provider_images' % api_url)
+                    _response['provider_images'] = _image_list('provider_images',
+                                                               {'type': 'ProviderImage', 'target_image_id': image.identifier},
+                                                               '%s/provider_images' % api_url)
                 elif (_type == "ProviderImage"):
                     _objtype = 'provider_image'
                     target_image_id = image.target_image_id
@@ -249,6 +559,28 @@ def image_with_id(collection_type, image_id, base_image_id=None, target_image_id
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
 
+@rest_api.delete('/imagefactory/build_cache')
+@rest_api.delete('/imagefactory/build_cache/<image_id>')
+@log_request
+@oauth_protect
+@check_accept_header
+def invalidate_build_cache(image_id=None):
+    try:
+        dropped = BuildCache().invalidate(PersistentImageManager.default_manager(), image_id)
+        if image_id and (not dropped):
+            raise HTTPResponse(status=404, output='No cached image found with id: %s' % image_id)
+        return converted_response({'_type': 'build_cache', 'href': request.url, 'invalidated': dropped})
+    except HTTPResponse:
+        raise
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+def _cancel_for_delete(image):
+    # An image still being built is cancelled and deleted once its build has cleaned up
+    return (image.status in ('NEW', 'PENDING', 'BUILDING')) and \
+           BuildDispatcher().cancel_build(image.identifier, 'Cancelled by a request to delete the image')
+
 @rest_api.delete('/imagefactory/<collection_type>/<image_id>')
 @rest_api.delete('/imagefactory/base_images/<base_image_id>/<collection_type>/<image_id>')
 @rest_api.delete('/imagefactory/base_images/<base_image_id>/target_images/<target_image_id>/<collection_type>/<image_id>')
@@ -284,12 +616,32 @@ def delete_image_with_id(image_id, collection_type=None, base_image_id=None, tar
                                  credentials=request_data.get('credentials'),
                                  target=request_data.get('target'),
                                  image_object=image,
-                                 parameters=request_data.get('parameters'))
+                                 parameters=request_data.get('parameters'),
+                                 wait_for_build=_cancel_for_delete(image))
         else:
             if image_class == 'ProviderImage':
                 raise HTTPResponse(status=400, output='Missing required values:%s' % required_values)
             else:
-                builder.delete_image(provider=None, credentials=None, target=None, image_object=image, parameters=None)
+                builder.delete_image(provider=None, credentials=None, target=None, image_object=image, parameters=None,
+                                     wait_for_build=_cancel_for_delete(image))
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output=e)
+
+@rest_api.get('/imagefactory/resources')
+@log_request
+@oauth_protect
+@check_accept_header
+def get_resources():
+    try:
+        res_mgr = ReservationManager()
+        budgets = res_mgr.resource_budgets
+        budgets['disk'] = res_mgr.available_space
+        budgets['queues'] = JobScheduler().stats()
+        budgets['callbacks'] = CallbackDelivery().stats()
+        budgets['event_subscribers'] = ImageEventBroker().subscriber_count()
+        budgets.update({'_type': 'resources', 'href': request.url})
+        return converted_response(budgets)
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
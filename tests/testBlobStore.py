@@ -0,0 +1,135 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os
+from imgfac.BlobStore import BlobStore, clone_file, copy_file, unshare_file
+
+
+class testBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.store = BlobStore(self.storage_path, chunk_size=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _body(self, name, content):
+        path = os.path.join(self.storage_path, name + '.body')
+        with open(path, 'wb') as body:
+            body.write(content)
+        return path
+
+    def testIdenticalBodiesShareABlob(self):
+        first = self._body('one', b'disk image content')
+        second = self._body('two', b'disk image content')
+        other = self._body('three', b'something else')
+        digest = self.store.ingest('one', first)
+        self.assertEqual(self.store.ingest('two', second), digest)
+        self.assertNotEqual(self.store.ingest('three', other), digest)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        # Two bodies and the blob itself
+        self.assertEqual(os.stat(first).st_nlink, 3)
+        with open(second, 'rb') as body:
+            self.assertEqual(body.read(), b'disk image content')
+        self.assertEqual(self.store.digest_for('two'), digest)
+        # Ingesting again is a no-op
+        self.assertEqual(self.store.ingest('one', first), digest)
+        self.assertEqual(os.stat(first).st_nlink, 3)
+        self.assertEqual(self.store.usage()['blobs'], 2)
+
+    def testIngestLater(self):
+        first = self._body('one', b'shared')
+        second = self._body('two', b'shared')
+        self.store.ingest_later('one', first)
+        self.store.ingest_later('two', second)
+        self.assertTrue(self.store.wait(5))
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        # Released while queued or being ingested - nothing is left behind
+        third = self._body('three', b'other')
+        self.store.ingest_later('three', third)
+        os.remove(third)
+        self.store.release('three')
+        self.assertTrue(self.store.wait(5))
+        self.assertIsNone(self.store.digest_for('three'))
+        self.assertEqual(self.store.usage()['blobs'], 1)
+
+    def testBlobRemovedWithLastReference(self):
+        first = self._body('one', b'shared')
+        second = self._body('two', b'shared')
+        self.store.ingest('one', first)
+        self.store.ingest('two', second)
+        os.remove(first)
+        self.store.release('one')
+        self.assertEqual(self.store.usage()['blobs'], 1)
+        os.remove(second)
+        self.store.release('two')
+        self.assertEqual(self.store.usage()['blobs'], 0)
+        self.assertIsNone(self.store.digest_for('two'))
+        # Releasing something never stored is harmless
+        self.store.release('never-stored')
+
+    def testChangedWhileHashedNotIngested(self):
+        path = self._body('one', b'being written')
+        real_digest = self.store.digest
+        def digest_then_write(path):
+            digest = real_digest(path)
+            with open(path, 'ab') as body:
+                body.write(b' some more')
+            return digest
+        self.store.digest = digest_then_write
+        self.assertIsNone(self.store.ingest('one', path))
+        self.assertIsNone(self.store.digest_for('one'))
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        self.assertTrue(os.access(path, os.W_OK) or (os.getuid() == 0))
+        self.assertEqual(self.store.usage()['blobs'], 0)
+
+    def testWritersBreakTheLink(self):
+        first = self._body('one', b'shared')
+        second = self._body('two', b'shared')
+        self.store.ingest('one', first)
+        self.store.ingest('two', second)
+        # Copying over a shared body replaces it instead of writing through the link
+        copy_file(self._body('source', b'replacement'), first)
+        with open(second, 'rb') as body:
+            self.assertEqual(body.read(), b'shared')
+        self.assertEqual(os.stat(second).st_nlink, 2)
+
+        # An unshared body can be written without touching the blob
+        self.assertTrue(unshare_file(second))
+        self.assertFalse(unshare_file(second))
+        with open(second, 'ab') as body:
+            body.write(b' and changed')
+        self.assertEqual(self.store.usage()['blobs'], 1)
+        # Ingesting it again stores what it holds now
+        digest = self.store.ingest('two', second)
+        self.assertEqual(digest, self.store.digest(second))
+        self.assertEqual(self.store.usage()['blobs'], 1)
+        self.assertEqual(os.stat(second).st_nlink, 2)
+
+    def testCloneFileFallsBackCleanly(self):
+        source = self._body('source', b'base image')
+        destination = os.path.join(self.storage_path, 'target.body')
+        if not clone_file(source, destination):
+            self.skipTest('Filesystem does not support reflinks')
+        with open(destination, 'rb') as body:
+            self.assertEqual(body.read(), b'base image')
+
+
+if __name__ == '__main__':
+    unittest.main()
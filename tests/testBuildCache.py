@@ -0,0 +1,143 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BuildCache import BuildCache, build_cache_key
+from imgfac.BlobStore import copy_file
+from imgfac.BaseImage import BaseImage
+
+TEMPLATE = """<template>
+  <name>f20</name>
+  <os>
+    <name>Fedora</name>
+    <version>20</version>
+    <arch>x86_64</arch>
+    <install type='url'>
+      <url>http://example.com/fedora/20/x86_64/os/</url>
+    </install>
+  </os>
+</template>"""
+
+
+class testBuildCache(unittest.TestCase):
+    def setUp(self):
+        BuildCache._instance = None
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+        self.cache = BuildCache()
+
+    def tearDown(self):
+        BuildCache._instance = None
+        shutil.rmtree(self.storage_path)
+
+    def _image(self, key, status, age=0):
+        image = BaseImage()
+        image.cache_key = key
+        self.pim.add_image(image)
+        with open(image.data, 'w') as body:
+            body.write('body of %s' % (image.identifier))
+        past = time.time() - age
+        os.utime(image.data, (past, past))
+        image._status = status
+        self.pim.save_image(image)
+        return image
+
+    def testKeyIgnoresFormattingAndBookkeeping(self):
+        reformatted = TEMPLATE.replace("\n", "").replace("  ", "").replace("type='url'", 'type="url"')
+        key = build_cache_key(TEMPLATE, {'generate_icicle': False})
+        self.assertEqual(key, build_cache_key(reformatted, {'generate_icicle': False, 'callbacks': ['http://a/'], 'tenant': 'x'}))
+        self.assertNotEqual(key, build_cache_key(TEMPLATE, {'generate_icicle': True}))
+        self.assertNotEqual(key, build_cache_key(TEMPLATE.replace('20', '21'), {'generate_icicle': False}))
+        self.assertIsNone(build_cache_key('6a0f3f96-1c8c-4aa2-a1a7-2d4b8a7c9a11'))
+
+    def testKeyIncludesIsoIdentity(self):
+        iso = os.path.join(self.storage_path, 'install.iso')
+        with open(iso, 'w') as f:
+            f.write('iso')
+        template = TEMPLATE.replace("type='url'", "type='iso'").replace(
+            '<url>http://example.com/fedora/20/x86_64/os/</url>', '<iso>%s</iso>' % (iso))
+        key = build_cache_key(template)
+        os.utime(iso, (1, 1))
+        self.assertNotEqual(key, build_cache_key(template))
+
+    def testFindPrefersFreshComplete(self):
+        key = build_cache_key(TEMPLATE)
+        self._image(key, 'FAILED')
+        building = self._image(key, 'BUILDING')
+        self.assertEqual(self.cache.find(self.pim, key), building.identifier)
+        complete = self._image(key, 'COMPLETE')
+        self.assertEqual(self.cache.find(self.pim, key), complete.identifier)
+        self.assertIsNone(self.cache.find(self.pim, 'other'))
+
+    def testTtl(self):
+        key = build_cache_key(TEMPLATE)
+        old = self._image(key, 'COMPLETE', age=7200)
+        self.assertEqual(self.cache.find(self.pim, key, ttl=86400), old.identifier)
+        self.assertIsNone(self.cache.find(self.pim, key, ttl=3600))
+
+    def testRegisterCoalesces(self):
+        key = build_cache_key(TEMPLATE)
+        first = BaseImage()
+        self.assertIsNone(self.cache.register(self.pim, key, first))
+        first._status = 'PENDING'
+        self.pim.save_image(first)
+        second = BaseImage()
+        self.assertEqual(self.cache.register(self.pim, key, second), first.identifier)
+        self.assertEqual(self.pim.image_with_id(second.identifier).cache_key, key)
+
+    def testInvalidate(self):
+        key = build_cache_key(TEMPLATE)
+        first = self._image(key, 'COMPLETE')
+        second = self._image(key, 'COMPLETE')
+        self.assertEqual(self.cache.invalidate(self.pim, first.identifier), [ first.identifier ])
+        self.assertEqual(self.cache.find(self.pim, key), second.identifier)
+        self.assertEqual(self.cache.invalidate(self.pim), [ second.identifier ])
+        self.assertIsNone(self.cache.find(self.pim, key))
+        self.assertIsNotNone(self.pim.image_with_id(first.identifier))
+
+    def testInvalidateImageBeingBuilt(self):
+        key = build_cache_key(TEMPLATE)
+        building = self._image(key, 'BUILDING')
+        self.assertEqual(self.cache.invalidate(self.pim, building.identifier), [ building.identifier ])
+        self.assertIsNone(self.cache.find(self.pim, key))
+        # The builder's own copy of the image still has the key until it finishes
+        self.assertEqual(building.cache_key, key)
+        building.status = 'COMPLETE'
+        self.pim.save_image(building)
+        self.assertIsNone(self.pim.image_with_id(building.identifier).cache_key)
+        self.assertIsNone(self.cache.find(self.pim, key))
+
+    def testCopyFileKeepsHoles(self):
+        source = os.path.join(self.storage_path, 'sparse')
+        with open(source, 'wb') as f:
+            f.write(b'a' * 4096)
+            f.seek(64 * 1024 * 1024)
+            f.write(b'b' * 4096)
+        destination = os.path.join(self.storage_path, 'copy')
+        copy_file(source, destination)
+        with open(source, 'rb') as src:
+            with open(destination, 'rb') as dst:
+                self.assertEqual(src.read(), dst.read())
+        self.assertLess(os.stat(destination).st_blocks * 512, 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
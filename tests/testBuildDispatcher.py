@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.JobScheduler import JobScheduler
+from imgfac.BuildDispatcher import BuildDispatcher
+from imgfac.TargetImage import TargetImage
+
+
+class MockBuilder(object):
+    def __init__(self):
+        self.target_image = TargetImage()
+        self.cancelled = None
+
+    def cancel(self, reason):
+        self.cancelled = reason
+        return True
+
+
+class testBuildDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.saved_instances = (ApplicationConfiguration._instance, NotificationCenter._instance,
+                                JobScheduler._instance, BuildDispatcher._instance)
+        ApplicationConfiguration._instance = None
+        NotificationCenter._instance = None
+        JobScheduler._instance = None
+        BuildDispatcher._instance = None
+        ApplicationConfiguration(configuration={'single_flight': 1})
+        self.dispatcher = BuildDispatcher()
+
+    def tearDown(self):
+        (ApplicationConfiguration._instance, NotificationCenter._instance,
+         JobScheduler._instance, BuildDispatcher._instance) = self.saved_instances
+
+    def testFlightKey(self):
+        key = self.dispatcher._single_flight_key('provider', 'image', None, {'callbacks': ['http://a/']}, ['ec2', 'secret', 'ec2'])
+        self.assertEqual(key, self.dispatcher._single_flight_key('provider', 'image', None, {'tenant': 'b'}, ['ec2', 'secret', 'ec2']))
+        self.assertNotEqual(key, self.dispatcher._single_flight_key('provider', 'image', None, None, ['ec2', 'other', 'ec2']))
+        self.assertNotIn('secret', key)
+        self.assertIsNone(self.dispatcher._single_flight_key('target', 'image', '<template/>', None, ['ec2']))
+        self.assertIsNone(self.dispatcher._single_flight_key('target', 'image', None, {'single_flight': 'false'}, ['ec2']))
+
+    def testFollowInFlightBuild(self):
+        key = self.dispatcher._single_flight_key('target', 'image', None, None, ['ec2'])
+        builder = MockBuilder()
+        with self.dispatcher.flights_lock:
+            self.assertIsNone(self.dispatcher._follow(key, 'target_image', None))
+            self.dispatcher._start_flight(key, builder, builder.target_image)
+            self.assertIs(self.dispatcher._follow(key, 'target_image', None), builder)
+        self.assertEqual(len(self.dispatcher.followers[builder.target_image.identifier]), 1)
+        builder.target_image.status = 'COMPLETE'
+        self.assertNotIn(key, self.dispatcher.in_flight)
+        self.assertNotIn(builder.target_image.identifier, self.dispatcher.followers)
+        with self.dispatcher.flights_lock:
+            self.assertIsNone(self.dispatcher._follow(key, 'target_image', None))
+
+    def testCancelBuild(self):
+        builder = MockBuilder()
+        self.dispatcher.builders[builder.target_image.identifier] = builder
+        self.assertTrue(self.dispatcher.cancel_build(builder.target_image.identifier, 'Stop'))
+        self.assertEqual(builder.cancelled, 'Stop')
+        self.assertFalse(self.dispatcher.cancel_build('unknown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
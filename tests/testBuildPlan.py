@@ -0,0 +1,111 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Lock
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BuildPlan import BuildPlan
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+from imgfac.ProviderImage import ProviderImage
+from imgfac.ImageFactoryException import ImageFactoryException
+
+
+class MockBuilder(object):
+    def __init__(self, base_image=None, target_image=None, provider_image=None):
+        self.base_image = base_image
+        self.target_image = target_image
+        self.provider_image = provider_image
+
+
+class MockDispatcher(object):
+    """
+    Starts nothing - the test finishes the images itself, in any order it likes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = [ ]
+
+    def _started(self, image, *args):
+        with self.lock:
+            self.started.append((image, args))
+        return image
+
+    def builder_for_base_image(self, template, parameters=None):
+        return MockBuilder(base_image=self._started(BaseImage(), template))
+
+    def builder_for_target_image(self, target, image_id=None, template=None, parameters=None):
+        return MockBuilder(target_image=self._started(TargetImage(), target, image_id))
+
+    def builder_for_provider_image(self, provider, credentials, target, image_id=None, template=None, parameters=None):
+        return MockBuilder(provider_image=self._started(ProviderImage(), provider, image_id))
+
+
+class testBuildPlan(unittest.TestCase):
+    def setUp(self):
+        self.saved_center = NotificationCenter._instance
+        NotificationCenter._instance = None
+        self.dispatcher = MockDispatcher()
+        self.targets = [ {'target': 'ec2', 'providers': [ {'provider': 'us-east-1', 'credentials': 'x'},
+                                                          {'provider': 'eu-west-1', 'credentials': 'x'} ]},
+                         {'target': 'openstack-kvm', 'providers': [ {'provider': 'cloud', 'credentials': 'y'} ]} ]
+
+    def tearDown(self):
+        NotificationCenter._instance = self.saved_center
+
+    def _started(self, count):
+        for i in range(100):
+            with self.dispatcher.lock:
+                if len(self.dispatcher.started) >= count:
+                    return list(self.dispatcher.started)
+            time.sleep(0.01)
+        self.fail("Expected %d builds to be started, got %d" % (count, len(self.dispatcher.started)))
+
+    def testNodesStartWhenInputsComplete(self):
+        plan = BuildPlan(template='<template/>', targets=self.targets, dispatcher=self.dispatcher)
+        plan.start()
+        started = self._started(1)
+        base = started[0][0]
+        self.assertEqual(plan.status, 'BUILDING')
+        base.status = 'COMPLETE'
+        started = self._started(3)
+        ec2, openstack = [ image for image, args in started[1:] ]
+        self.assertEqual(started[1][1], ('ec2', base.identifier))
+        openstack.status = 'COMPLETE'
+        started = self._started(4)
+        self.assertEqual(started[3][1], ('cloud', openstack.identifier))
+        ec2.status = 'FAILED'
+        started[3][0].status = 'COMPLETE'
+        time.sleep(0.05)
+        self.assertEqual(len(self.dispatcher.started), 4)
+        nodes = plan.as_dict()['nodes']
+        self.assertEqual([ node['status'] for node in nodes ], [ 'COMPLETE', 'FAILED', 'SKIPPED', 'SKIPPED', 'COMPLETE', 'COMPLETE' ])
+        self.assertEqual(plan.status, 'FAILED')
+        self.assertIsNotNone(plan.finished_at)
+        self.assertNotIn('credentials', nodes[2])
+
+    def testInvalidPlans(self):
+        self.assertRaises(ImageFactoryException, BuildPlan, template='<template/>', targets=[ ], dispatcher=self.dispatcher)
+        self.assertRaises(ImageFactoryException, BuildPlan, template='<template/>', base_image_id='id',
+                          targets=self.targets, dispatcher=self.dispatcher)
+        self.assertRaises(ImageFactoryException, BuildPlan, template='<template/>',
+                          targets=[ {'target': 'ec2', 'providers': [ {'provider': 'us-east-1'} ]} ], dispatcher=self.dispatcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BuildRecovery import BuildRecovery
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+from imgfac.ProviderImage import ProviderImage
+
+
+class MockDispatcher(object):
+    def __init__(self):
+        self.resumed = [ ]
+
+    def builder_for_interrupted_image(self, image):
+        self.resumed.append(image.identifier)
+
+
+class testBuildRecovery(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+        self.dispatcher = MockDispatcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _image(self, image_class, status, checkpoints=None, body=None):
+        image = image_class()
+        image.template = '<template/>'
+        image.checkpoints = checkpoints if checkpoints else { }
+        self.pim.add_image(image)
+        if body:
+            with open(image.data, 'w') as f:
+                f.write(body)
+        image._status = status
+        self.pim.save_image(image)
+        return image
+
+    def testRecover(self):
+        target = self._image(TargetImage, 'PENDING')
+        iciclized = self._image(BaseImage, 'BUILDING', checkpoints={'install_done': { }, 'icicle_done': { }}, body='disk')
+        installed = self._image(BaseImage, 'BUILDING', checkpoints={'install_done': { }}, body='disk')
+        provider = self._image(ProviderImage, 'BUILDING', checkpoints={'snapshot_taken': {'snapshot_id': 'snap-1'}})
+        deleting = self._image(TargetImage, 'DELETING')
+        complete = self._image(BaseImage, 'COMPLETE')
+
+        report = BuildRecovery(self.pim, self.dispatcher).recover()
+        self.assertEqual(report['completed'], [ iciclized.identifier ])
+        self.assertEqual(sorted(report['failed']), sorted([ provider.identifier, deleting.identifier ]))
+        # Base images are resumed before the target images that may depend on them
+        self.assertEqual(self.dispatcher.resumed, [ installed.identifier, target.identifier ])
+        self.assertEqual(self.pim.image_with_id(iciclized.identifier).status, 'COMPLETE')
+        failed = self.pim.image_with_id(provider.identifier)
+        self.assertEqual(failed.status, 'FAILED')
+        self.assertIn('snapshot_taken', failed.status_detail['error'])
+        self.assertIn('resume_from=%s' % (provider.identifier), failed.status_detail['error'])
+        self.assertEqual(self.pim.image_with_id(deleting.identifier).status, 'DELETEFAILED')
+        self.assertEqual(self.pim.image_with_id(complete.identifier).status, 'COMPLETE')
+
+    def testRecoverWithoutResume(self):
+        base = self._image(BaseImage, 'BUILDING', checkpoints={'install_done': { }}, body='disk')
+        # Still running on its worker - followed again either way
+        remote = ProviderImage()
+        remote.farm_node = 'http://localhost:8076'
+        self.pim.add_image(remote)
+        remote._status = 'BUILDING'
+        self.pim.save_image(remote)
+        report = BuildRecovery(self.pim, self.dispatcher, resume=False).recover()
+        self.assertEqual(report['failed'], [ base.identifier ])
+        self.assertEqual(self.dispatcher.resumed, [ remote.identifier ])
+        self.assertEqual(self.pim.image_with_id(base.identifier).status, 'FAILED')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import json
+from threading import Event, Lock
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.CallbackDelivery import CallbackDelivery
+
+
+class MockResponse(object):
+    def __init__(self, status):
+        self.status = status
+
+
+class MockEndpoint(object):
+    """
+    Stands in for the callback receivers - records every PUT and answers with the
+    statuses queued for its URL, 200 once they run out.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.received = [ ]
+        self.statuses = { }
+        self.connections = 0
+        self.gate = Event()
+        self.gate.set()
+        self.entered = Event()
+
+    def connection(self):
+        with self.lock:
+            self.connections += 1
+        return self
+
+    def request(self, url, method, body=None, headers=None):
+        self.entered.set()
+        self.gate.wait()
+        with self.lock:
+            self.received.append((url, json.loads(body)['n']))
+            statuses = self.statuses.get(url, [ ])
+            return MockResponse(statuses.pop(0) if statuses else 200), b''
+
+
+class testCallbackDelivery(unittest.TestCase):
+    def setUp(self):
+        self.saved_instances = (ApplicationConfiguration._instance, CallbackDelivery._instance)
+        ApplicationConfiguration._instance = None
+        CallbackDelivery._instance = None
+        ApplicationConfiguration(configuration={'callback_workers': 2, 'callback_max_attempts': 3, 'callback_backoff': 0.01})
+        self.endpoint = MockEndpoint()
+        self.delivery = CallbackDelivery(http_factory=self.endpoint.connection)
+
+    def tearDown(self):
+        self.endpoint.gate.set()
+        (ApplicationConfiguration._instance, CallbackDelivery._instance) = self.saved_instances
+
+    def _received(self, url):
+        return [ n for received_url, n in self.endpoint.received if received_url == url ]
+
+    def testOrderingAndCoalescing(self):
+        # A slow endpoint - updates pile up behind the one being sent
+        self.endpoint.gate.clear()
+        self.delivery.enqueue('http://a/cb', 'image-1', {'n': 0})
+        self.assertTrue(self.endpoint.entered.wait(5))
+        for n in range(1, 5):
+            self.delivery.enqueue('http://a/cb', 'image-1', {'n': n})
+        self.endpoint.gate.set()
+        self.assertTrue(self.delivery.wait([ ('http://a/cb', 'image-1') ], timeout=5))
+        # The first went out straight away, the rest collapsed to the newest
+        self.assertEqual(self._received('http://a/cb'), [ 0, 4 ])
+        stats = self.delivery.stats()
+        self.assertEqual((stats['delivered'], stats['coalesced'], stats['queued']), (2, 3, 0))
+        self.assertEqual(stats['latency']['count'], 2)
+        self.assertLessEqual(stats['latency']['p50'], stats['latency']['max'])
+
+    def testRetryWithBackoff(self):
+        self.endpoint.statuses['http://a/retry'] = [ 503, 503 ]
+        self.endpoint.statuses['http://a/rejected'] = [ 404 ]
+        self.endpoint.statuses['http://a/down'] = [ 503, 503, 503 ]
+        for url in ('http://a/retry', 'http://a/rejected', 'http://a/down'):
+            self.delivery.enqueue(url, 'image-1', {'n': 1})
+        keys = [ (url, 'image-1') for url in ('http://a/retry', 'http://a/rejected', 'http://a/down') ]
+        self.assertTrue(self.delivery.wait(keys, timeout=5))
+        self.assertEqual(self._received('http://a/retry'), [ 1, 1, 1 ])
+        # Rejected updates are not tried again and attempts run out
+        self.assertEqual(self._received('http://a/rejected'), [ 1 ])
+        self.assertEqual(self._received('http://a/down'), [ 1, 1, 1 ])
+        stats = self.delivery.stats()
+        self.assertEqual((stats['delivered'], stats['failed'], stats['retried']), (1, 2, 4))
+
+    def testConnectionsReused(self):
+        for n in range(10):
+            self.delivery.enqueue('http://a/cb', 'image-%d' % (n), {'n': n})
+            self.assertTrue(self.delivery.wait([ ('http://a/cb', 'image-%d' % (n)) ], timeout=5))
+        self.assertEqual(self.endpoint.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
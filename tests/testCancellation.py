@@ -0,0 +1,96 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import time
+from threading import Thread, Timer
+from imgfac.Cancellation import CancellationToken, BuildCancelled
+from imgfac.ImageStatusWaiter import ImageStatusWaiter
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BaseImage import BaseImage
+
+
+class testCancellationToken(unittest.TestCase):
+    def testCheckAndCallbacks(self):
+        token = CancellationToken()
+        called = [ ]
+        token.on_cancel(lambda: called.append('first'))
+        token.on_cancel(lambda: called.append('second'))
+        removed = lambda: called.append('removed')
+        token.on_cancel(removed)
+        token.remove(removed)
+        token.check()
+        self.assertTrue(token.cancel('No longer needed'))
+        self.assertFalse(token.cancel('Again'))
+        self.assertEqual(called, [ 'second', 'first' ])
+        self.assertRaises(BuildCancelled, token.check)
+        self.assertEqual(token.reason, 'No longer needed')
+        # Registered too late to be told - run straight away
+        token.on_cancel(lambda: called.append('late'))
+        self.assertEqual(called, [ 'second', 'first', 'late' ])
+
+    def testFailingCallbackDoesNotStopOthers(self):
+        token = CancellationToken()
+        called = [ ]
+        token.on_cancel(lambda: called.append('ran'))
+        token.on_cancel(lambda: 1 / 0)
+        token.cancel()
+        self.assertEqual(called, [ 'ran' ])
+
+    def testSleepEndsOnCancel(self):
+        token = CancellationToken()
+        Timer(0.1, token.cancel).start()
+        start = time.time()
+        self.assertRaises(BuildCancelled, token.sleep, 30)
+        self.assertTrue(time.time() - start < 5)
+
+
+class testCancelledWait(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+        self.image = BaseImage()
+        self.pim.add_image(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+        NotificationCenter().remove_observer(ImageStatusWaiter(), 'status_changed', 'image.status')
+        ImageStatusWaiter._instance = None
+
+    def testWaitForFinalStatusEndsOnCancel(self):
+        token = CancellationToken()
+        errors = [ ]
+        def wait():
+            try:
+                ImageStatusWaiter().wait_for_final_status(self.image.identifier, self.pim, poll_interval=30, cancellation=token)
+            except BuildCancelled as e:
+                errors.append(e)
+        waiter = Thread(target=wait)
+        waiter.start()
+        time.sleep(0.1)
+        start = time.time()
+        token.cancel()
+        waiter.join(5)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual({ }, dict(ImageStatusWaiter().waiters))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import time
+import os
+import sys
+import json
+import socket
+import subprocess
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.PersistentImageManager import PersistentImageManager
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.FarmCoordinator import FarmCoordinator, supports_target
+from imgfac.FarmWorker import FarmWorker
+from imgfac.FarmClient import FarmClient, FarmRequestFailed
+from imgfac.BaseImage import BaseImage
+
+FEDORA = ('Fedora', '20', 'x86_64')
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_TEMPLATE = """<template>
+  <name>farm</name>
+  <os>
+    <name>MockOS_A</name>
+    <version>1</version>
+    <arch>x86_64</arch>
+    <install type='url'><url>http://example.com/</url></install>
+  </os>
+</template>"""
+# Started like imagefactoryd, with the configuration passed as the only argument
+DAEMON = """
+import sys, json
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+app_config = ApplicationConfiguration(configuration=json.loads(sys.argv[1])).configuration
+from imgfac.PluginManager import PluginManager
+from imgfac.PersistentImageManager import PersistentImageManager
+from imgfac.BuildDispatcher import BuildDispatcher
+from imgfac.FarmCoordinator import FarmCoordinator
+from imgfac.FarmWorker import FarmWorker
+from imgfac.rest.bottle import run
+from imgfac.rest.RESTv2 import rest_api
+from imgfac.rest.RESTtools import rest_server
+PluginManager(app_config['plugins']).load()
+PersistentImageManager.default_manager()
+BuildDispatcher()
+if app_config['farm_role'] == 'coordinator':
+    FarmCoordinator().start()
+else:
+    FarmWorker().start()
+server, server_options = rest_server(app_config)
+run(server=server, app=rest_api, host=app_config['address'], port=app_config['port'], quiet=True, **server_options)
+"""
+
+
+class MockClient(object):
+    def __init__(self):
+        self.requests = [ ]
+        self.responses = { }
+
+    def request(self, method, url, body=None):
+        self.requests.append((method, url, body))
+        response = self.responses.get(url)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class testFarmCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.saved_instances = (ApplicationConfiguration._instance, NotificationCenter._instance,
+                                FarmCoordinator._instance, FarmWorker._instance, PersistentImageManager._default_manager)
+        ApplicationConfiguration._instance = None
+        NotificationCenter._instance = None
+        FarmCoordinator._instance = None
+        FarmWorker._instance = None
+        self.storage_path = tempfile.mkdtemp()
+        PersistentImageManager._default_manager = FilePersistentImageManager(self.storage_path)
+        ApplicationConfiguration(configuration={'farm_role': 'coordinator', 'farm_url': 'http://localhost:8075',
+                                                'farm_heartbeat_interval': 10})
+        self.farm = FarmCoordinator()
+        self.farm.client = MockClient()
+        self.pim = self.farm.pim
+
+    def tearDown(self):
+        self.farm.stop()
+        (ApplicationConfiguration._instance, NotificationCenter._instance, FarmCoordinator._instance,
+         FarmWorker._instance, PersistentImageManager._default_manager) = self.saved_instances
+        shutil.rmtree(self.storage_path)
+
+    def _register(self, worker_id, targets, kvm=True, running=0, free_disk=1000, now=None):
+        return self.farm.register({'id': worker_id, 'url': 'http://localhost:%s/' % (worker_id),
+                                   'capabilities': {'targets': targets, 'kvm': kvm, 'free_disk': free_disk,
+                                                    'jobs': {'base': {'pool_size': 2, 'running': running, 'queued': 0},
+                                                             'target': {'pool_size': 2, 'running': running, 'queued': 0},
+                                                             'provider': {'pool_size': 4, 'running': 0, 'queued': 0}}}},
+                                  now=now)
+
+    def testSupportsTarget(self):
+        targets = [ [ 'Fedora', None, None ], [ 'ec2' ] ]
+        self.assertTrue(supports_target(targets, FEDORA))
+        self.assertTrue(supports_target(targets, 'ec2'))
+        self.assertFalse(supports_target(targets, ('RHEL-7', '1', 'x86_64')))
+        self.assertFalse(supports_target(targets, 'openstack-kvm'))
+
+    def testRegistrationExpires(self):
+        self.assertRaises(Exception, self.farm.register, {'url': 'http://localhost:1'})
+        registration = self._register('8076', [ [ 'Fedora', None, None ] ], now=1000)
+        self.assertEqual(registration['url'], 'http://localhost:8076')
+        self.assertEqual(registration['heartbeat_interval'], 10)
+        self.assertEqual(self.farm.place('base', FEDORA, now=1020), '8076')
+        # Three missed heartbeats and it is no longer given builds
+        self.assertIsNone(self.farm.place('base', FEDORA, now=1031))
+        self.assertEqual([ worker['alive'] for worker in self.farm.workers_as_list(now=1031) ], [ False ])
+        self._register('8076', [ [ 'Fedora', None, None ] ], now=1031)
+        self.assertEqual(self.farm.place('base', FEDORA, now=1032), '8076')
+
+    def testPlacement(self):
+        now = time.time()
+        self._register('8076', [ [ 'Fedora', None, None ], [ 'ec2' ] ], running=2, now=now)
+        self._register('8077', [ [ 'Fedora', None, None ], [ 'ec2' ] ], running=0, free_disk=10, now=now)
+        self._register('8078', [ [ 'Fedora', None, None ], [ 'ec2' ] ], kvm=False, free_disk=5000, now=now)
+        self._register('8079', [ [ 'Fedora', None, None ] ], running=0, free_disk=20, now=now)
+        # Capable of the stage, then least busy, then most free disk
+        self.assertEqual(self.farm.place('base', FEDORA, now=now), '8079')
+        self.assertEqual(self.farm.place('target', FEDORA, 'ec2', now=now), '8077')
+        self.assertIsNone(self.farm.place('target', FEDORA, 'openstack-kvm', now=now))
+        # Pushes need no KVM
+        self.assertEqual(self.farm.place('provider', FEDORA, 'ec2', now=now), '8078')
+        # Kept next to the body of the image the stage starts from, however busy that is
+        base = BaseImage()
+        base.farm_node = '8076'
+        self.assertEqual(self.farm.place('target', FEDORA, 'ec2', input_image=base, now=now), '8076')
+        base.farm_node = '8079'
+        self.assertEqual(self.farm.place('target', FEDORA, 'ec2', input_image=base, now=now), '8077')
+
+    def testFollowRemoteBuild(self):
+        self._register('8076', [ [ 'Fedora', None, None ] ])
+        self.statuses = [ ]
+        finished = [ ]
+        NotificationCenter().add_observer(self, '_status_changed', 'image.status')
+        image = BaseImage()
+        image.farm_node = '8076'
+        self.pim.add_image(image)
+        url = 'http://localhost:8076/imagefactory/base_images/%s' % (image.identifier)
+        self.farm.client.responses[url] = {'base_image': {'status': 'BUILDING', 'percent_complete': 40, 'icicle': None,
+                                                          'status_detail': {'activity': 'Installing', 'error': None},
+                                                          'farm_node': None}}
+        self.farm.follow(image, finished=finished.append)
+        self.farm.poll()
+        self.assertEqual(image.status, 'BUILDING')
+        self.assertEqual(image.percent_complete, 40)
+        self.assertEqual(image.farm_node, '8076')
+        self.assertTrue(self.farm.is_following(image.identifier))
+        self.farm.client.responses[url]['base_image'].update({'status': 'COMPLETE', 'icicle': '<icicle/>'})
+        self.farm.poll()
+        self.assertEqual(finished, [ image ])
+        self.assertFalse(self.farm.is_following(image.identifier))
+        stored = self.pim.image_with_id(image.identifier)
+        self.assertEqual((stored.status, stored.icicle, stored.farm_node), ('COMPLETE', '<icicle/>', '8076'))
+        self.assertEqual(self.statuses, [ 'BUILDING', 'COMPLETE' ])
+
+        # A worker that lost the image fails it here
+        lost = BaseImage()
+        lost.farm_node = '8076'
+        self.pim.add_image(lost)
+        self.farm.client.responses['http://localhost:8076/imagefactory/base_images/%s' % (lost.identifier)] = \
+            FarmRequestFailed(404, 'Not found')
+        self.farm.follow(lost)
+        self.farm.poll()
+        self.assertEqual(lost.status, 'FAILED')
+        self.assertIn('8076', lost.status_detail['error'])
+
+    def _status_changed(self, notification):
+        self.statuses.append(notification.user_info['new_status'])
+
+    def testInputSpecAndImport(self):
+        base = BaseImage()
+        base.template = '<template/>'
+        base.icicle = '<icicle/>'
+        self.pim.add_image(base)
+        with open(base.data, 'w') as body:
+            body.write('disk')
+        spec = self.farm.input_spec(base)
+        self.assertEqual(spec['body_url'], 'http://localhost:8075/imagefactory/base_images/%s/raw_image' % (base.identifier))
+        base.farm_node = '8076'
+        self._register('8076', [ ])
+        self.assertEqual(self.farm.input_spec(base)['body_url'],
+                         'http://localhost:8076/imagefactory/base_images/%s/raw_image' % (base.identifier))
+
+        # The worker end, with a storage of its own and the body fetched from a file URL
+        worker_path = tempfile.mkdtemp()
+        try:
+            worker = FarmWorker()
+            worker.pim = FilePersistentImageManager(worker_path)
+            worker.client = FarmClient()
+            spec['body_url'] = 'file://%s' % (base.data)
+            worker.import_inputs([ spec ])
+            for i in range(100):
+                copy = worker.pim.image_with_id(base.identifier)
+                if copy.status == 'COMPLETE':
+                    break
+                time.sleep(0.01)
+            self.assertEqual((copy.status, copy.template, copy.icicle), ('COMPLETE', '<template/>', '<icicle/>'))
+            with open(copy.data) as body:
+                self.assertEqual(body.read(), 'disk')
+            self.assertRaises(Exception, worker.import_inputs, [ {'_type': 'ProviderImage', 'id': 'x', 'body_url': 'file:///x'} ])
+        finally:
+            shutil.rmtree(worker_path)
+
+
+class testFarmOverHTTP(unittest.TestCase):
+    """
+    A coordinator and a worker, each a factory process of its own with its own
+    storage, talking to each other over HTTP on localhost.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.plugins = os.path.join(self.path, 'plugins')
+        os.mkdir(self.plugins)
+        for plugin in ('MockOS', 'MockCloud'):
+            shutil.copy(os.path.join(REPO_PATH, 'imagefactory_plugins', plugin, plugin + '.info'), self.plugins)
+        self.client = FarmClient(timeout=10)
+        self.daemons = [ ]
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(self.path)
+
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def _start(self, name, **farm):
+        port = self._free_port()
+        url = 'http://127.0.0.1:%d' % (port)
+        storage_path = os.path.join(self.path, name)
+        with open(os.path.join(REPO_PATH, 'imagefactory.conf')) as conf:
+            app_config = json.load(conf)
+        app_config.update({'address': '127.0.0.1', 'port': port, 'no_ssl': 1, 'no_oauth': 1, 'plugins': self.plugins,
+                           'imgdir': storage_path, 'tmpdir': storage_path, 'timeout': 60,
+                           'image_manager_args': {'storage_path': storage_path}, 'rest_server': 'wsgiref',
+                           'gc_interval': 0, 'farm_url': url, 'farm_heartbeat_interval': 1, 'farm_poll_interval': 0.2})
+        app_config.update(farm)
+        self.daemons.append(subprocess.Popen([ sys.executable, '-c', DAEMON, json.dumps(app_config) ], cwd=REPO_PATH))
+        self._wait_for(lambda: self.client.request('GET', url + '/imagefactory'))
+        return url
+
+    def _wait_for(self, condition, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            for daemon in self.daemons:
+                self.assertIsNone(daemon.poll(), 'A factory exited with status %s' % (daemon.returncode))
+            try:
+                result = condition()
+                if result:
+                    return result
+            except Exception:
+                if time.time() > deadline:
+                    raise
+            if time.time() > deadline:
+                self.fail('Timed out waiting on the factories')
+            time.sleep(0.2)
+
+    def _final(self, url, collection, image_id):
+        def finished():
+            image = self.client.request('GET', '%s/imagefactory/%s/%s' % (url, collection, image_id))[collection[0:-1]]
+            return image if image['status'] in ('COMPLETE', 'FAILED') else None
+        return self._wait_for(finished)
+
+    def testPushOnWorker(self):
+        coordinator = self._start('coordinator', farm_role='coordinator')
+        # Built by the coordinator itself - there is no worker yet
+        target_image = self.client.request('POST', coordinator + '/imagefactory/target_images',
+                                           {'target_image': {'target': 'MockCloud', 'template': MOCK_TEMPLATE}})['target_image']
+        target_image = self._final(coordinator, 'target_images', target_image['id'])
+        self.assertEqual(target_image['status'], 'COMPLETE', target_image['status_detail'])
+
+        worker = self._start('worker', farm_role='worker', farm_coordinator=coordinator)
+        self._wait_for(lambda: [ registered for registered in
+                                 self.client.request('GET', coordinator + '/imagefactory/farm/workers')['workers']
+                                 if (registered['id'] == worker) and registered['alive'] ])
+
+        provider_image = self.client.request('POST', coordinator + '/imagefactory/provider_images',
+                                             {'provider_image': {'target': 'MockCloud', 'provider': 'mock',
+                                                                 'credentials': '<provider_credentials/>',
+                                                                 'target_image_id': target_image['id']}})['provider_image']
+        # Followed on the coordinator until the worker is done with it
+        provider_image = self._final(coordinator, 'provider_images', provider_image['id'])
+        self.assertEqual(provider_image['status'], 'COMPLETE', provider_image['status_detail'])
+        self.assertEqual(provider_image['farm_node'], worker)
+        self.assertTrue(provider_image['identifier_on_provider'])
+
+        # The worker built it under the same ID, from the body it fetched from the coordinator
+        on_worker = self._final(worker, 'provider_images', provider_image['id'])
+        self.assertEqual(on_worker['identifier_on_provider'], provider_image['identifier_on_provider'])
+        target_on_worker = self._final(worker, 'target_images', target_image['id'])
+        self.assertEqual(target_on_worker['status'], 'COMPLETE')
+        bodies = [ ]
+        for url in (coordinator, worker):
+            download = os.path.join(self.path, 'body-%d' % len(bodies))
+            self.client.download('%s/imagefactory/target_images/%s/raw_image' % (url, target_image['id']), download)
+            with open(download, 'rb') as body:
+                bodies.append(body.read())
+        self.assertTrue(bodies[0])
+        self.assertEqual(bodies[0], bodies[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
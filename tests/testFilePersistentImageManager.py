@@ -0,0 +1,300 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import time
+from threading import Thread
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.FileMetadataIndex import INDEX_FILENAME
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+from imgfac.NotificationCenter import NotificationCenter
+
+
+class testFilePersistentImageManager(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _add_target_image(self, base_image_id, target='ec2', status='NEW'):
+        image = TargetImage()
+        image.base_image_id = base_image_id
+        image.target = target
+        image._status = status
+        self.pim.add_image(image)
+        return image
+
+    def testAddAndRetrieve(self):
+        image = BaseImage()
+        image.template = '<template/>'
+        self.pim.add_image(image)
+        fetched = self.pim.image_with_id(image.identifier)
+        self.assertEqual(fetched.identifier, image.identifier)
+        self.assertEqual(fetched.template, '<template/>')
+        self.assertIsNone(self.pim.image_with_id('no-such-image'))
+
+    def testIndexedQuery(self):
+        base = BaseImage()
+        self.pim.add_image(base)
+        t1 = self._add_target_image(base.identifier)
+        t2 = self._add_target_image(base.identifier, status='COMPLETE')
+        self._add_target_image('some-other-base')
+
+        found = self.pim.images_from_query({'type': 'TargetImage', 'base_image_id': base.identifier})
+        self.assertEqual(set([t1.identifier, t2.identifier]), set([i.identifier for i in found]))
+
+        found = self.pim.images_from_query({'base_image_id': base.identifier, 'status': 'COMPLETE'})
+        self.assertEqual([t2.identifier], [i.identifier for i in found])
+
+        # Keys outside the index are still honored
+        found = self.pim.images_from_query({'type': 'TargetImage', 'target': 'ec2', 'base_image_id': base.identifier})
+        self.assertEqual(2, len(found))
+
+        t2._status = 'FAILED'
+        self.pim.save_image(t2)
+        self.assertEqual([], self.pim.images_from_query({'base_image_id': base.identifier, 'status': 'COMPLETE'}))
+
+        self.pim.delete_image_with_id(t1.identifier)
+        found = self.pim.images_from_query({'type': 'TargetImage', 'base_image_id': base.identifier})
+        self.assertEqual([t2.identifier], [i.identifier for i in found])
+
+        # Build cache lookups are answered by the index alone
+        self.assertTrue(self.pim.index.covers({'cache_key': 'abc'}))
+        base.cache_key = 'abc'
+        self.pim.save_image(base)
+        self.assertEqual([base.identifier], self.pim.index.identifiers_matching({'cache_key': 'abc'}))
+
+    def testQueryForNoneSkipsImagesWithoutTheKey(self):
+        base = BaseImage()
+        self.pim.add_image(base)
+        target = self._add_target_image(None)
+        found = self.pim.images_from_query({'base_image_id': None})
+        self.assertEqual([target.identifier], [i.identifier for i in found])
+
+    def testIndexReconciledOnStartup(self):
+        base = BaseImage()
+        self.pim.add_image(base)
+        target = self._add_target_image(base.identifier)
+
+        # Simulate changes made while no manager was watching the store
+        metadata_path = os.path.join(self.storage_path, target.identifier + '.meta')
+        with open(metadata_path) as mdf:
+            metadata = json.load(mdf)
+        metadata['status'] = 'COMPLETE'
+        with open(metadata_path, 'w') as mdf:
+            json.dump(metadata, mdf)
+        os.utime(metadata_path, (0, 0))
+        os.remove(os.path.join(self.storage_path, base.identifier + '.meta'))
+
+        pim = FilePersistentImageManager(self.storage_path)
+        self.assertEqual([], pim.images_from_query({'type': 'BaseImage'}))
+        found = pim.images_from_query({'status': 'COMPLETE'})
+        self.assertEqual([target.identifier], [i.identifier for i in found])
+
+    def testIndexRebuiltWhenMissing(self):
+        base = BaseImage()
+        self.pim.add_image(base)
+        os.remove(os.path.join(self.storage_path, INDEX_FILENAME))
+        pim = FilePersistentImageManager(self.storage_path)
+        found = pim.images_from_query({'type': 'BaseImage'})
+        self.assertEqual([base.identifier], [i.identifier for i in found])
+
+    def testAtomicWriteLeavesNoTemporaryFiles(self):
+        image = BaseImage()
+        self.pim.add_image(image)
+        image.status_detail = {'activity': 'Testing', 'error': None}
+        self.pim.save_image(image)
+        leftovers = [ name for name in os.listdir(self.storage_path) if name.endswith('.tmp') ]
+        self.assertEqual([ ], leftovers)
+        with open(os.path.join(self.storage_path, image.identifier + '.meta')) as mdf:
+            self.assertEqual('Testing', json.load(mdf)['status_detail']['activity'])
+
+    def testWriteBehindCoalescesSaves(self):
+        pim = FilePersistentImageManager(self.storage_path, write_behind_window=60)
+        writes = [ ]
+        real_write = pim._write_metadata
+        def counting_write(image_id, serialized, meta):
+            writes.append(meta.get('percent_complete'))
+            real_write(image_id, serialized, meta)
+        pim._write_metadata = counting_write
+
+        image = BaseImage()
+        pim.add_image(image)
+        self.assertEqual(0, len(writes))
+        for percentage in range(10, 60, 10):
+            image._percent_complete = percentage
+            pim.save_image(image)
+        self.assertEqual(0, len(writes))
+        # Readers see the newest metadata even before it reaches the disk
+        self.assertEqual(50, pim.image_with_id(image.identifier).percent_complete)
+
+        # Terminal states are written immediately and replace anything pending
+        image._status = 'COMPLETE'
+        pim.save_image(image)
+        self.assertEqual([50], writes)
+        pim.flush()
+        self.assertEqual([50], writes)
+
+    def testFlushWritesPendingMetadata(self):
+        pim = FilePersistentImageManager(self.storage_path, write_behind_window=60)
+        image = BaseImage()
+        pim.add_image(image)
+        image._percent_complete = 42
+        pim.save_image(image)
+        pim.flush()
+        with open(os.path.join(self.storage_path, image.identifier + '.meta')) as mdf:
+            self.assertEqual(42, json.load(mdf)['percent_complete'])
+
+    def testFlushRecordsMtimeAfterPendingSave(self):
+        pim = FilePersistentImageManager(self.storage_path, write_behind_window=60)
+        image = BaseImage()
+        pim.add_image(image)
+        flushes = [ ]
+        real_update = pim.index.update
+        def racing_update(meta, mtime):
+            # Let a flush of the same entry run while the save records it as pending
+            if (mtime is None) and not flushes:
+                flushes.append(Thread(target=pim.flush))
+                flushes[0].start()
+                flushes[0].join(0.2)
+            real_update(meta, mtime)
+        pim.index.update = racing_update
+
+        image._percent_complete = 42
+        pim.save_image(image)
+        flushes[0].join()
+        self.assertEqual([image.identifier], pim.index.identifiers_matching({}, modified_before=time.time() + 60))
+
+    def testImageWithIdIsCached(self):
+        image = BaseImage()
+        image.template = '<template/>'
+        self.pim.add_image(image)
+        self.pim.image_with_id(image.identifier)
+        before = self.pim.cache_stats()
+        for i in range(5):
+            self.pim.image_with_id(image.identifier)
+        after = self.pim.cache_stats()
+        self.assertEqual(before['hits'] + 5, after['hits'])
+        self.assertEqual(before['misses'], after['misses'])
+
+        # Callers cannot corrupt the cached copy
+        fetched = self.pim.image_with_id(image.identifier)
+        fetched.status_detail['activity'] = 'Scribbled on'
+        self.assertNotEqual('Scribbled on', self.pim.image_with_id(image.identifier).status_detail['activity'])
+
+    def testCacheInvalidatedByChanges(self):
+        image = BaseImage()
+        self.pim.add_image(image)
+        self.assertEqual('NEW', self.pim.image_with_id(image.identifier).status)
+
+        image._status = 'BUILDING'
+        self.pim.save_image(image)
+        self.assertEqual('BUILDING', self.pim.image_with_id(image.identifier).status)
+
+        # A write from outside this manager, e.g. another process sharing the store
+        other = FilePersistentImageManager(self.storage_path)
+        image._status = 'COMPLETE'
+        other.save_image(image)
+        self.assertEqual('COMPLETE', self.pim.image_with_id(image.identifier).status)
+
+    def testLoadingDoesNotPostNotifications(self):
+        image = BaseImage()
+        image._status = 'COMPLETE'
+        self.pim.add_image(image)
+        received = [ ]
+        observer = MockObserver(received)
+        NotificationCenter().add_observer(observer, 'receive', 'image.status')
+        try:
+            self.assertEqual('COMPLETE', self.pim.image_with_id(image.identifier).status)
+        finally:
+            NotificationCenter().remove_observer(observer, 'receive', 'image.status')
+        self.assertEqual([ ], received)
+
+    def testDedupeCompletedBodies(self):
+        pim = FilePersistentImageManager(os.path.join(self.storage_path, 'dedupe'), dedupe_bodies=True)
+        images = [ ]
+        for i in range(2):
+            image = TargetImage()
+            pim.add_image(image)
+            with open(image.data, 'wb') as body:
+                body.write(b'identical target image')
+            pim.save_image(image)
+            images.append(image)
+        self.assertNotEqual(os.stat(images[0].data).st_ino, os.stat(images[1].data).st_ino)
+        for image in images:
+            image._status = 'COMPLETE'
+            pim.save_image(image)
+        # Deduplicated in the background
+        self.assertTrue(pim.blob_store.wait(5))
+        self.assertEqual(os.stat(images[0].data).st_ino, os.stat(images[1].data).st_ino)
+        self.assertEqual(pim.blob_store.usage()['blobs'], 1)
+        # A body left behind by a failed delete keeps its blob
+        os.remove(os.path.join(pim.storage_path, images[0].identifier + '.meta'))
+        pim.delete_image_with_id(images[0].identifier)
+        self.assertTrue(os.path.isfile(images[0].data))
+        self.assertIsNotNone(pim.blob_store.digest_for(images[0].identifier))
+        os.remove(images[0].data)
+        pim.blob_store.release(images[0].identifier)
+        pim.delete_image_with_id(images[1].identifier)
+        self.assertEqual(pim.blob_store.usage()['blobs'], 0)
+
+    def testPagedQueries(self):
+        images = [ ]
+        for i in range(7):
+            image = BaseImage()
+            image._status = 'COMPLETE' if i % 2 else 'FAILED'
+            self.pim.add_image(image)
+            images.append(image)
+        ids = sorted([ image.identifier for image in images ])
+
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, limit=3))
+        self.assertEqual(ids[0:3], [ metadata['identifier'] for metadata in page ])
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, limit=3, after=page[-1]['identifier']))
+        self.assertEqual(ids[3:6], [ metadata['identifier'] for metadata in page ])
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, offset=5))
+        self.assertEqual(ids[5:], [ metadata['identifier'] for metadata in page ])
+
+        completed = sorted([ image.identifier for image in images if image.status == 'COMPLETE' ])
+        page = list(self.pim.metadata_from_query({'status': 'COMPLETE'}, offset=1, limit=1))
+        self.assertEqual(completed[1:2], [ metadata['identifier'] for metadata in page ])
+        # Same again with a key that has to be checked outside the index
+        page = list(self.pim.metadata_from_query({'status': 'COMPLETE', 'parameters': { }}, offset=1, limit=1))
+        self.assertEqual(completed[1:2], [ metadata['identifier'] for metadata in page ])
+
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, fields=['status'], limit=1))
+        self.assertEqual(set(['type', 'identifier', 'status']), set(page[0].keys()))
+
+        self.assertEqual([ ], list(self.pim.metadata_from_query({'type': 'BaseImage'}, modified_after=time.time() + 3600)))
+        self.assertEqual(7, len(list(self.pim.metadata_from_query({'type': 'BaseImage'}, modified_before=time.time() + 3600))))
+
+
+class MockObserver(object):
+    def __init__(self, received):
+        self.received = received
+
+    def receive(self, notification):
+        self.received.append(notification)
+
+
+if __name__ == '__main__':
+    unittest.main()
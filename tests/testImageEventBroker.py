@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import json
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.ImageEventBroker import ImageEventBroker, image_event, event_stream, MAX_QUEUED_EVENTS
+from imgfac.BaseImage import BaseImage
+
+
+class testImageEventBroker(unittest.TestCase):
+    def setUp(self):
+        self.saved_instances = (NotificationCenter._instance, ImageEventBroker._instance)
+        NotificationCenter._instance = None
+        ImageEventBroker._instance = None
+        self.broker = ImageEventBroker()
+        self.image = BaseImage()
+        self.other = BaseImage()
+
+    def tearDown(self):
+        (NotificationCenter._instance, ImageEventBroker._instance) = self.saved_instances
+
+    def _parse(self, stream):
+        events = [ ]
+        for chunk in stream:
+            if not chunk.startswith(':'):
+                lines = chunk.strip().split('\n')
+                events.append((lines[0][len('event: '):], json.loads(lines[1][len('data: '):])))
+        return events
+
+    def testStatusAndCoalescedPercentages(self):
+        subscription = self.broker.subscribe([ self.image.identifier ])
+        self.image.status = 'BUILDING'
+        for percentage in range(1, 50):
+            self.image.percent_complete = percentage
+        # Not subscribed to
+        self.other.status = 'BUILDING'
+        self.image.status = 'COMPLETE'
+        self.image.percent_complete = 100
+        events = subscription.next_events(0)
+        self.assertEqual([ (event['event'], event.get('status'), event['percent_complete']) for event in events ],
+                         [ ('status', 'BUILDING', 0), ('percentage', None, 49), ('status', 'COMPLETE', 49),
+                           ('percentage', None, 100) ])
+        self.assertEqual(events[2]['old_status'], 'BUILDING')
+        self.assertEqual(subscription.next_events(0.01), [ ])
+        self.broker.unsubscribe(subscription)
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+    def testStreamMultipleImages(self):
+        ids = [ self.image.identifier, self.other.identifier ]
+        subscription = self.broker.subscribe(ids)
+        self.assertEqual(self.broker.subscriber_count(), 1)
+        snapshots = [ image_event(self.image), image_event(self.other) ]
+        self.image.status = 'BUILDING'
+        self.image.status = 'COMPLETE'
+        self.other.status = 'FAILED'
+        # Ends once every image is final, then unsubscribes
+        events = self._parse(event_stream(subscription, snapshots, keepalive=5))
+        self.assertEqual([ (name, event['id'], event['status']) for name, event in events ],
+                         [ ('status', self.image.identifier, 'NEW'), ('status', self.other.identifier, 'NEW'),
+                           ('status', self.image.identifier, 'BUILDING'), ('status', self.image.identifier, 'COMPLETE'),
+                           ('status', self.other.identifier, 'FAILED') ])
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+    def testSlowSubscriberDropped(self):
+        subscription = self.broker.subscribe([ self.image.identifier ])
+        for i in range(MAX_QUEUED_EVENTS + 1):
+            self.image.status = ('BUILDING', 'PENDING')[i % 2]
+        # What it missed is not sent - it gets the current state when it subscribes again
+        chunks = list(event_stream(subscription, [ ], keepalive=5))
+        self.assertEqual(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith(': too far behind'))
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import time
+from threading import Thread, Timer
+from imgfac.ImageStatusWaiter import ImageStatusWaiter
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BaseImage import BaseImage
+from imgfac.NotificationCenter import NotificationCenter
+
+
+class testImageStatusWaiter(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+        self.image = BaseImage()
+        self.pim.add_image(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+        # Leave the shared NotificationCenter as we found it
+        NotificationCenter().remove_observer(ImageStatusWaiter(), 'status_changed', 'image.status')
+        ImageStatusWaiter._instance = None
+
+    def testWakesOnNotification(self):
+        def finish():
+            self.image.status = 'COMPLETE'
+        Timer(0.2, finish).start()
+        start = time.time()
+        image = ImageStatusWaiter().wait_for_final_status(self.image.identifier, self.pim, poll_interval=30)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual('COMPLETE', image.status)
+        self.assertEqual({ }, dict(ImageStatusWaiter().waiters))
+
+    def testReturnsImmediatelyWhenAlreadyFinal(self):
+        self.image._status = 'FAILED'
+        self.pim.save_image(self.image)
+        image = ImageStatusWaiter().wait_for_final_status(self.image.identifier, self.pim, poll_interval=30)
+        self.assertEqual('FAILED', image.status)
+
+    def testFallsBackToPolling(self):
+        # Changes made by another process only show up in storage
+        def finish():
+            self.image._status = 'COMPLETE'
+            FilePersistentImageManager(self.storage_path).save_image(self.image)
+        Timer(0.2, finish).start()
+        image = ImageStatusWaiter().wait_for_final_status(self.image.identifier, self.pim,
+                                                          poll_interval=0.05, max_poll_interval=0.1)
+        self.assertEqual('COMPLETE', image.status)
+
+    def testIgnoresIntermediateStatus(self):
+        results = [ ]
+        waiter = Thread(target=lambda: results.append(
+            ImageStatusWaiter().wait_for_final_status(self.image.identifier, self.pim, poll_interval=30)))
+        waiter.start()
+        time.sleep(0.1)
+        self.image.status = 'BUILDING'
+        time.sleep(0.1)
+        self.assertEqual([ ], results)
+        self.image.status = 'COMPLETE'
+        waiter.join(5)
+        self.assertEqual('COMPLETE', results[0].status)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Event, Lock
+from imgfac.JobScheduler import JobScheduler
+from imgfac.ImageFactoryException import ImageFactoryException
+
+
+class MockImage(object):
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+class testJobScheduler(unittest.TestCase):
+    def setUp(self):
+        JobScheduler._instance = None
+        self.scheduler = JobScheduler(pool_sizes={'base': 2, 'target': 1, 'provider': 1})
+        self.release = Event()
+        self.lock = Lock()
+        self.order = [ ]
+        self.running = 0
+        self.max_running = 0
+
+    def tearDown(self):
+        self.release.set()
+        JobScheduler._instance = None
+
+    def _job(self, name):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.order.append(name)
+        self.release.wait(5)
+        with self.lock:
+            self.running -= 1
+
+    def _submit(self, stage, name, parameters=None):
+        return self.scheduler.submit(stage, self._job, {'name': name}, name, image=MockImage(name), parameters=parameters)
+
+    def testPoolSizeBoundsConcurrency(self):
+        jobs = [ self._submit('base', 'job%d' % i) for i in range(6) ]
+        time.sleep(0.2)
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(self.scheduler.stats()['base'], {'pool_size': 2, 'running': 2, 'queued': 4})
+        self.assertTrue(jobs[5].is_alive())
+        self.release.set()
+        for job in jobs:
+            job.join(5)
+            self.assertFalse(job.is_alive())
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(len(self.scheduler.workers['base']), 2)
+
+    def testPriorityAndTenantFairness(self):
+        blocker = self._submit('target', 'blocker')
+        time.sleep(0.1)
+        for i in range(3):
+            self._submit('target', 'a%d' % i, {'tenant': 'a'})
+        self._submit('target', 'b0', {'tenant': 'b'})
+        self._submit('target', 'urgent', {'tenant': 'b', 'priority': 10})
+        self.assertIsNone(self.scheduler.queue_position('blocker'))
+        self.assertEqual(self.scheduler.queue_position('urgent'), 1)
+        # Tenant a was first in line but b gets the next turn after a's first job
+        self.assertEqual(self.scheduler.queue_position('a0'), 2)
+        self.assertEqual(self.scheduler.queue_position('b0'), 3)
+        self.assertEqual(self.scheduler.queue_position('a2'), 5)
+        self.release.set()
+        blocker.join(5)
+        deadline = time.time() + 5
+        while (len(self.order) < 6) and (time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.order, [ 'blocker', 'urgent', 'a0', 'b0', 'a1', 'a2' ])
+
+    def testWithdrawQueuedJob(self):
+        blocker = self._submit('target', 'blocker')
+        queued = self._submit('target', 'queued')
+        time.sleep(0.1)
+        self.assertFalse(self.scheduler.withdraw(blocker))
+        self.assertTrue(self.scheduler.withdraw(queued))
+        self.assertFalse(self.scheduler.withdraw(queued))
+        self.assertEqual(self.scheduler.stats()['target']['queued'], 0)
+        self.release.set()
+        blocker.join(5)
+        time.sleep(0.1)
+        self.assertEqual(self.order, [ 'blocker' ])
+
+    def testAgingAndDeadlines(self):
+        self.scheduler.configure(aging_interval=60)
+        blocker = self._submit('target', 'blocker')
+        time.sleep(0.1)
+        old = self._submit('target', 'old')
+        self._submit('target', 'important', {'priority': 2})
+        self.assertEqual(self.scheduler.queue_position('important'), 1)
+        # Three minutes in the queue are worth three priority levels
+        old.submitted_at -= 180
+        self.assertEqual(self.scheduler.queue_position('old'), 1)
+        # Would miss its deadline unless started next
+        self._submit('target', 'due', {'deadline': time.time() + 60})
+        self.assertEqual(self.scheduler.queue_position('due'), 1)
+        self._submit('target', 'later', {'deadline': '2999-01-01T00:00:00Z'})
+        self.assertEqual(self.scheduler.queue_position('later'), 4)
+        self.release.set()
+        blocker.join(5)
+
+    def testPredictedStart(self):
+        self.scheduler.estimates['target'] = 100
+        blocker = self._submit('target', 'blocker')
+        time.sleep(0.1)
+        self._submit('target', 'first')
+        self._submit('target', 'second')
+        self.assertAlmostEqual(self.scheduler.predicted_start('first'), blocker.started_at + 100, delta=1)
+        self.assertAlmostEqual(self.scheduler.predicted_start('second'), blocker.started_at + 200, delta=1)
+        self.assertIsNone(self.scheduler.predicted_start('blocker'))
+        position, start = self.scheduler.queue_estimate('second')
+        self.assertEqual(position, 2)
+        self.assertAlmostEqual(start, blocker.started_at + 200, delta=1)
+        self.assertIsNone(self.scheduler.queue_estimate('blocker'))
+        self.release.set()
+        blocker.join(5)
+
+    def testBadStageOrPriority(self):
+        self.assertRaises(ImageFactoryException, self._submit, 'nosuchstage', 'x')
+        self.assertRaises(ImageFactoryException, self._submit, 'base', 'x', {'priority': 'high'})
+        self.assertRaises(ImageFactoryException, self._submit, 'base', 'x', {'deadline': 'tomorrow'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,14 +16,22 @@
 #   limitations under the License.
 
 import unittest
+import time
+from threading import Event
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
 from imgfac.NotificationCenter import NotificationCenter
 
 class testNotificationCenter(unittest.TestCase):
     def setUp(self):
+        self.saved_instances = (ApplicationConfiguration._instance, NotificationCenter._instance)
+        ApplicationConfiguration._instance = None
+        NotificationCenter._instance = None
+        ApplicationConfiguration(configuration={'notification_workers': 2, 'notification_queue_size': 100})
         self.notification_center = NotificationCenter()
 
     def tearDown(self):
         del self.notification_center
+        (ApplicationConfiguration._instance, NotificationCenter._instance) = self.saved_instances
 
     def testAddRemoveObservers(self):
         o1 = MockObserver()
@@ -77,12 +85,75 @@ class testNotificationCenter(unittest.TestCase):
         self.assertNotEqual(o2.notification.message, 'test3')
         self.assertNotEqual(o3.notification.message, 'test3')
 
+    def testObserverExceptionsIsolated(self):
+        o1 = MockObserver()
+        o2 = MockObserver()
+        nc = self.notification_center
+        nc.add_observer(o1, 'fail')
+        nc.add_observer(o2, 'receive')
+        # Registered twice, for 'all' and the message, but notified once
+        nc.add_observer(o2, 'receive', 'test')
+        nc.post_notification_with_info('test', self)
+        self.assertEqual(o2.received, [ 'test' ])
+
+    def testAsynchronousObservers(self):
+        slow = MockObserver()
+        slow.gate.clear()
+        fast = MockObserver()
+        nc = self.notification_center
+        nc.add_observer(slow, 'receive', 'test', asynchronous=True)
+        nc.add_observer(fast, 'receive', 'test')
+        for i in range(5):
+            # A blocked asynchronous observer holds up nobody
+            nc.post_notification_with_info('test', self, {'n': i})
+        self.assertEqual(len(fast.received), 5)
+        self.assertEqual(slow.received, [ ])
+        self.assertFalse(nc.wait_for_delivery(timeout=0.05))
+        slow.gate.set()
+        self.assertTrue(nc.wait_for_delivery(timeout=5))
+        self.assertEqual([ n.user_info['n'] for n in slow.notifications ], [ 0, 1, 2, 3, 4 ])
+
+    def testPostTimeIndependentOfObserverCount(self):
+        nc = self.notification_center
+        senders = [ object() for i in range(5000) ]
+        watched = senders[0]
+        nc.add_observer(MockObserver(), 'receive', 'image.status', watched)
+
+        def post_time():
+            best = None
+            for attempt in range(5):
+                start = time.time()
+                for i in range(1000):
+                    nc.post_notification_with_info('image.status', watched)
+                elapsed = time.time() - start
+                best = elapsed if (best is None) else min(best, elapsed)
+            return best
+
+        few = post_time()
+        # Many more observers, each for another image, as with a build per image
+        for sender in senders[1:]:
+            nc.add_observer(MockObserver(), 'receive', 'image.status', sender)
+        many = post_time()
+        self.assertLess(many, (few * 3) + 0.005)
+
 class MockObserver(object):
     def __init__(self):
         self.notification = None
+        self.notifications = [ ]
+        self.gate = Event()
+        self.gate.set()
+
+    @property
+    def received(self):
+        return [ notification.message for notification in self.notifications ]
 
     def receive(self, notification):
+        self.gate.wait()
         self.notification = notification
+        self.notifications.append(notification)
+
+    def fail(self, notification):
+        raise RuntimeError('Observer failed')
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+import threading
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BaseImage import BaseImage
+
+
+class testPersistentImage(unittest.TestCase):
+    def setUp(self):
+        self.saved_instance = NotificationCenter._instance
+        self.saved_config = ApplicationConfiguration._instance
+        NotificationCenter._instance = None
+        ApplicationConfiguration._instance = None
+        self.image = BaseImage()
+        self.notifications = [ ]
+        NotificationCenter().add_observer(self, 'receive', sender=self.image)
+
+    def tearDown(self):
+        NotificationCenter._instance = self.saved_instance
+        ApplicationConfiguration._instance = self.saved_config
+
+    def receive(self, notification):
+        self.notifications.append((notification.message, notification.user_info))
+
+    def testEveryPercentagePostedByDefault(self):
+        for percentage in range(1, 11):
+            self.image.percent_complete = percentage
+        self.image.percent_complete = 10
+        self.assertEqual(len(self.notifications), 10)
+
+    def testIntervalFromConfiguration(self):
+        ApplicationConfiguration(configuration={'percentage_notifications_per_second': 4})
+        self.assertEqual(BaseImage().percentage_interval, 0.25)
+        self.assertEqual(self.image.percentage_interval, 0)
+
+    def testPercentagesRateLimited(self):
+        self.image.percentage_interval = 0.1
+        for percentage in range(1, 101):
+            self.image.percent_complete = percentage
+        # The first straight away, the newest once the interval is up
+        self.assertEqual(self.notifications, [ ('image.percentage', {'old_percentage': 0, 'new_percentage': 1}) ])
+        time.sleep(0.3)
+        self.assertEqual(self.notifications[1:], [ ('image.percentage', {'old_percentage': 1, 'new_percentage': 100}) ])
+
+    def testStatusChangeFlushesPercentage(self):
+        self.image.percentage_interval = 10
+        self.image.percent_complete = 50
+        self.image.percent_complete = 100
+        self.image.status = 'COMPLETE'
+        self.assertEqual(self.notifications,
+                         [ ('image.percentage', {'old_percentage': 0, 'new_percentage': 50}),
+                           ('image.percentage', {'old_percentage': 50, 'new_percentage': 100}),
+                           ('image.status', {'old_status': 'NEW', 'new_status': 'COMPLETE'}) ])
+        self.assertIsNone(self.image._percentage_due)
+
+    def testOneThreadForAllImages(self):
+        images = [ BaseImage() for i in range(20) ]
+        for image in images:
+            image.percentage_interval = 0.1
+            image.percent_complete = 1
+        threads = threading.active_count()
+        for image in images:
+            image.percent_complete = 2
+        self.assertLessEqual(threading.active_count(), threads + 1)
+        time.sleep(0.3)
+        self.assertEqual([ image._percentage_due for image in images ], [ None ] * 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Thread, Lock
+from imgfac.PushFanout import PushFanout
+
+
+class MockImage(object):
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+
+class MockPlugin(object):
+    def __init__(self):
+        self.prepared = 0
+
+    def prepare_push_to_providers(self, builder, target, parameters):
+        time.sleep(0.05)
+        self.prepared += 1
+
+
+class MockBuilder(object):
+    running = 0
+    max_running = 0
+    lock = Lock()
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.provider_image = None
+        self.target_image = MockImage('target')
+        self.push_thread = None
+        self.submitted = False
+        self.pushed = False
+
+    def _submit_job(self, stage, image, target, kwargs, parameters):
+        # Saves the image and posts notifications - the fanout must not hold its lock
+        assert not kwargs['kwargs']['fanout'].lock.locked()
+        self.submitted = True
+        thread = Thread(target=target, kwargs=kwargs)
+        thread.start()
+        return thread
+
+    def _push_image_to_provider(self, fanout):
+        with MockBuilder.lock:
+            MockBuilder.running += 1
+            MockBuilder.max_running = max(MockBuilder.max_running, MockBuilder.running)
+        fanout.prepare(self.plugin, self, 'ec2', None)
+        time.sleep(0.05)
+        with MockBuilder.lock:
+            MockBuilder.running -= 1
+        self.pushed = True
+
+
+class testPushFanout(unittest.TestCase):
+    def setUp(self):
+        MockBuilder.running = 0
+        MockBuilder.max_running = 0
+
+    def testParallelismAndSharedPreparation(self):
+        plugin = MockPlugin()
+        fanout = PushFanout(parallelism=3)
+        builders = [ MockBuilder(plugin) for i in range(10) ]
+        for builder in builders:
+            fanout.enqueue(builder, {'fanout': fanout}, None)
+        self.assertTrue(fanout.join(10))
+        self.assertTrue(all([ builder.pushed for builder in builders ]))
+        self.assertEqual(MockBuilder.max_running, 3)
+        self.assertEqual(plugin.prepared, 1)
+
+    def testWithdrawPending(self):
+        plugin = MockPlugin()
+        fanout = PushFanout(parallelism=1)
+        builders = [ MockBuilder(plugin) for i in range(3) ]
+        for builder in builders:
+            fanout.enqueue(builder, {'fanout': fanout}, None)
+        self.assertFalse(fanout.is_pending(builders[0]))
+        self.assertTrue(fanout.is_pending(builders[2]))
+        self.assertEqual(fanout.withdraw(builders[2]), [ {'fanout': fanout} ])
+        self.assertEqual(fanout.withdraw(builders[2]), [ ])
+        self.assertTrue(fanout.join(10))
+        self.assertEqual([ builder.pushed for builder in builders ], [ True, True, False ])
+        self.assertFalse(builders[2].submitted)
+
+    def testPluginWithoutPreparation(self):
+        fanout = PushFanout(parallelism=2)
+        builder = MockBuilder(object())
+        fanout.enqueue(builder, {'fanout': fanout}, None)
+        self.assertTrue(fanout.join(10))
+        self.assertTrue(builder.pushed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import json
+import zlib
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.rest.bottle import request, CherryPyServer, WSGIRefServer
+from imgfac.rest.RESTtools import file_response, _http_date, rest_server, log_request, LOGGED_BODY_LIMIT, \
+                                  CherootServer, TunedWaitressServer
+
+CONTENT = bytes(range(256)) * 4
+
+
+class testFileResponse(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.storage_path, 'image.body')
+        with open(self.path, 'wb') as body:
+            body.write(CONTENT)
+        self.mtime = os.stat(self.path).st_mtime
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _get(self, compress=False, **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/body'}
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper()] = value
+        request.bind(environ)
+        return file_response(self.path, 'image', compress=compress)
+
+    def _read(self, response):
+        # Whatever the body is - a file, a FileRange or a generator - read it all and close it
+        body = response.body
+        if hasattr(body, 'read'):
+            data = b''
+            chunk = body.read()
+            while chunk:
+                data += chunk
+                chunk = body.read()
+            body.close()
+            return data
+        return b''.join(body)
+
+    def _etag(self):
+        response = self._get()
+        self._read(response)
+        return response.get_header('ETag')
+
+    def testFullDownload(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_header('Content-Length'), str(len(CONTENT)))
+        self.assertEqual(response.get_header('Accept-Ranges'), 'bytes')
+        self.assertEqual(self._read(response), CONTENT)
+
+    def testSingleRange(self):
+        response = self._get(range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_header('Content-Range'), 'bytes 10-19/%d' % len(CONTENT))
+        self.assertEqual(response.get_header('Content-Length'), '10')
+        self.assertEqual(self._read(response), CONTENT[10:20])
+
+    def testMultipleRanges(self):
+        response = self._get(range='bytes=0-1,100-103')
+        self.assertEqual(response.status_code, 206)
+        content_type = response.get_header('Content-Type')
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('boundary=')[1].encode('ascii')
+        expected = b''
+        for start, end in ((0, 1), (100, 103)):
+            expected += b'--' + boundary + b'\r\nContent-Type: application/octet-stream\r\n'
+            expected += b'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, end, len(CONTENT))
+            expected += CONTENT[start:end + 1] + b'\r\n'
+        expected += b'--' + boundary + b'--\r\n'
+        self.assertEqual(self._read(response), expected)
+
+    def testUnsatisfiableRange(self):
+        response = self._get(range='bytes=5000-6000')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.get_header('Content-Range'), 'bytes */%d' % len(CONTENT))
+
+    def testIfRange(self):
+        etag = self._etag()
+        # Unchanged since the first part was fetched - carry on with the range
+        response = self._get(range='bytes=10-19', if_range=etag)
+        self.assertEqual(response.status_code, 206)
+        self._read(response)
+        response = self._get(range='bytes=10-19', if_range=_http_date(self.mtime))
+        self.assertEqual(response.status_code, 206)
+        self._read(response)
+        # Changed - the whole file is sent again
+        for stale in ('"image-0-0"', _http_date(self.mtime - 3600)):
+            response = self._get(range='bytes=10-19', if_range=stale)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.get_header('Content-Range'))
+            self.assertEqual(self._read(response), CONTENT)
+
+    def testNotModified(self):
+        etag = self._etag()
+        self.assertEqual(self._get(if_none_match=etag).status_code, 304)
+        self.assertEqual(self._get(if_none_match='"other", W/%s' % etag).status_code, 304)
+        self.assertEqual(self._get(if_modified_since=_http_date(self.mtime)).status_code, 304)
+        self.assertEqual(self._get(if_modified_since=_http_date(self.mtime + 3600)).status_code, 304)
+        # If-None-Match takes precedence over If-Modified-Since
+        response = self._get(if_none_match='"other"', if_modified_since=_http_date(self.mtime))
+        self.assertEqual(response.status_code, 200)
+        self._read(response)
+        response = self._get(if_modified_since=_http_date(self.mtime - 3600))
+        self.assertEqual(response.status_code, 200)
+        self._read(response)
+
+    def testGzipOnlyForFullDownloads(self):
+        response = self._get(compress=True, accept_encoding='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_header('Content-Encoding'), 'gzip')
+        self.assertEqual(response.get_header('Vary'), 'Accept-Encoding')
+        self.assertTrue(response.get_header('ETag').startswith('W/'))
+        self.assertEqual(zlib.decompress(self._read(response), 16 + zlib.MAX_WBITS), CONTENT)
+        # Not without the client asking, never for a range and never unless allowed
+        for compress, headers in ((True, { }),
+                                  (True, {'accept_encoding': 'gzip', 'range': 'bytes=10-19'}),
+                                  (False, {'accept_encoding': 'gzip'})):
+            response = self._get(compress=compress, **headers)
+            self.assertIsNone(response.get_header('Content-Encoding'))
+            self._read(response)
+
+
+class testRestServer(unittest.TestCase):
+    def testAdapterAndOptions(self):
+        config = {'rest_threads': 12, 'rest_request_queue_size': 34, 'rest_keepalive_timeout': 5}
+        cherrypy_options = {'numthreads': 12, 'request_queue_size': 34, 'timeout': 5}
+        config['rest_server'] = 'cheroot'
+        self.assertEqual(rest_server(config), (CherootServer, cherrypy_options))
+        # Falls back to cheroot where cherrypy no longer has its own server
+        config['rest_server'] = 'cherrypy'
+        adapter, options = rest_server(config)
+        self.assertIn(adapter, (CherryPyServer, CherootServer))
+        self.assertEqual(options, cherrypy_options)
+        config['rest_server'] = 'waitress'
+        self.assertEqual(rest_server(config),
+                         (TunedWaitressServer, {'threads': 12, 'backlog': 34, 'channel_timeout': 5, 'send_bytes': 1}))
+        config['rest_server'] = 'wsgiref'
+        self.assertEqual(rest_server(config), (WSGIRefServer, { }))
+
+    def testDefaults(self):
+        adapter, options = rest_server({ })
+        self.assertIn(adapter, (CherryPyServer, CherootServer))
+        self.assertEqual(options, {'numthreads': 30, 'request_queue_size': 64, 'timeout': 10})
+
+    def testUnknownServer(self):
+        with self.assertRaises(ImageFactoryException) as context:
+            rest_server({'rest_server': 'twisted'})
+        self.assertIn('twisted', str(context.exception))
+
+
+class testLogRequest(unittest.TestCase):
+    def setUp(self):
+        self.saved_config = ApplicationConfiguration._instance
+        ApplicationConfiguration._instance = None
+        ApplicationConfiguration(configuration={'debug': True})
+
+    def tearDown(self):
+        ApplicationConfiguration._instance = self.saved_config
+
+    def testOnlyPrefixLogged(self):
+        body = json.dumps({'template': 'x' * (3 * LOGGED_BODY_LIMIT)}).encode('utf-8')
+        request.bind({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/imagefactory/base_images',
+                      'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(body)),
+                      'wsgi.input': io.BytesIO(body)})
+        handler = log_request(lambda: request.body.read())
+        with self.assertLogs('imgfac.rest.RESTtools', level='DEBUG') as logs:
+            # The handler still gets all of it
+            self.assertEqual(handler(), body)
+        self.assertEqual(len(logs.records), 1)
+        message = logs.records[0].getMessage()
+        self.assertIn(body[:LOGGED_BODY_LIMIT].decode('utf-8'), message)
+        self.assertNotIn(body[:LOGGED_BODY_LIMIT + 1].decode('utf-8'), message)
+
+    def testUploadsNotLogged(self):
+        body = b'\0' * 1000
+        request.bind({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/imagefactory/base_images',
+                      'CONTENT_TYPE': 'multipart/form-data; boundary=x', 'CONTENT_LENGTH': str(len(body)),
+                      'wsgi.input': io.BytesIO(body)})
+        with self.assertLogs('imgfac.rest.RESTtools', level='DEBUG') as logs:
+            log_request(lambda: None)()
+        self.assertIn('(1000 bytes not logged)', logs.records[0].getMessage())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import time
+from threading import Thread, Lock, Barrier, BrokenBarrierError
+from imgfac.ReadWriteLock import ReadWriteLock, StripedReadWriteLock
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BaseImage import BaseImage
+
+
+class testReadWriteLock(unittest.TestCase):
+    def testReadersRunInParallel(self):
+        # Every reader waits inside the lock for all the others, which could never
+        # happen if the lock let only one of them in at a time
+        lock = ReadWriteLock()
+        barrier = Barrier(8, timeout=5)
+        errors = [ ]
+
+        def reader():
+            with lock.reading():
+                try:
+                    barrier.wait()
+                except BrokenBarrierError:
+                    errors.append('reader not let in alongside the others')
+
+        threads = [ Thread(target=reader) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ ], errors)
+
+    def testWriterExcludesEveryone(self):
+        lock = ReadWriteLock()
+        state = {'active': 0, 'writer': False, 'violations': 0}
+        state_lock = Lock()
+
+        def enter(writing):
+            with state_lock:
+                if state['writer'] or (writing and state['active']):
+                    state['violations'] += 1
+                state['active'] += 1
+                state['writer'] = writing
+
+        def leave():
+            with state_lock:
+                state['active'] -= 1
+                state['writer'] = False
+
+        def reader():
+            for i in range(50):
+                with lock.reading():
+                    enter(False)
+                    time.sleep(0.0005)
+                    leave()
+
+        def writer():
+            for i in range(50):
+                with lock.writing():
+                    enter(True)
+                    time.sleep(0.0005)
+                    leave()
+
+        threads = [ Thread(target=reader) for i in range(6) ] + [ Thread(target=writer) for i in range(2) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(0, state['violations'])
+
+    def testStripesAreStable(self):
+        locks = StripedReadWriteLock(8)
+        self.assertIs(locks.lock_for('image-a'), locks.lock_for('image-a'))
+
+
+class testFilePersistentImageManagerConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def testConcurrentReadersAndWriters(self):
+        images = [ ]
+        for i in range(8):
+            image = BaseImage()
+            image.template = '<template/>'
+            self.pim.add_image(image)
+            images.append(image)
+        errors = [ ]
+
+        def reader(image_id):
+            for i in range(100):
+                fetched = self.pim.image_with_id(image_id)
+                if (not fetched) or (fetched.template != '<template/>'):
+                    errors.append(image_id)
+
+        def writer(image):
+            for i in range(50):
+                image.status_detail = {'activity': 'step %d' % i, 'error': None}
+                self.pim.save_image(image)
+
+        threads = [ Thread(target=reader, args=(image.identifier,)) for image in images ]
+        threads += [ Thread(target=writer, args=(image,)) for image in images ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ ], errors)
+
+    def testReadersOfOneImageRunInParallel(self):
+        image = BaseImage()
+        self.pim.add_image(image)
+        # The metadata cache is consulted with the image's read lock held
+        barrier = Barrier(8, timeout=5)
+        real_get = self.pim.metadata_cache.get
+        def waiting_get(image_id, token):
+            barrier.wait()
+            return real_get(image_id, token)
+        self.pim.metadata_cache.get = waiting_get
+        fetched = [ ]
+
+        def reader():
+            fetched.append(self.pim.image_with_id(image.identifier))
+
+        threads = [ Thread(target=reader) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(barrier.broken, 'readers were not let in alongside each other')
+        self.assertEqual([ image.identifier ] * 8, [ i.identifier if i else None for i in fetched ])
+
+    def testWriterBlocksOnlyItsOwnStripe(self):
+        images = [ ]
+        while len(images) < 2:
+            image = BaseImage()
+            if images and self.pim.metadata_locks.lock_for(image.identifier) is self.pim.metadata_locks.lock_for(images[0].identifier):
+                continue
+            self.pim.add_image(image)
+            images.append(image)
+        fetched = [ ]
+        with self.pim.metadata_locks.lock_for(images[0].identifier).writing():
+            blocked = Thread(target=lambda: fetched.append(self.pim.image_with_id(images[0].identifier).identifier))
+            other = Thread(target=lambda: fetched.append(self.pim.image_with_id(images[1].identifier).identifier))
+            blocked.start()
+            other.start()
+            other.join(5)
+            blocked.join(0.1)
+            self.assertEqual([ images[1].identifier ], fetched)
+        blocked.join(5)
+        self.assertEqual([ images[1].identifier, images[0].identifier ], fetched)
+
+    def _readers_and_writers(self, pim):
+        images = [ ]
+        for i in range(4):
+            image = BaseImage()
+            image.template = '<template/>'
+            pim.add_image(image)
+            images.append(image)
+        errors = [ ]
+
+        def reader(image_id):
+            seen = 0
+            for i in range(100):
+                fetched = pim.image_with_id(image_id)
+                if not fetched:
+                    errors.append((image_id, None))
+                    continue
+                # Once a save has been read, no reader may get an older one back
+                if fetched.percent_complete < seen:
+                    errors.append((image_id, seen, fetched.percent_complete))
+                seen = fetched.percent_complete
+                # The writers save these two in step, so a torn read shows as a mismatch
+                expected = ('step %d' % fetched.percent_complete) if fetched.percent_complete else \
+                           'Initializing image prior to Cloud/OS customization'
+                if fetched.status_detail['activity'] != expected:
+                    errors.append((image_id, fetched.percent_complete, fetched.status_detail['activity']))
+
+        def writer(image):
+            for i in range(1, 51):
+                image.percent_complete = i
+                image.status_detail = {'activity': 'step %d' % i, 'error': None}
+                pim.save_image(image)
+
+        threads = [ Thread(target=reader, args=(image.identifier,)) for image in images for j in range(4) ]
+        threads += [ Thread(target=writer, args=(image,)) for image in images ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ ], errors)
+        for image in images:
+            fetched = pim.image_with_id(image.identifier)
+            self.assertEqual((50, 'step 50'), (fetched.percent_complete, fetched.status_detail['activity']))
+
+    def testConcurrentReadersSeeConsistentMetadata(self):
+        # One stripe, so every reader and writer shares a single lock
+        self._readers_and_writers(FilePersistentImageManager(self.storage_path, metadata_lock_stripes=1))
+
+    def testConcurrentReadersWithWriteBehind(self):
+        pim = FilePersistentImageManager(self.storage_path, metadata_lock_stripes=1, write_behind_window=0.005)
+        self._readers_and_writers(pim)
+        pim.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,7 +16,11 @@ import unittest
 import logging
 import os
 import time
+import tempfile
 from imgfac.ReservationManager import ReservationManager
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.Cancellation import CancellationToken, BuildCancelled
 from threading import Thread, Semaphore
 
 
@@ -146,6 +150,77 @@ class testReservationManager(unittest.TestCase):
         self.assertEqual((3 * job_number * len(ReservationManager().queues)), len(job_output))
 
 
+class testResourceAdmission(unittest.TestCase):
+    def setUp(self):
+        self.saved_instances = (ApplicationConfiguration._instance, ReservationManager.instance)
+        ApplicationConfiguration._instance = None
+        ReservationManager.instance = None
+        ApplicationConfiguration(configuration={'resource_budgets': {'memory_mb': 4096, 'cpus': 4}})
+        self.res_mgr = ReservationManager()
+        self.test_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(self.test_path)
+        ApplicationConfiguration._instance, ReservationManager.instance = self.saved_instances
+
+    def testAdmitWholeBudgetOrNothing(self):
+        self.assertTrue(self.res_mgr.admit('first', memory_mb=3072, cpus=1))
+        # Enough vCPUs but not enough memory - nothing may be reserved
+        self.assertFalse(self.res_mgr.admit('second', memory_mb=2048, cpus=2, timeout=0.1))
+        budgets = self.res_mgr.resource_budgets
+        self.assertEqual(budgets['memory_mb'], {'total': 4096, 'reserved': 3072, 'available': 1024})
+        self.assertEqual(budgets['cpus']['reserved'], 1)
+        self.assertEqual(list(budgets['admitted'].keys()), [ 'first' ])
+        self.res_mgr.release('first')
+        self.assertTrue(self.res_mgr.admit('second', memory_mb=2048, cpus=2, timeout=0.1))
+        self.res_mgr.release('second')
+        self.assertEqual(self.res_mgr.resource_budgets['cpus']['available'], 4)
+
+    def testWaitingBuildAdmittedOnRelease(self):
+        self.res_mgr.admit('first', memory_mb=1024, cpus=4)
+        admitted = [ ]
+        waiter = Thread(target=lambda: admitted.append(self.res_mgr.admit('second', memory_mb=1024, cpus=1)))
+        waiter.start()
+        time.sleep(0.2)
+        self.assertEqual(admitted, [ ])
+        self.assertEqual(self.res_mgr.resource_budgets['waiting'], 1)
+        self.res_mgr.release('first')
+        waiter.join(5)
+        self.assertEqual(admitted, [ True ])
+        self.res_mgr.release('second')
+
+    def testDiskReservedWithMemoryAndCPUs(self):
+        body = os.path.join(self.test_path, 'image.body')
+        self.res_mgr.add_path(self.test_path, 0)
+        self.assertTrue(self.res_mgr.admit('build', memory_mb=512, cpus=1, disk_bytes=1024, disk_path=body))
+        self.assertEqual(self.res_mgr.reservations[body], 1024)
+        self.res_mgr.release('build')
+        self.assertFalse(body in self.res_mgr.reservations)
+        self.res_mgr.remove_path(self.test_path)
+
+    def testCancelWhileWaitingForAdmission(self):
+        self.res_mgr.admit('first', memory_mb=1024, cpus=4)
+        token = CancellationToken()
+        errors = [ ]
+        def admit():
+            try:
+                self.res_mgr.admit('second', memory_mb=1024, cpus=1, cancellation=token)
+            except BuildCancelled as e:
+                errors.append(e)
+        waiter = Thread(target=admit)
+        waiter.start()
+        time.sleep(0.2)
+        token.cancel('Stop')
+        waiter.join(5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.res_mgr.resource_budgets['waiting'], 0)
+        self.assertEqual(list(self.res_mgr.resource_budgets['admitted'].keys()), [ 'first' ])
+        self.res_mgr.release('first')
+
+    def testRequestLargerThanBudget(self):
+        self.assertRaises(ImageFactoryException, self.res_mgr.admit, 'huge', memory_mb=8192)
+
+
 class MockJob(Thread):
     """ TODO: Docstring for MockJob  """
 
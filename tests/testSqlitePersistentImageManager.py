@@ -0,0 +1,180 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from threading import Thread
+from imgfac.SqlitePersistentImageManager import SqlitePersistentImageManager
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+from imgfac.ProviderImage import ProviderImage
+
+
+class testSqlitePersistentImageManager(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = SqlitePersistentImageManager(self.storage_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def testAddSaveAndRetrieve(self):
+        image = BaseImage()
+        image.template = '<template/>'
+        self.pim.add_image(image)
+        self.assertTrue(os.path.isfile(image.data))
+        self.assertRaises(ImageFactoryException, self.pim.add_image, image)
+
+        image._status = 'COMPLETE'
+        image.parameters = {'nested': {'value': 1}}
+        self.pim.save_image(image)
+        fetched = self.pim.image_with_id(image.identifier)
+        self.assertEqual('COMPLETE', fetched.status)
+        self.assertEqual('<template/>', fetched.template)
+        self.assertEqual({'nested': {'value': 1}}, fetched.parameters)
+        self.assertIsNone(self.pim.image_with_id('no-such-image'))
+
+        self.assertRaises(ImageFactoryException, self.pim.save_image, BaseImage())
+
+    def testQueries(self):
+        base = BaseImage()
+        self.pim.add_image(base)
+        targets = [ ]
+        for target in ('ec2', 'ec2', 'openstack-kvm'):
+            image = TargetImage()
+            image.base_image_id = base.identifier
+            image.target = target
+            self.pim.add_image(image)
+            targets.append(image)
+        provider = ProviderImage()
+        provider.target_image_id = targets[0].identifier
+        provider.identifier_on_provider = 'ami-1234'
+        self.pim.add_image(provider)
+
+        found = self.pim.images_from_query({'type': 'TargetImage', 'base_image_id': base.identifier, 'target': 'ec2'})
+        self.assertEqual(set([ targets[0].identifier, targets[1].identifier ]), set([ i.identifier for i in found ]))
+        # A key only present in the JSON blob
+        found = self.pim.images_from_query({'identifier_on_provider': 'ami-1234'})
+        self.assertEqual([ provider.identifier ], [ i.identifier for i in found ])
+        found = self.pim.images_from_query({'type': 'BaseImage', 'parameters': { }})
+        self.assertEqual([ base.identifier ], [ i.identifier for i in found ])
+
+        self.pim.delete_image_with_id(targets[2].identifier)
+        self.assertEqual(2, len(self.pim.images_from_query({'type': 'TargetImage'})))
+        self.assertFalse(os.path.exists(targets[2].data))
+
+    def testBodiesStoredOutsideTransaction(self):
+        pim = SqlitePersistentImageManager(os.path.join(self.storage_path, 'dedupe'), dedupe_bodies=True)
+        ingested = [ ]
+        ingest = pim.blob_store.ingest
+        def checked_ingest(key, path):
+            ingested.append((key, pim._connection().in_transaction))
+            return ingest(key, path)
+        pim.blob_store.ingest = checked_ingest
+        images = [ BaseImage() for i in range(2) ]
+        for image in images:
+            pim.add_image(image)
+            with open(image.data, 'w') as body:
+                body.write('identical body')
+            image._status = 'COMPLETE'
+        pim.save_images(images)
+        self.assertTrue(pim.blob_store.wait(5))
+        self.assertEqual(sorted(ingested), sorted([ (image.identifier, False) for image in images ]))
+        self.assertEqual(os.stat(images[0].data).st_ino, os.stat(images[1].data).st_ino)
+
+    def testBatchedSaves(self):
+        images = [ BaseImage() for i in range(5) ]
+        with self.pim.batch():
+            for image in images:
+                self.pim.add_image(image)
+        for image in images:
+            image._status = 'COMPLETE'
+        self.pim.save_images(images)
+        self.assertEqual(5, len(self.pim.images_from_query({'status': 'COMPLETE'})))
+
+        try:
+            with self.pim.batch():
+                self.pim.add_image(BaseImage())
+                raise RuntimeError('abandon the batch')
+        except RuntimeError:
+            pass
+        self.assertEqual(5, len(self.pim.images_from_query({'type': 'BaseImage'})))
+
+    def testConcurrentAccess(self):
+        images = [ BaseImage() for i in range(4) ]
+        for image in images:
+            self.pim.add_image(image)
+        errors = [ ]
+
+        def reader():
+            try:
+                for i in range(50):
+                    if len(self.pim.images_from_query({'type': 'BaseImage'})) != 4:
+                        errors.append('short read')
+            except Exception as e:
+                errors.append(e)
+
+        def writer(image):
+            try:
+                for i in range(25):
+                    image.status_detail = {'activity': 'step %d' % i, 'error': None}
+                    self.pim.save_image(image)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [ Thread(target=reader) for i in range(4) ] + [ Thread(target=writer, args=(image,)) for image in images ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([ ], errors)
+
+    def testPagedQueries(self):
+        images = [ ]
+        for i in range(7):
+            image = BaseImage()
+            image._status = 'COMPLETE' if i % 2 else 'FAILED'
+            self.pim.add_image(image)
+            images.append(image)
+        ids = sorted([ image.identifier for image in images ])
+
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, limit=3))
+        self.assertEqual(ids[0:3], [ metadata['identifier'] for metadata in page ])
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, limit=3, after=page[-1]['identifier']))
+        self.assertEqual(ids[3:6], [ metadata['identifier'] for metadata in page ])
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, offset=5))
+        self.assertEqual(ids[5:], [ metadata['identifier'] for metadata in page ])
+
+        completed = sorted([ image.identifier for image in images if image.status == 'COMPLETE' ])
+        page = list(self.pim.metadata_from_query({'status': 'COMPLETE'}, offset=1, limit=1))
+        self.assertEqual(completed[1:2], [ metadata['identifier'] for metadata in page ])
+        # Same again with a key that has to be checked outside the index
+        page = list(self.pim.metadata_from_query({'status': 'COMPLETE', 'parameters': { }}, offset=1, limit=1))
+        self.assertEqual(completed[1:2], [ metadata['identifier'] for metadata in page ])
+
+        page = list(self.pim.metadata_from_query({'type': 'BaseImage'}, fields=['status'], limit=1))
+        self.assertEqual(set(['type', 'identifier', 'status']), set(page[0].keys()))
+
+        self.assertEqual([ ], list(self.pim.metadata_from_query({'type': 'BaseImage'}, modified_after=time.time() + 3600)))
+        self.assertEqual(7, len(list(self.pim.metadata_from_query({'type': 'BaseImage'}, modified_before=time.time() + 3600))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os
+import time
+import uuid
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.StorageCollector import StorageCollector
+from imgfac.TargetImage import TargetImage
+
+
+class testStorageCollector(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.pim = FilePersistentImageManager(self.storage_path)
+        self.collector = StorageCollector(self.pim, min_age=600)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _file(self, name, size=4096, age=3600):
+        path = os.path.join(self.storage_path, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        past = time.time() - age
+        os.utime(path, (past, past))
+        return path
+
+    def _image(self, status):
+        image = TargetImage()
+        image._status = status
+        self.pim.add_image(image)
+        return image
+
+    def testOrphansRemoved(self):
+        complete = self._image('COMPLETE')
+        building = self._image('BUILDING')
+        orphan_id = str(uuid.uuid4())
+        orphan_body = self._file(orphan_id + '.body')
+        orphan_gz = self._file(orphan_id + '.body.gz')
+        orphan_marker = self._file(orphan_id + '.body.gz-factory-compressed', size=0)
+        finished_tmp = self._file(complete.identifier + '.body.tmp.qcow2')
+        complete_gz = self._file(complete.identifier + '.body.gz')
+        building_tmp = self._file(building.identifier + '.body.tmp')
+        recent_orphan = self._file(str(uuid.uuid4()) + '.body', age=0)
+        unrelated = self._file('notes.txt')
+        ovf_dir = tempfile.mkdtemp(dir=self.storage_path)
+        past = time.time() - 3600
+        os.utime(ovf_dir, (past, past))
+
+        report = self.collector.collect()
+        self.assertEqual(sorted(report['removed']),
+                         sorted([ orphan_body, orphan_gz, orphan_marker, finished_tmp, ovf_dir ]))
+        self.assertEqual(report['reclaimed_bytes'], 3 * 4096)
+        for path in report['removed']:
+            self.assertFalse(os.path.exists(path))
+        for path in (complete.data, complete_gz, building.data, building_tmp, recent_orphan, unrelated):
+            self.assertTrue(os.path.exists(path))
+        self.assertIsNotNone(self.pim.image_with_id(complete.identifier))
+
+    def testDryRunRemovesNothing(self):
+        orphan_body = self._file(str(uuid.uuid4()) + '.body')
+        report = self.collector.collect(dry_run=True)
+        self.assertEqual(report['removed'], [ orphan_body ])
+        self.assertEqual(report['reclaimed_bytes'], 4096)
+        self.assertTrue(os.path.exists(orphan_body))
+
+    def testFailedImageQuotas(self):
+        old_failed = self._image('FAILED')
+        new_failed = self._image('FAILED')
+        complete = self._image('COMPLETE')
+        for image, age in ((old_failed, 7200), (new_failed, 60), (complete, 7200)):
+            past = time.time() - age
+            os.utime(image.data, (past, past))
+        self.collector.failed_image_max_age = 3600
+        report = self.collector.collect()
+        self.assertEqual(report['deleted_images'], [ old_failed.identifier ])
+        self.assertIsNone(self.pim.image_with_id(old_failed.identifier))
+        # Over the size quota the remaining FAILED image goes too, but never a COMPLETE one
+        self.collector.max_storage_bytes = 1
+        report = self.collector.collect()
+        self.assertEqual(report['deleted_images'], [ new_failed.identifier ])
+        self.assertIsNotNone(self.pim.image_with_id(complete.identifier))
+
+    def testDeduplicatedOrphanFreesBlob(self):
+        pim = FilePersistentImageManager(os.path.join(self.storage_path, 'dedupe'), dedupe_bodies=True)
+        collector = StorageCollector(pim, min_age=600)
+        images = [ ]
+        for content in (b'x' * 8192, b'y' * 8192):
+            image = TargetImage()
+            pim.add_image(image)
+            with open(image.data, 'wb') as body:
+                body.write(content)
+            image._status = 'COMPLETE'
+            pim.save_image(image)
+            images.append(image)
+        self.assertTrue(pim.blob_store.wait(5))
+        self.assertEqual(pim.blob_store.usage()['blobs'], 2)
+        past = time.time() - 3600
+        os.utime(images[0].data, (past, past))
+        # Loses its metadata - the body, its ref and its blob are all junk
+        os.remove(os.path.join(pim.storage_path, images[0].identifier + '.meta'))
+        # Removed behind the store's back - only the blob and its ref are left
+        os.remove(images[1].data)
+
+        report = collector.collect()
+        self.assertIn(images[0].data, report['removed'])
+        self.assertFalse(os.path.exists(images[0].data))
+        self.assertEqual(pim.blob_store.usage()['blobs'], 0)
+        self.assertIsNone(pim.blob_store.digest_for(images[0].identifier))
+        self.assertIsNone(pim.blob_store.digest_for(images[1].identifier))
+        self.assertGreaterEqual(report['reclaimed_bytes'], 2 * 8192)
+
+
+if __name__ == '__main__':
+    unittest.main()